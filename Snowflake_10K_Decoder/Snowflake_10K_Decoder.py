@@ -2,8 +2,29 @@
 import streamlit as st
 import pandas as pd
 import json
+import sys
+import tempfile
+import time
+from concurrent.futures import as_completed
+from pathlib import Path
 from snowflake.snowpark.context import get_active_session
 
+# Make the shared cortex_utils package (in the repository root) importable
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from cortex_utils.context import context_window, estimate_tokens, pack_documents, prompt_budget
+from cortex_utils.dashboard import render_performance_dashboard
+from cortex_utils.data_cache import QueryCache, session_key
+from cortex_utils.extraction import ExtractionStore, extract_all, extraction_prompt
+from cortex_utils.frames import filing_frame, frame_documents, preview_frame
+from cortex_utils.map_reduce import map_reduce
+from cortex_utils.metrics import CallRecord, CallRecorder, LoggingSink, run_instrumented
+from cortex_utils.multi_company import analyze_companies
+from cortex_utils.retrieval import RetrievalIndex
+from cortex_utils.scheduler import CortexBackend, Scheduler
+from cortex_utils.sec_filings import FilingStore, ingest
+from cortex_utils.sql import complete_over_documents_sql
+from cortex_utils.streaming import TimedStream
+
 
 # Set up the main title of the Streamlit app
 st.title("AI21's Jamba-Instruct in Snowflake Cortex :snake::snowflake:")
@@ -40,73 +61,269 @@ st.write("""
 uses Cybersyn's [SEC_FILINGS](https://app.snowflake.com/marketplace/listing/GZTSZAS2KH9/cybersyn-sec-filings?originTab=provider&providerName=Cybersyn%2C&ref=blog.streamlit.io) database (specifically the SEC_REPORT_TEXT_ATTRIBUTES and SEC_REPORT_INDEX tables), 
 which is available for free in the Snowflake data marketpalce.
 
-This app uses the last 3 Fiscal Years of NVIDIA Corp's SEC 10-K filings. To view the raw table data click 'View 10K Detail' below. (To expand 'VALUE' double click the cell)
+By default this app uses the last 3 Fiscal Years of NVIDIA Corp's SEC 10-K filings. Select more companies below to analyze them side by side. To view the raw table data click 'View 10K Detail' below. (To expand 'VALUE' double click the cell)
 """)
 
 
-sec_query = """
+# Default company and fiscal years of the filings read from the local filing store
+COMPANY_NAME = 'NVIDIA CORP'
+FISCAL_YEARS = (2021, 2022, 2023)
+
+# Companies that can be analyzed, as named in SEC_REPORT_INDEX
+COMPANY_NAMES = ('NVIDIA CORP', 'ADVANCED MICRO DEVICES INC', 'INTEL CORP', 'MICROSOFT CORP', 'APPLE INC.')
+
+# Function to build the sec filing query of the given companies and fiscal years.
+# The company names and years are passed as bind parameters.
+def sec_query(company_names=(COMPANY_NAME,), fiscal_years=FISCAL_YEARS):
+    sql = f"""
     (
 select A.*, B.* from "SEC_FILINGS"."CYBERSYN".SEC_REPORT_TEXT_ATTRIBUTES A
 left join "SEC_FILINGS"."CYBERSYN".SEC_REPORT_INDEX B
-on A.CIK = B.CIK
-where B.company_name = 'NVIDIA CORP' --limit the results to only show NVIDIA
+on A.ADSH = B.ADSH
+where B.company_name in ({', '.join('?' for _ in company_names)}) --limit the results to the selected companies
 and B.form_type = '10-K' --10K filing only
 and A.variable_name = '10-K Filing Text' --10K filing only
-and ((A.PERIOD_END_DATE = '2024-01-28' and B.FISCAL_YEAR = 2023) 
-    or (A.PERIOD_END_DATE = '2023-01-29' and B.FISCAL_YEAR = 2022) 
-    or (A.PERIOD_END_DATE = '2022-01-30' and B.FISCAL_YEAR = 2021)) --NVIDIA 10K filings for the last 3 years
-order by FILED_DATE desc, PERIOD_END_DATE desc)
+and B.FISCAL_YEAR in ({', '.join('?' for _ in fiscal_years)}) --10K filings of the selected fiscal years
+order by COMPANY_NAME, FILED_DATE desc, PERIOD_END_DATE desc)
     """
+    return sql, list(company_names) + list(fiscal_years)
+
+# Shared store of the filings and their section splits, persisted on local disk
+@st.cache_resource
+def get_filing_store():
+    return FilingStore(str(Path(tempfile.gettempdir()) / "10k_decoder_filings"))
+
+# Shared store of the key figures extracted from each filing, persisted on local disk
+@st.cache_resource
+def get_extraction_store():
+    return ExtractionStore(str(Path(tempfile.gettempdir()) / "10k_decoder_extractions"))
+
+# Shared recorder of the latency and token usage of every model call
+@st.cache_resource
+def get_call_recorder():
+    return CallRecorder([LoggingSink()])
+
+# Shared scheduler of the model calls: per-model concurrency caps, retries of
+# throttled calls and deduplication of identical prompts, across reruns and users
+@st.cache_resource
+def get_scheduler():
+    return Scheduler()
+
+# Backend of the model calls, one per Snowflake account and role, shared across reruns
+# and users so that the scheduler recognises identical prompts already in flight
+@st.cache_resource
+def get_backend(identity):
+    return CortexBackend(session, get_call_recorder())
 
-# Function to fetch sec data from Snowflake
-def run_data_query():
-    query = sec_query
-    result = session.sql(query).collect()
-    return result
+# Shared passage index of the filings, persisted on local disk
+@st.cache_resource
+def get_retrieval_index():
+    return RetrievalIndex(str(Path(tempfile.gettempdir()) / "10k_decoder_index"))
+
+# Shared cache of the filing DataFrames, kept across reruns and users of the app.
+# A multi-company analysis holds one entry per company, so a few entries are kept.
+@st.cache_resource
+def get_data_cache():
+    return QueryCache(max_entries=8)
+
+# Columnar view of the stored filings, built once per selection and version of the filings
+def load_filing_frame(company_names, fiscal_years, filings_version):
+    return get_data_cache().get_or_load(
+        session,
+        ("filing_frame", company_names, fiscal_years, filings_version),
+        lambda: filing_frame(get_filing_store().rows(company_names, fiscal_years)),
+    )
+
+# Function to download the filings of the selected fiscal years that are not in the local store yet.
+# Snowflake is only queried for companies with a selected fiscal year never checked before.
+def ingest_missing(company_names, fiscal_years):
+    store = get_filing_store()
+    missing = [company_name for company_name in company_names if store.missing_years(company_name, fiscal_years)]
+    if missing:
+        ingest(session, store, missing, fiscal_years)
+
+# Function to fetch sec data as a DataFrame. The filings of the selected fiscal years are
+# downloaded into the local store on the first call; later reruns reuse the cached DataFrame until
+# new filings are ingested.
+def run_data_query(company_names=(COMPANY_NAME,), fiscal_years=FISCAL_YEARS):
+    company_names, fiscal_years = tuple(company_names), tuple(sorted(fiscal_years))
+    ingest_missing(company_names, fiscal_years)
+    filings_version = tuple(meta['text_hash'] for meta in get_filing_store().filings(company_names, fiscal_years))
+    return load_filing_frame(company_names, fiscal_years, filings_version)
+
+# Generation options of every question
+QUERY_OPTIONS = {'temperature': 0.3, 'max_tokens': 2000}
+
+# Function to submit a question to a given language model through the scheduler.
+# The question is passed as bind parameters, either as one string or as a list of
+# parts that Snowflake concatenates, so the SQL text is the same for every question.
+def submit_query(model, question):
+    messages = [{'role': 'user', 'content': question}]
+    return get_scheduler().submit_complete(get_backend(session_key(session)), model, messages, QUERY_OPTIONS)
+
+# Function to build the prompt parts: the question followed by every filing or passage,
+# each headed by its title (fiscal year and company) so the model knows where it comes from
+def build_prompt_parts(question, documents):
+    parts = [question, "\n\n\n\n"]
+    for index, (title, text) in enumerate(documents):
+        if index:
+            parts.append("\n\n")
+        parts += [f"[{title}]\n", text]
+    return parts
 
 # Function to run a specific query using the selected language model
 def run_query(question):
-    params = f"""
-    SELECT SNOWFLAKE.CORTEX.COMPLETE(
-        '{option}',
-        ARRAY_CONSTRUCT(
-            OBJECT_CONSTRUCT('role', 'user', 'content', '{question}')
-        ),
-        OBJECT_CONSTRUCT('temperature', 0.3, 'max_tokens', 2000)
-    );
-    """
-    result = session.sql(params).collect()
-    return result[0][0] if result else None
+    return submit_query(option, question).result()
 
-# Fetch the data
-filing_data = run_data_query()
+# Function to return only the answer text of the selected language model
+def run_query_text(prompt):
+    result = run_query(prompt)
+    return json.loads(result)['choices'][0]['messages'] if result else ''
+
+# Function to return a callable answering prompts with the selected language model, for
+# engines that call it from worker threads (map-reduce, extraction, multi-company analysis).
+# The scheduler and backend are looked up here, on the script thread: worker threads have
+# no Streamlit script context, so they must not call st.cache_resource functions.
+def query_text_runner():
+    scheduler, backend = get_scheduler(), get_backend(session_key(session))
+    
+    def run(prompt):
+        messages = [{'role': 'user', 'content': prompt}]
+        result = scheduler.submit_complete(backend, option, messages, QUERY_OPTIONS).result()
+        return json.loads(result)['choices'][0]['messages'] if result else ''
+    return run
+
+# Function to answer the question with a prompt assembled inside Snowflake.
+# The filings never leave Snowflake: only the answer is returned to the app.
+# The scheduler and call recorder can be passed in when it runs in a worker thread.
+def run_server_side_query(question, company_names=(COMPANY_NAME,), fiscal_years=FISCAL_YEARS,
+                          scheduler=None, recorder=None):
+    # Cut each filing in SQL if the model's context window cannot hold all of them
+    # (about four characters per token)
+    budget_chars = prompt_budget(option, 2000, question) * 4
+    filings_sql, filings_params = sec_query(company_names, fiscal_years)
+    sql, params = complete_over_documents_sql(
+        option,
+        f"{question}\n\n\n\n",
+        f"SELECT VALUE, FILED_DATE, PERIOD_END_DATE, COUNT(*) OVER () AS FILING_COUNT FROM {filings_sql}",
+        f"LEFT(VALUE, FLOOR({budget_chars} / FILING_COUNT))",
+        "FILED_DATE DESC, PERIOD_END_DATE DESC",
+        QUERY_OPTIONS,
+        documents_params=filings_params,
+    )
+    scheduler, recorder = scheduler or get_scheduler(), recorder or get_call_recorder()
+    return scheduler.run(option, lambda: run_instrumented(session, (sql, params), option, recorder))
+
+# Function to extract the key figures (revenue, margins, headcount, segments) of every filing.
+# Each filing is sent to the model once per schema version; later calls read the stored fields.
+# The prompt runner and store can be passed in when it runs in a worker thread.
+def extract_key_figures(filing_data, run_text=None, store=None):
+    return extract_all(
+        list(zip(filing_data['SEC_DOCUMENT_ID'], filing_data['VALUE'])),
+        run_text or query_text_runner(),
+        store or get_extraction_store(),
+        max_text_tokens=prompt_budget(option, 2000, extraction_prompt('')),
+    )
+
+# Function to show the extracted key figures as one row per filing
+def key_figures_table(filing_data, extractions):
+    rows = []
+    for company_name, fiscal_year, extraction in zip(filing_data['COMPANY_NAME'], filing_data['FISCAL_YEAR'], extractions):
+        fields = extraction.fields
+        rows.append({
+            'COMPANY_NAME': company_name,
+            'FISCAL_YEAR': fiscal_year,
+            'REVENUE (M)': fields.get('revenue'),
+            'GROSS_MARGIN (%)': fields.get('gross_margin'),
+            'OPERATING_MARGIN (%)': fields.get('operating_margin'),
+            'NET_MARGIN (%)': fields.get('net_margin'),
+            'HEADCOUNT': fields.get('headcount'),
+            'SEGMENTS': ', '.join(f"{segment['name']}: {segment['revenue']}" for segment in fields.get('segments') or []),
+            'STATUS': 'stored' if extraction.cached else '; '.join(extraction.errors) or 'extracted',
+        })
+    return rows
+
+# Function to build a prompt answering the question from the extracted key figures only,
+# a few hundred tokens instead of the full filings
+def build_key_figures_prompt(question, filing_data, extractions):
+    figures = [
+        dict(company_name=company_name, fiscal_year=int(fiscal_year), **extraction.fields)
+        for company_name, fiscal_year, extraction in zip(filing_data['COMPANY_NAME'], filing_data['FISCAL_YEAR'], extractions)
+        if not extraction.errors
+    ]
+    return f"{question}\n\n\n\nKey figures of the 10K filings (amounts in millions):\n{json.dumps(figures, indent=2)}"
+
+# Function to stream the answer of the selected language model chunk by chunk
+def stream_query(question):
+    messages = [{'role': 'user', 'content': question}]
+    return get_scheduler().stream(get_backend(session_key(session)), option, messages, QUERY_OPTIONS)
+
+# Function to answer the question over the filings of a single company (company_data) with the
+# given processing mode. A multi-company analysis runs it for every company in worker threads,
+# so it only uses plain data and the callables and stores it is given.
+def analyze_company(question, company_data, run_text, extraction_store, mode="Single prompt"):
+    company_documents = frame_documents(company_data)
+    if not company_documents:
+        return ''
+    if mode == "Key figures":
+        extractions = extract_key_figures(company_data, run_text, extraction_store)
+        return run_text(build_key_figures_prompt(question, company_data, extractions))
+    if mode == "Map-reduce":
+        return map_reduce(company_documents, question, run_text, prompt_budget(option, 2000)).answer
+    packed = pack_documents(company_documents, prompt_budget(option, 2000, question), question)
+    return run_text(build_prompt_parts(question, packed.documents))
+
+# Function to return the per-company analysis of a multi-company question. The filings (downloaded
+# in one query for every company missing them) and the shared resources are resolved here, on the
+# script thread, before analyze_companies runs the analysis of each company in a worker thread.
+def company_analyzer(question, company_names, fiscal_years=FISCAL_YEARS, mode="Single prompt"):
+    if mode == "Server-side prompt":
+        scheduler, recorder = get_scheduler(), get_call_recorder()
+        
+        def analyze_server_side(company_name):
+            result = run_server_side_query(question, (company_name,), fiscal_years, scheduler, recorder)
+            return json.loads(result)['choices'][0]['messages'] if result else ''
+        return analyze_server_side
+    
+    ingest_missing(company_names, sorted(fiscal_years))
+    company_data = {company_name: run_data_query((company_name,), fiscal_years) for company_name in company_names}
+    run_text, extraction_store = query_text_runner(), get_extraction_store()
+    return lambda company_name: analyze_company(question, company_data[company_name], run_text, extraction_store, mode)
+
+# Select the companies and fiscal years of the filings
+companies = st.multiselect("Companies:", COMPANY_NAMES, default=[COMPANY_NAME])
+fiscal_years = st.multiselect("Fiscal years:", (2019, 2020, 2021, 2022, 2023), default=list(FISCAL_YEARS))
 
 # Display the SQL query used to fetch the data
 with st.expander("View SQL Query:"):
-    st.code(sec_query)
+    st.code(sec_query(companies, fiscal_years)[0])
+
+# Display the filing store watermarks and DataFrame cache counters, and allow ingesting
+# new or changed filings
+with st.expander("Filing Store:"):
+    st.write(get_filing_store().watermarks())
+    st.write(get_data_cache().stats())
+    if st.button('Check for New 10K Filings'):
+        updated = ingest(session, get_filing_store(), companies, sorted(fiscal_years))
+        st.write(f"{len(updated)} filings added or updated")
 
 # Button to display the filing details
 if st.button('View 10K Detail'):
-    if filing_data:
-        # Create a DataFrame for the main details
-        df_main = pd.DataFrame([{
-            'SEC_DOCUMENT_ID': row['SEC_DOCUMENT_ID'],
-            'VARIABLE_NAME': row['VARIABLE_NAME'],
-            'COMPANY_NAME': row['COMPANY_NAME'],
-            'FILED_DATE': row['FILED_DATE'],
-            'FISCAL_YEAR': row['FISCAL_YEAR'],
-            'VALUE': row['VALUE']
-        } for row in filing_data])
-        
-        # Display the main details as a DataFrame
-        st.dataframe(df_main)
+    # Fetch the data
+    filing_data = run_data_query(companies, fiscal_years)
+    if not filing_data.empty:
+        # Display the main details, with a preview of each filing instead of its full text
+        st.dataframe(preview_frame(filing_data))
+    else:
+        st.error("No filing data available.")
 
-        # Create a string variable with all VALUE data concatenated
-        all_values = ' '.join(df_main['VALUE'].astype(str))
-        
-        # Display the concatenated string
-        # st.write("All VALUES concatenated:")
-        # st.text(all_values)
+# Button to extract the key figures of the filings, or read them from the store
+if st.button('Extract Key Figures'):
+    filing_data = run_data_query(companies, fiscal_years)
+    if not filing_data.empty:
+        with st.spinner("Extracting the key figures of new filings..."):
+            extractions = extract_key_figures(filing_data)
+        st.dataframe(key_figures_table(filing_data, extractions), use_container_width=True)
     else:
         st.error("No filing data available.")
 
@@ -115,10 +332,8 @@ st.write("""
 Of the language models available in Snowflake Cortex, only Jamba-Instruct can handle context lenghts up to 256K tokens!
 """)
 
-# Dropdown to select a language model
-option = st.selectbox(
-"Select a language model:",
-("snowflake-arctic",
+# Language models available in the app
+models = ("snowflake-arctic",
 "mistral-large",
 "reka-flash",
 "jamba-1.5-mini",
@@ -129,7 +344,18 @@ option = st.selectbox(
 "llama3-70b",
 "llama3.1-405b",
 "mistral-7b",
-"gemma-7b",))
+"gemma-7b",)
+
+# Dropdown to select a language model
+option = st.selectbox("Select a language model:", models)
+
+# Optionally run the same question on several models at once
+compare_models = st.multiselect(
+    "Compare models (optional):",
+    models,
+    help="All selected models are queried concurrently and their answers are shown side by side, "
+         "so the comparison takes as long as the slowest model.",
+)
 
 # Provide information about using Jamba with long text
 st.write("""
@@ -152,50 +378,219 @@ question = question + "##################\n\n"
 
 
 
+# Select how the filings are sent to the model
+mode = st.radio(
+    "Processing mode:",
+    ("Single prompt", "Server-side prompt", "Retrieval", "Map-reduce", "Key figures"),
+    horizontal=True,
+    help="Server-side prompt builds the prompt inside Snowflake, so the filings are never downloaded "
+         "(the answer is not streamed). Retrieval only sends the filing passages most relevant to the "
+         "question. Map-reduce splits the filings into sections, queries the sections concurrently and "
+         "combines the partial answers. Use it with models whose context window cannot hold the filings. "
+         "Key figures answers from the revenue, margins, headcount and segments extracted from each filing "
+         "once and stored, so follow-up questions about these figures take a single small prompt. "
+         "With several companies, each company is analyzed on its own, all of them concurrently, and the "
+         "answers are then combined (in retrieval mode, each company's filings are trimmed to the passages "
+         "most relevant to the question when they do not fit the context window).",
+)
+
+# Number of passages sent to the model in retrieval mode
+if mode == "Retrieval":
+    top_k = st.slider("Passages to retrieve:", min_value=2, max_value=40, value=12)
+
 # Button to run the sec filing query
 if st.button('Run Filing Query'):
-    with st.spinner("Fetching filing data and running query..."):
-        if filing_data:
-            df_main = pd.DataFrame([{
-                'SEC_DOCUMENT_ID': row['SEC_DOCUMENT_ID'],
-                'VARIABLE_NAME': row['VARIABLE_NAME'],
-                'COMPANY_NAME': row['COMPANY_NAME'],
-                'FILED_DATE': row['FILED_DATE'],
-                'FISCAL_YEAR': row['FISCAL_YEAR'],
-                'VALUE': row['VALUE']
-            } for row in filing_data])
+    # Several companies are analyzed one company per call, unless models are compared
+    multi_company = len(companies) > 1 and not compare_models
+    # Only download the filings when the prompt is built in the app
+    filing_data = (
+        run_data_query(companies, fiscal_years)
+        if companies and not multi_company and (mode != "Server-side prompt" or compare_models) else None
+    )
+    filing_documents = frame_documents(filing_data) if filing_data is not None else []
+    
+    if not companies or not fiscal_years:
+        st.error("Select at least one company and one fiscal year.")
+    elif multi_company:
+        # Fetch the filings and query the model for every company concurrently, then
+        # combine the answers: the wall-clock time is that of the slowest company
+        with st.spinner(f"Analyzing {len(companies)} companies concurrently..."):
+            result = analyze_companies(
+                companies,
+                question,
+                company_analyzer(question, companies, fiscal_years, mode),
+                run_query_text,
+            )
+        
+        if result.answer:
+            st.write("Jamba-Instruct Response:")
+            st.write(result.answer)
             
-            # Create a string variable with all VALUE data concatenated
-            all_values = ' '.join(df_main['VALUE'].astype(str))
+            # Report the wall-clock time against the slowest single company
+            col1, col2 = st.columns(2)
+            col1.metric("Total time", f"{result.elapsed:.2f}s")
+            col2.metric("Slowest company", f"{max(analysis.elapsed for analysis in result.analyses):.2f}s")
             
-            # Prepare the question with context
-            question_context = f"{question}\n\n\n\n{all_values}".replace('"', '').replace("'", '')
-            with st.expander("View Query and Context"):
-                st.write(question_context)
+            with st.expander("View Per-Company Answers"):
+                for analysis in result.analyses:
+                    st.subheader(analysis.company_name)
+                    st.caption(f"{analysis.elapsed:.2f}s")
+                    if analysis.error:
+                        st.error(f"Query failed: {analysis.error}")
+                    else:
+                        st.write(analysis.answer)
+        else:
+            st.error("No result returned from the query.")
+    elif mode == "Server-side prompt" and not compare_models:
+        with st.spinner("Running the query inside Snowflake..."):
+            started_at = time.perf_counter()
+            query_result = run_server_side_query(question, companies, fiscal_years)
+            elapsed = time.perf_counter() - started_at
+        
+        if query_result:
+            result_json = json.loads(query_result)
+            st.write("Jamba-Instruct Response:")
+            st.write(result_json['choices'][0]['messages'])
             
-            # Run the query
-            query_result = run_query(question_context)
+            # Report the cost of the query; only the answer was transferred
+            usage = result_json.get('usage', {})
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Total time", f"{elapsed:.2f}s")
+            col2.metric("Prompt tokens", f"{usage.get('prompt_tokens', 0):,}")
+            col3.metric("Bytes downloaded", f"{len(query_result):,}")
             
-            if query_result:
-                # Parse the JSON string
-                result_json = json.loads(query_result)
-                
-                # Display the message in a text area
-                message = result_json['choices'][0]['messages']
-                st.write("Jamba-Instruct Response:")
-                st.write(message)
-                
-                # Display the full response in an expandable section
-                with st.expander("View Full Response"):
-                    st.json(result_json)
-            else:
-                st.error("No result returned from the query.")
+            with st.expander("View Full Response"):
+                st.json(result_json)
         else:
-            st.error("No result returned from the data query.")
-    
+            st.error("No result returned from the query.")
+    elif filing_documents and compare_models:
+        # Submit one query per model, with the filings packed into each model's context window.
+        # The scheduler runs them concurrently and records the metrics of every call.
+        started_at = time.perf_counter()
+        futures = {}
+        for model in compare_models:
+            packed = pack_documents(filing_documents, prompt_budget(model, 2000, question), question)
+            futures[submit_query(model, build_prompt_parts(question, packed.documents))] = model
+        
+        # One column per model, filled in as soon as that model's answer arrives
+        placeholders = {}
+        for model, column in zip(compare_models, st.columns(len(compare_models))):
+            column.subheader(model)
+            placeholders[model] = column.empty()
+            placeholders[model].info("Running...")
+        
+        for future in as_completed(futures):
+            latency = time.perf_counter() - started_at
+            with placeholders[futures[future]].container():
+                if future.exception():
+                    st.error(f"Query failed: {future.exception()}")
+                elif future.result():
+                    result_json = json.loads(future.result())
+                    usage = result_json.get('usage', {})
+                    st.metric("Latency", f"{latency:.2f}s")
+                    st.metric("Tokens (prompt / completion)",
+                              f"{usage.get('prompt_tokens', 0):,} / {usage.get('completion_tokens', 0):,}")
+                    st.write(result_json['choices'][0]['messages'])
+                else:
+                    st.error("No result returned from the query.")
+        st.caption(f"Wall-clock time for all models: {time.perf_counter() - started_at:.2f}s")
+    elif filing_documents and mode == "Key figures":
+        with st.spinner("Extracting the key figures of new filings..."):
+            started_at = time.perf_counter()
+            extractions = extract_key_figures(filing_data)
+            key_figures_prompt = build_key_figures_prompt(question, filing_data, extractions)
+            answer = run_query_text(key_figures_prompt)
+            elapsed = time.perf_counter() - started_at
+        
+        if answer:
+            st.write("Jamba-Instruct Response:")
+            st.write(answer)
+            
+            # Report how many filings were read from the store instead of being sent to the model
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Filings read from the store", f"{sum(extraction.cached for extraction in extractions)} / {len(extractions)}")
+            col2.metric("Prompt tokens (est.)", f"{estimate_tokens(key_figures_prompt):,}")
+            col3.metric("Total time", f"{elapsed:.2f}s")
+            
+            with st.expander("View Key Figures"):
+                st.dataframe(key_figures_table(filing_data, extractions), use_container_width=True)
+        else:
+            st.error("No result returned from the query.")
+    elif filing_documents and mode == "Map-reduce":
+        with st.spinner("Querying the filing sections concurrently..."):
+            result = map_reduce(
+                filing_documents,
+                question,
+                query_text_runner(),
+                prompt_budget(option, 2000),
+            )
+        
+        if result.answer:
+            st.write("Jamba-Instruct Response:")
+            st.write(result.answer)
+            
+            # Report the cost of the map-reduce run
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Model calls", result.calls)
+            col2.metric("Prompt tokens (est.)", f"{result.prompt_tokens:,}")
+            col3.metric("Total time", f"{result.elapsed:.2f}s")
+        else:
+            st.error("No result returned from the query.")
+    elif filing_documents:
+        if mode == "Retrieval":
+            # Index new or changed filings, then keep only the passages closest to the question.
+            # The index holds every filing ever indexed, so only the selected filings are searched.
+            # The passages are grouped by filing and kept in their order within it.
+            index = get_retrieval_index()
+            index.add_documents([
+                (doc_id, title, text) for doc_id, (title, text) in zip(filing_data['SEC_DOCUMENT_ID'], filing_documents)
+            ])
+            filing_documents = [
+                (title, text)
+                for title, text, _ in index.search(question, k=top_k, doc_ids=set(filing_data['SEC_DOCUMENT_ID']),
+                                                   in_document_order=True)
+            ]
+        
+        # Trim the filings to what fits in the selected model's context window
+        packed = pack_documents(filing_documents, prompt_budget(option, 2000, question), question)
+        if packed.trimmed:
+            st.info(f"{option} has a {context_window(option):,}-token context window, so the filings for "
+                    f"{', '.join(packed.trimmed)} were trimmed to the passages most relevant to the question "
+                    f"(~{packed.tokens:,} tokens of context).")
+        
+        # Prepare the question with context, copying the filings into the prompt only once.
+        # The streaming endpoint takes one string (it has no bind parameters), which is also shown below.
+        question_context = ''.join(build_prompt_parts(question, packed.documents))
+        with st.expander("View Query and Context"):
+            st.write(question_context)
+        
+        # Stream the answer as it is generated instead of waiting for the full completion
+        st.write("Jamba-Instruct Response:")
+        stream = TimedStream(stream_query(question_context))
+        st.write_stream(stream)
+        get_call_recorder().record(CallRecord(option, stream.elapsed, time_to_first_token=stream.time_to_first_token))
+        
+        if stream.text:
+            # Report how long users waited for the first and last token
+            col1, col2 = st.columns(2)
+            col1.metric("Time to first token", f"{stream.time_to_first_token:.2f}s")
+            col2.metric("Total generation time", f"{stream.elapsed:.2f}s")
+            
+            # Display the full response in an expandable section
+            with st.expander("View Full Response"):
+                st.json(json.loads(stream.response_json(option)))
+        else:
+            st.error("No result returned from the query.")
+    else:
+        st.error("No result returned from the data query.")
+
     st.success('Done!')
     st.write("""
-    The 'View Full Response' expander shows the json response returned from Snowflake Cortex. You can see details such as number of tokens submitted and returned.
+    The 'View Full Response' expander shows the streamed response together with the time to first token and the total generation time.
     """)
 
+# Latency and token usage of the model calls made by the app
+with st.expander("Performance"):
+    render_performance_dashboard(session, get_call_recorder(), get_scheduler())
+
 st.markdown("---")
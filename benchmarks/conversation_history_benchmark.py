@@ -0,0 +1,122 @@
+"""Compare request sizes of a global chat history with those of a compacted ``ChatSession``.
+
+The conversational RAG notebook (``conversational_rag/convrag_fsi_example.ipynb``)
+used to append every turn to a global list and send the whole list on every
+call. This benchmark simulates a long chat, sending the history with each
+question, and reports the request size in tokens at several turns:
+
+- global: the notebook's original list, which grows with every turn;
+- evict: a ``ChatSession`` that drops its oldest turns past the threshold;
+- summarize: a ``ChatSession`` that folds them into a running summary.
+
+The summary is simulated (the last 150 words of the old turns), so the
+benchmark needs no API key. It then runs ``--sessions`` chats concurrently
+against one ``ConversationStore`` and checks that no session sees another
+session's turns.
+
+Usage::
+
+    python benchmarks/conversation_history_benchmark.py --turns 200 --max-history-tokens 2000
+"""
+import argparse
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from cortex_utils.context import estimate_tokens
+from cortex_utils.conversation import ConversationStore
+
+WORDS = ["amazon", "revenue", "net", "sales", "employees", "stock", "split", "operating", "income", "aws",
+         "segment", "growth", "2019", "2020", "2021", "2022", "2023", "billion", "million", "percent"]
+
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)) + "."
+
+
+def simulated_turns(count, seed=0):
+    """Return ``count`` questions and answers of the lengths seen in the notebook (answers ~100-250 words)."""
+    rng = random.Random(seed)
+    return [(sentence(rng, rng.randint(8, 30)), sentence(rng, rng.randint(100, 250))) for _ in range(count)]
+
+
+def simulated_summary(summary, turns, latency=0.0):
+    time.sleep(latency)
+    text = " ".join(f"{question} {answer}" for question, answer in turns)
+    return " ".join((summary + " " + text).split()[-150:])
+
+
+def request_sizes(turns, send):
+    """Return the request size in tokens of every turn, given ``send(question, answer)``."""
+    return [send(question, answer) for question, answer in turns]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--max-history-tokens", type=int, default=2000)
+    parser.add_argument("--sessions", type=int, default=50, help="Concurrent sessions in the store check.")
+    parser.add_argument("--summary-latency", type=float, default=0.01, help="Simulated seconds per summary call.")
+    args = parser.parse_args()
+
+    turns = simulated_turns(args.turns)
+
+    conversation_history = []
+
+    def send_global(question, answer):
+        conversation_history.append({"role": "user", "content": question})
+        tokens = sum(estimate_tokens(message["content"]) for message in conversation_history)
+        conversation_history.append({"role": "assistant", "content": answer})
+        return tokens
+
+    def session_sender(session):
+        def send(question, answer):
+            session.messages(question)
+            session.add_turn(question, answer)
+            return session.requests[-1].tokens
+        return send
+
+    evicting = ConversationStore(max_history_tokens=args.max_history_tokens).get("user")
+    summarizing = ConversationStore(
+        max_history_tokens=args.max_history_tokens,
+        summarize=lambda summary, old_turns: simulated_summary(summary, old_turns, args.summary_latency),
+    ).get("user")
+    sizes = {
+        "global": request_sizes(turns, send_global),
+        "evict": request_sizes(turns, session_sender(evicting)),
+        "summarize": request_sizes(turns, session_sender(summarizing)),
+    }
+
+    print(f"{'turn':>6} " + " ".join(f"{name:>10}" for name in sizes))
+    checkpoints = sorted({1, 5, 10, 25, 50, 100, 200, 500, 1000, args.turns} & set(range(1, args.turns + 1)))
+    for turn in checkpoints:
+        print(f"{turn:>6} " + " ".join(f"{values[turn - 1]:>10}" for values in sizes.values()))
+    print(f"evict: dropped {evicting.evicted_turns} turns; "
+          f"summarize: folded {summarizing.summarized_turns} turns into the summary")
+
+    store = ConversationStore(max_history_tokens=args.max_history_tokens,
+                              summarize=lambda summary, old_turns: simulated_summary(summary, old_turns))
+
+    def chat(index):
+        session = store.get(f"session-{index}")
+        for question, answer in simulated_turns(args.turns // 4, seed=index):
+            session.messages(question)
+            session.add_turn(f"[session-{index}] {question}", answer)
+        return session
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        sessions = list(executor.map(chat, range(args.sessions)))
+    for index, session in enumerate(sessions):
+        tags = {message["content"].split()[0] for message in session.history()
+                if message["role"] == "user" and message["content"].startswith("[")}
+        if tags != {f"[session-{index}]"}:
+            sys.exit(f"session-{index} holds turns of other sessions: {sorted(tags)}")
+    print(f"{args.sessions} concurrent sessions, largest request "
+          f"{max(size.tokens for session in sessions for size in session.requests)} tokens, no shared turns")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Compare the notebook's word-overlap scoring with ``cortex_utils.grounding`` on a scaled-up dataset.
+
+The reference is ``get_words`` and ``percentage_distinct_words`` from
+``grounded_product_description_creation/grounded_product_description_generation.ipynb``,
+copied verbatim, applied row by row. The dataset is
+``Product_Data_Evaluation.csv`` repeated ``--scale`` times. The reference is
+only run on ``--reference-scale`` copies, as it takes milliseconds per row;
+its time for the full dataset is extrapolated. The benchmark checks that
+``match_rates`` returns the same scores as the reference on those rows.
+
+Needs NLTK's English stopwords (``nltk.download('stopwords')``).
+
+Usage::
+
+    python benchmarks/grounding_benchmark.py --scale 100 --processes 4
+"""
+import argparse
+import csv
+import string
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from nltk.corpus import stopwords
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(REPO_ROOT))
+from cortex_utils.grounding import match_rates
+
+DATASET = REPO_ROOT / "grounded_product_description_creation" / "Product_Data_Evaluation.csv"
+
+
+def get_words(text:str, min_chars_in_word:int = 2)->list:
+    """get words from a string
+
+    Args:
+        text (str): the string to break into words
+        min_chars_in_word (int, optional): min word length in chars.. Defaults to 2.
+
+    Returns:
+        list: a list of words
+    """
+    final_stopwords_list = stopwords.words('english')
+    return [word.strip(string.punctuation) for word in text.lower().split() if ((len(word) >= min_chars_in_word) and (word not in final_stopwords_list))]
+
+
+def percentage_distinct_words(text1:str, text2:str, threshold = 0.2 ,numeric = False)->float:
+    """check percentage of distinct words match rate in two texts
+
+    Args:
+        text1 (str): 1st string
+        text2 (str): 2nd string
+        numeric (bool, optional): are we checking numbers or words?. Defaults to False.
+
+    Returns:
+        float: percantage of match rate (1-0),
+               how many distinct words that appear in text2 appear in text1
+    """
+    words1 = set(get_words(text1))
+    words2 = set(get_words(text2))
+
+    if(numeric):
+       words1 = {word for word in words1 if word.isnumeric()}
+       words2 = {word for word in words2 if word.isnumeric()}
+
+    if(len(words1) == 0):
+            return 0
+
+    res = len(words1.intersection(words2)) / len(words1)
+    # if(res >= threshold):
+        # print (f"Percentage of distinct words is above threshold {res}\n")
+    return res
+
+
+def load_columns(path):
+    """Return the description and attribute columns of the CSV at ``path``, skipping rows without a description."""
+    with open(path, encoding="utf-8", newline="") as f:
+        rows = [row for row in csv.DictReader(f) if row["description_column"]]
+    return [row["description_column"] for row in rows], [row["attributes_column"] for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dataset", default=str(DATASET))
+    parser.add_argument("--scale", type=int, default=100, help="Copies of the dataset to score.")
+    parser.add_argument("--reference-scale", type=int, default=1, help="Copies scored with the notebook's functions.")
+    parser.add_argument("--processes", type=int, default=4)
+    args = parser.parse_args()
+
+    descriptions, attributes = load_columns(args.dataset)
+    print(f"{len(descriptions) * args.scale} rows ({len(descriptions)} x {args.scale})")
+
+    for numeric in (False, True):
+        reference_rows = len(descriptions) * args.reference_scale
+        started_at = time.perf_counter()
+        expected = np.array([
+            percentage_distinct_words(description, attribute, numeric=numeric)
+            for description, attribute in zip(descriptions * args.reference_scale, attributes * args.reference_scale)
+        ], dtype=float)
+        reference_time = (time.perf_counter() - started_at) * args.scale / args.reference_scale
+
+        timings = []
+        for processes in (None, args.processes):
+            started_at = time.perf_counter()
+            scores = match_rates(descriptions * args.scale, attributes * args.scale, numeric=numeric,
+                                 processes=processes)
+            timings.append(time.perf_counter() - started_at)
+            if not np.array_equal(scores[:reference_rows], expected):
+                sys.exit(f"Scores differ (numeric={numeric}, processes={processes})")
+
+        print(f"numeric={numeric!s:<5}  notebook {reference_time:>8.2f}s (extrapolated)  "
+              f"serial {timings[0]:>6.2f}s  {args.processes} processes {timings[1]:>6.2f}s")
+
+
+if __name__ == "__main__":
+    main()
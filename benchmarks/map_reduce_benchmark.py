@@ -0,0 +1,89 @@
+"""Compare single-shot and map-reduce answers over the three NVIDIA 10-K filings.
+
+Runs the same question through one ``CORTEX.COMPLETE`` call over all filings
+and through ``cortex_utils.map_reduce``, then prints latency, number of calls
+and billed tokens of each path.
+
+Usage (connection parameters are read from ``~/.snowflake/connections.toml``)::
+
+    python benchmarks/map_reduce_benchmark.py --model jamba-1.5-large
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+
+from snowflake.snowpark import Session
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from cortex_utils.context import prompt_budget
+from cortex_utils.map_reduce import map_reduce
+from cortex_utils.sql import run_complete
+
+NVIDIA_10K_QUERY = """
+select A.VALUE, B.FISCAL_YEAR from "SEC_FILINGS"."CYBERSYN".SEC_REPORT_TEXT_ATTRIBUTES A
+left join "SEC_FILINGS"."CYBERSYN".SEC_REPORT_INDEX B
+on A.CIK = B.CIK
+where B.company_name = 'NVIDIA CORP'
+and B.form_type = '10-K'
+and A.variable_name = '10-K Filing Text'
+and ((A.PERIOD_END_DATE = '2024-01-28' and B.FISCAL_YEAR = 2023)
+    or (A.PERIOD_END_DATE = '2023-01-29' and B.FISCAL_YEAR = 2022)
+    or (A.PERIOD_END_DATE = '2022-01-30' and B.FISCAL_YEAR = 2021))
+order by FILED_DATE desc, PERIOD_END_DATE desc
+"""
+
+MAX_TOKENS = 2000
+
+
+class UsageCounter:
+    """Run completions while adding up the tokens reported in ``usage``."""
+
+    def __init__(self, session, model):
+        self.session = session
+        self.model = model
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._lock = threading.Lock()
+
+    def complete(self, prompt):
+        messages = [{'role': 'user', 'content': prompt}]
+        response = json.loads(run_complete(self.session, self.model, messages,
+                                           {'temperature': 0.3, 'max_tokens': MAX_TOKENS}))
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += response['usage']['prompt_tokens']
+            self.completion_tokens += response['usage']['completion_tokens']
+        return response['choices'][0]['messages']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default="jamba-1.5-large")
+    parser.add_argument("--question", default="How has NVIDIA Corp's revenue and profit changed over the years?")
+    parser.add_argument("--max-workers", type=int, default=8)
+    args = parser.parse_args()
+
+    session = Session.builder.getOrCreate()
+    filings = [(f"FY{row['FISCAL_YEAR']}", row['VALUE']) for row in session.sql(NVIDIA_10K_QUERY).collect()]
+
+    print(f"{'mode':<14}{'latency (s)':>12}{'calls':>8}{'prompt tokens':>16}{'completion tokens':>20}")
+
+    single = UsageCounter(session, args.model)
+    started_at = time.perf_counter()
+    single.complete(f"{args.question}\n\n\n\n{' '.join(text for _, text in filings)}")
+    print(f"{'single-shot':<14}{time.perf_counter() - started_at:>12.2f}{single.calls:>8}"
+          f"{single.prompt_tokens:>16,}{single.completion_tokens:>20,}")
+
+    chunked = UsageCounter(session, args.model)
+    result = map_reduce(filings, args.question, chunked.complete, prompt_budget(args.model, MAX_TOKENS),
+                        max_workers=args.max_workers)
+    print(f"{'map-reduce':<14}{result.elapsed:>12.2f}{chunked.calls:>8}"
+          f"{chunked.prompt_tokens:>16,}{chunked.completion_tokens:>20,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""Benchmark the Streamlit apps offline, against a fake Snowflake session.
+
+The app scripts are loaded without their UI: their imports, constants and
+functions are executed with ``session`` bound to a
+``cortex_utils.fakes.FakeSession``. The fake serves canned HMO2 plans and SEC
+filing rows (the text of ``financial_document_analysis/10k.txt``), and it
+answers ``CORTEX.COMPLETE`` after a latency proportional to the prompt and
+completion tokens. No network access or Snowflake account is needed.
+
+For each benchmarked path the script reports the median and maximum
+end-to-end latency, the median client CPU time (all threads) and the peak
+memory allocated by Python. ``--json`` writes the results, and
+``--baseline`` compares them with a previous ``--json`` file and exits with
+status 1 when a metric regressed by more than ``--tolerance``, so the suite
+can gate CI.
+
+Usage::
+
+    python benchmarks/offline_benchmark.py --runs 5 --json results.json
+    python benchmarks/offline_benchmark.py --baseline results.json --tolerance 0.2
+"""
+import argparse
+import ast
+import datetime
+import json
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(REPO_ROOT))
+from cortex_utils.context import pack_documents, prompt_budget
+from cortex_utils.fakes import FakeCortexBackend, FakeSession
+from cortex_utils.frames import frame_documents, preview_frame
+from cortex_utils.metrics import percentile
+from cortex_utils.multi_company import analyze_companies
+from cortex_utils.scheduler import CortexBackend, Scheduler
+from cortex_utils.sec_filings import FilingStore
+
+INSURANCE_APP = REPO_ROOT / "insurance_policy_compare.py"
+DECODER_APP = REPO_ROOT / "Snowflake_10K_Decoder" / "Snowflake_10K_Decoder.py"
+COMPANION_APP = REPO_ROOT / "streamlit_cortex_contract_companion" / "jamba_contract_companion.py"
+FILING_TEXT = REPO_ROOT / "financial_document_analysis" / "10k.txt"
+
+QUESTION = "Summarize the key themes in these 10K filings"
+COMPANY_NAMES = ("NVIDIA CORP", "ADVANCED MICRO DEVICES INC", "INTEL CORP")
+PLAN_QUESTION = "Which healthcare plan should I choose between these 2?"
+
+PLAN_SERVICES = [
+    "Primary care visit", "Specialist visit", "Emergency room", "Urgent care", "Inpatient hospital stay",
+    "Outpatient surgery", "Generic drugs", "Preferred brand drugs", "Non-preferred brand drugs",
+    "Routine eye exam", "Eyeglasses", "Mental health visit", "Physical therapy", "Maternity care",
+    "Lab tests", "X-rays", "MRI and CT scans", "Ambulance", "Durable medical equipment", "Hospice care",
+]
+
+
+def canned_plans(count=4, lines=200, seed=0):
+    """Return ``count`` synthetic HMO2 plans, each about ``lines`` benefit lines long."""
+    rng = random.Random(seed)
+    plans = {}
+    for index in range(count):
+        name = f"HMO Blue Option {index + 1}"
+        detail = [
+            f"{name} - Summary of Benefits and Coverage",
+            f"Deductible: ${rng.choice([0, 500, 1000, 2000])} individual / ${rng.choice([1000, 2000, 4000])} family",
+            f"Out-of-pocket maximum: ${rng.choice([3000, 5000, 7500])} individual",
+        ]
+        for line in range(lines):
+            service = PLAN_SERVICES[line % len(PLAN_SERVICES)]
+            detail.append(
+                f"{service} (network tier {line // len(PLAN_SERVICES) + 1}): copayment ${rng.choice([0, 20, 35, 50, 150])} "
+                f"per visit, coinsurance {rng.choice([0, 10, 20, 30])}% after the deductible. Prior authorization is "
+                f"{rng.choice(['required', 'not required'])}. Limitations and exceptions apply; see the evidence of "
+                f"coverage for details."
+            )
+        plans[name] = "\n".join(detail)
+    return plans
+
+
+def canned_filings(path=FILING_TEXT, fiscal_years=(2023, 2022, 2021), company_names=("NVIDIA CORP",)):
+    """Return SEC filing rows, one per company and fiscal year, all with the text of ``path``."""
+    text = path.read_text(encoding="utf-8")
+    return [
+        {
+            "SEC_DOCUMENT_ID": f"{1045810 + index:010d}-{fiscal_year}-10K",
+            "CIK": f"{1045810 + index:010d}",
+            "ADSH": f"{1045810 + index:010d}-{fiscal_year}",
+            "VARIABLE_NAME": "10-K Filing Text",
+            "COMPANY_NAME": company_name,
+            "FORM_TYPE": "10-K",
+            "FISCAL_YEAR": fiscal_year,
+            "FILED_DATE": datetime.date(fiscal_year + 1, 2, 21),
+            "PERIOD_END_DATE": datetime.date(fiscal_year + 1, 1, 28),
+            "VALUE": text,
+        }
+        for index, company_name in enumerate(company_names)
+        for fiscal_year in fiscal_years
+    ]
+
+
+def load_app(path, session, **overrides):
+    """Execute the imports, constants and functions of a Streamlit app script, without its UI.
+
+    Top-level statements that render widgets are skipped, as are assignments
+    that call anything or read a widget's value. ``session`` and
+    ``overrides`` replace the corresponding globals of the app.
+    """
+    tree = ast.parse(path.read_text(encoding="utf-8"), filename=str(path))
+    namespace = {"__file__": str(path), "__name__": f"offline_{path.stem}"}
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            if any(isinstance(child, ast.Call) for child in ast.walk(node.value)):
+                continue
+        elif not isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef)):
+            continue
+        try:
+            exec(compile(ast.Module([node], type_ignores=[]), str(path), "exec"), namespace)
+        except NameError:
+            # e.g. "question = question + ..." which depends on a text input
+            if not isinstance(node, ast.Assign):
+                raise
+    namespace.update(session=session, **overrides)
+    return namespace
+
+
+@dataclass
+class Measurement:
+    name: str
+    runs: int
+    latency_p50: float
+    latency_max: float
+    cpu_time_p50: float
+    peak_memory: int
+
+
+def measure(name, fn, runs, setup=None):
+    """Run ``fn`` ``runs`` times for latency and CPU time, then once more under tracemalloc."""
+    latencies = []
+    cpu_times = []
+    for _ in range(runs):
+        if setup:
+            setup()
+        started_at, cpu_started_at = time.perf_counter(), time.process_time()
+        fn()
+        latencies.append(time.perf_counter() - started_at)
+        cpu_times.append(time.process_time() - cpu_started_at)
+
+    # Peak memory is measured on a separate run, as tracing allocations slows the code down
+    if setup:
+        setup()
+    tracemalloc.start()
+    fn()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return Measurement(name, runs, percentile(latencies, 0.5), max(latencies), percentile(cpu_times, 0.5), peak_memory)
+
+
+def benchmarks(session, store_directory):
+    """Return ``(name, fn, setup)`` for every benchmarked path of the apps."""
+    insurance = load_app(INSURANCE_APP, session, get_backend=lambda identity: session.backend)
+    plan_names = sorted(session.plans)[:2]
+
+    decoder = load_app(DECODER_APP, session, option="jamba-1.5-large")
+    filing_store = FilingStore(store_directory)
+    decoder["get_filing_store"] = lambda: filing_store
+
+    companion = load_app(COMPANION_APP, session, option="jamba-instruct")
+
+    def decoder_run_query():
+        documents = frame_documents(decoder["run_data_query"]())
+        packed = pack_documents(documents, prompt_budget(decoder["option"], 2000, QUESTION), QUESTION)
+        decoder["run_query"](decoder["build_prompt_parts"](QUESTION, packed.documents))
+
+    def companion_run_query():
+        documents = frame_documents(companion["run_data_query"]())
+        packed = pack_documents(documents, prompt_budget(companion["option"], 3000, QUESTION), QUESTION)
+        companion["run_query"](' '.join([f"{QUESTION}\n\n\n\n"] + [text for _, text in packed.documents]))
+
+    def insurance_stream_query():
+        messages = [{'role': 'user', 'content': insurance["build_plan_prompt"](PLAN_QUESTION, plan_names)}]
+        return "".join(insurance["stream_jamba_query"](messages))
+
+    def decoder_analyze_companies(company_names):
+        return analyze_companies(
+            company_names,
+            QUESTION,
+            decoder["company_analyzer"](QUESTION, company_names),
+            decoder["run_query_text"],
+        )
+
+    return [
+        ("insurance: stream_jamba_query", insurance_stream_query, None),
+        ("insurance: run_jamba_server_side",
+         lambda: insurance["run_jamba_server_side"](PLAN_QUESTION, plan_names),
+         None),
+        ("10-K decoder: run_query", decoder_run_query, None),
+        ("10-K decoder: 1 company", lambda: decoder_analyze_companies(COMPANY_NAMES[:1]), None),
+        (f"10-K decoder: {len(COMPANY_NAMES)} companies", lambda: decoder_analyze_companies(COMPANY_NAMES), None),
+        ("10-K decoder: filing DataFrame",
+         lambda: preview_frame(decoder["run_data_query"]()),
+         lambda: decoder["get_data_cache"]().invalidate()),
+        ("contract companion: run_query", companion_run_query, None),
+        ("contract companion: filing DataFrame",
+         lambda: preview_frame(companion["run_data_query"]()),
+         lambda: companion["load_filing_frame"].clear()),
+    ]
+
+
+def check_deduplication(session, model="jamba-1.5-large"):
+    """Exit unless two identical prompts submitted concurrently make a single model call.
+
+    Each prompt goes through its own ``CortexBackend``, as when two reruns or
+    two users of an app ask the same question at the same time.
+    """
+    scheduler = Scheduler()
+    messages = [{"role": "user", "content": QUESTION}]
+    calls_before = session.backend.calls
+    futures = [scheduler.submit_complete(CortexBackend(session), model, messages, {}) for _ in range(2)]
+    responses = [future.result() for future in futures]
+    scheduler.shutdown()
+    calls = session.backend.calls - calls_before
+    if calls != 1 or responses[0] != responses[1]:
+        sys.exit(f"Deduplication check failed: {calls} model calls for 2 identical concurrent prompts")
+
+
+def compare(results, baseline, tolerance):
+    """Return a description of every metric that regressed by more than ``tolerance``."""
+    previous = {row["name"]: row for row in baseline}
+    regressions = []
+    for result in results:
+        if result.name not in previous:
+            continue
+        for metric in ("latency_p50", "cpu_time_p50", "peak_memory"):
+            before, after = previous[result.name][metric], getattr(result, metric)
+            if before and after > before * (1 + tolerance):
+                regressions.append(f"{result.name}: {metric} {before:.4g} -> {after:.4g}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--seconds-per-prompt-token", type=float, default=2e-6,
+                        help="Simulated COMPLETE latency per prompt token.")
+    parser.add_argument("--seconds-per-completion-token", type=float, default=1e-3,
+                        help="Simulated COMPLETE latency per generated token.")
+    parser.add_argument("--json", help="Write the results to this file.")
+    parser.add_argument("--baseline", help="Compare the results with this file written by --json.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative increase of each metric over the baseline.")
+    args = parser.parse_args()
+
+    backend = FakeCortexBackend(
+        seconds_per_prompt_token=args.seconds_per_prompt_token,
+        seconds_per_completion_token=args.seconds_per_completion_token,
+        seed=0,
+    )
+    session = FakeSession(canned_plans(), canned_filings(company_names=COMPANY_NAMES), backend)
+    check_deduplication(session)
+
+    results = []
+    with tempfile.TemporaryDirectory() as store_directory:
+        for name, fn, setup in benchmarks(session, store_directory):
+            results.append(measure(name, fn, args.runs, setup))
+
+    print(f"{'path':<42} {'p50 latency':>12} {'max latency':>12} {'p50 CPU':>10} {'peak memory':>14}")
+    for result in results:
+        print(f"{result.name:<42} {result.latency_p50:>11.3f}s {result.latency_max:>11.3f}s "
+              f"{result.cpu_time_p50:>9.3f}s {result.peak_memory / 2**20:>11.1f} MiB")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump([asdict(result) for result in results], f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
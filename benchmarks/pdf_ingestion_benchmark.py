@@ -0,0 +1,84 @@
+"""Compare serial and parallel, cached ingestion of a folder of PDFs.
+
+Three variants are timed on the same folder:
+
+- serial: every PDF parsed with pypdf, then uploaded, one after the other,
+  as the document-QA notebooks do;
+- cold: ``extract_texts`` and ``upload_files`` with empty caches, so every
+  file is parsed in the process pool and uploaded concurrently;
+- warm: the same again, where every file is unchanged and skipped.
+
+Uploads are simulated with a fixed latency (``--upload-latency``), so the
+benchmark needs no API key. By default the folder is the sample PDFs of
+``legal_document_analysis`` and ``conversational_rag``, copied ``--copies``
+times with a distinct trailer each, so that every copy has its own hash.
+
+Usage::
+
+    python benchmarks/pdf_ingestion_benchmark.py --copies 10 --upload-latency 1.0
+"""
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(REPO_ROOT))
+from cortex_utils.pdf_ingestion import (
+    TextCache, UploadManifest, extract_texts, list_documents, parse_document, upload_files,
+)
+
+SAMPLE_FOLDERS = [REPO_ROOT / "legal_document_analysis" / "data" / "pdfs", REPO_ROOT / "conversational_rag" / "data"]
+
+
+def build_folder(directory, copies):
+    """Copy the sample PDFs ``copies`` times into ``directory``, each copy with a distinct hash."""
+    for folder in SAMPLE_FOLDERS:
+        for path in list_documents(str(folder), (".pdf",)):
+            for copy in range(copies):
+                target = Path(directory) / f"{Path(path).stem}_{copy}.pdf"
+                shutil.copyfile(path, target)
+                # Bytes after %%EOF are ignored by PDF readers
+                with open(target, "ab") as f:
+                    f.write(f"\n% {uuid.uuid4()}\n".encode("ascii"))
+    return list_documents(directory, (".pdf",))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--folder", help="Folder of PDFs to ingest instead of copies of the samples.")
+    parser.add_argument("--copies", type=int, default=5, help="Copies of each sample PDF.")
+    parser.add_argument("--upload-latency", type=float, default=1.0, help="Simulated seconds per upload.")
+    parser.add_argument("--max-uploads", type=int, default=8, help="Concurrent uploads.")
+    args = parser.parse_args()
+
+    def upload(path):
+        time.sleep(args.upload_latency)
+        return str(uuid.uuid4())
+
+    with tempfile.TemporaryDirectory() as work_directory:
+        paths = list_documents(args.folder, (".pdf",)) if args.folder else build_folder(work_directory, args.copies)
+        print(f"{len(paths)} PDFs")
+
+        started_at = time.perf_counter()
+        for path in paths:
+            parse_document(path)
+            upload(path)
+        print(f"{'serial':<8} {time.perf_counter() - started_at:>8.2f}s")
+
+        cache = TextCache(str(Path(work_directory) / "texts"))
+        manifest = UploadManifest(str(Path(work_directory) / "manifest.json"))
+        for variant in ("cold", "warm"):
+            started_at = time.perf_counter()
+            extracted = extract_texts(paths, cache)
+            uploaded = upload_files(paths, upload, manifest, max_workers=args.max_uploads)
+            print(f"{variant:<8} {time.perf_counter() - started_at:>8.2f}s  "
+                  f"(parsed {len(extracted.parsed)}, uploaded {len(uploaded.uploaded)}, "
+                  f"skipped {len(uploaded.skipped)}, failed {len(uploaded.failed)})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Compare full-context and retrieval answers over the three NVIDIA 10-K filings.
+
+Each question is answered once with all three filings in the prompt and once
+with only the top-k passages from ``cortex_utils.retrieval``. The benchmark
+prints the latency and the prompt tokens billed for each path, plus the
+one-off indexing time.
+
+Usage (connection parameters are read from ``~/.snowflake/connections.toml``)::
+
+    python benchmarks/retrieval_benchmark.py --model jamba-1.5-large --top-k 12
+"""
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from snowflake.snowpark import Session
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from cortex_utils.retrieval import RetrievalIndex
+from map_reduce_benchmark import NVIDIA_10K_QUERY, UsageCounter
+
+QUESTIONS = [
+    "How has NVIDIA Corp's revenue and profit changed over the years?",
+    "What major acquisitions or partnerships has the company engaged in?",
+    "How has the company's discussion of sustainability initiatives changed across the filings?",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default="jamba-1.5-large")
+    parser.add_argument("--top-k", type=int, default=12)
+    parser.add_argument("--index-dir", default=str(Path(tempfile.gettempdir()) / "10k_benchmark_index"))
+    args = parser.parse_args()
+
+    session = Session.builder.getOrCreate()
+    rows = session.sql(NVIDIA_10K_QUERY).collect()
+    filings = [row['VALUE'] for row in rows]
+
+    started_at = time.perf_counter()
+    index = RetrievalIndex(args.index_dir)
+    indexed = index.add_documents([(f"FY{row['FISCAL_YEAR']}", f"FY{row['FISCAL_YEAR']}", row['VALUE']) for row in rows])
+    print(f"indexed {indexed} filings with {index.embedder.name} in {time.perf_counter() - started_at:.2f}s\n")
+
+    print(f"{'mode':<12}{'latency (s)':>12}{'prompt tokens':>16}  question")
+    for question in QUESTIONS:
+        full = UsageCounter(session, args.model)
+        started_at = time.perf_counter()
+        full.complete(f"{question}\n\n\n\n{' '.join(filings)}")
+        print(f"{'full':<12}{time.perf_counter() - started_at:>12.2f}{full.prompt_tokens:>16,}  {question}")
+
+        retrieved = UsageCounter(session, args.model)
+        started_at = time.perf_counter()
+        passages = index.search(question, k=args.top_k)
+        retrieved.complete(f"{question}\n\n\n\n{' '.join(text for _, text, _ in passages)}")
+        print(f"{'retrieval':<12}{time.perf_counter() - started_at:>12.2f}{retrieved.prompt_tokens:>16,}  {question}")
+
+
+if __name__ == "__main__":
+    main()
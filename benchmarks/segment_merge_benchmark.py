@@ -0,0 +1,93 @@
+"""Compare the notebook's segment merging with ``cortex_utils.segments`` on thousands of segments.
+
+The reference is ``get_user_defined_segments`` from
+``summarize_text_custom_segments/Summarize_Provided_Link.ipynb``, copied
+verbatim. Segments are synthetic, with random lengths and summaries (some
+empty, as in summarize-by-segment output). For every size the benchmark
+checks that both functions return identical DataFrames, then reports their
+run times.
+
+Usage::
+
+    python benchmarks/segment_merge_benchmark.py --sizes 1000 2000 5000 --desired 5
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from cortex_utils.segments import merge_shortest_segments
+
+
+def get_user_defined_segments(df, desired_segments):
+    """
+    Get a user-provided number of segments after using the AI21 Get Segments API.
+    """
+    while len(df) > desired_segments:
+        # Find the index of the shortest segment
+        shortest_idx = df['SegmentText'].str.len().idxmin()
+
+        # Determine the neighbors' indices
+        left_idx = max(0, shortest_idx - 1)
+        right_idx = min(len(df) - 1, shortest_idx + 1)
+
+        # Find the length of the neighbors
+        left_len = df.iloc[left_idx]['SegmentText'].__len__()
+        right_len = df.iloc[right_idx]['SegmentText'].__len__()
+
+        # Merge with the shorter neighbor
+        if shortest_idx == 0 or (shortest_idx < len(df) - 1 and right_len < left_len):
+            # Merge with the right neighbor (shortest segment comes first)
+            df.at[shortest_idx, 'Summary'] += " " + df.at[right_idx, 'Summary']
+            df.at[shortest_idx, 'SegmentText'] += " " + df.at[right_idx, 'SegmentText']
+            df = df.drop(right_idx).reset_index(drop=True)
+        else:
+            # Merge with the left neighbor (left segment comes first)
+            df.at[left_idx, 'Summary'] += " " + df.at[shortest_idx, 'Summary']
+            df.at[left_idx, 'SegmentText'] += " " + df.at[shortest_idx, 'SegmentText']
+            df = df.drop(shortest_idx).reset_index(drop=True)
+
+    return df
+
+
+def synthetic_segments(count, seed=0):
+    rng = random.Random(seed)
+    words = ["google", "announced", "search", "model", "pixel", "android", "ai", "developers", "event", "new"]
+    rows = []
+    for index in range(count):
+        text = " ".join(rng.choice(words) for _ in range(rng.randint(5, 120)))
+        summary = "" if rng.random() < 0.2 else f"Summary {index}: " + " ".join(rng.choice(words) for _ in range(8))
+        rows.append({"Summary": summary, "SegmentText": text})
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 2000, 5000])
+    parser.add_argument("--desired", type=int, default=5, help="Number of segments to merge down to.")
+    args = parser.parse_args()
+
+    print(f"{'segments':>9} {'notebook':>10} {'heap':>10} {'speed-up':>9}")
+    for size in args.sizes:
+        segments = synthetic_segments(size)
+
+        started_at = time.perf_counter()
+        # The notebook's function modifies the DataFrame it is given
+        expected = get_user_defined_segments(segments.copy(), args.desired)
+        notebook_time = time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        merged = merge_shortest_segments(segments, args.desired)
+        heap_time = time.perf_counter() - started_at
+
+        if not merged.equals(expected):
+            sys.exit(f"Results differ for {size} segments")
+        print(f"{size:>9} {notebook_time:>9.3f}s {heap_time:>9.3f}s {notebook_time / heap_time:>8.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Compare inlined and bound prompts for CORTEX.COMPLETE on the NVIDIA 10-K filings.
+
+For each variant the benchmark reports the size of the SQL text, the SQL
+compilation and execution time recorded by Snowflake, and the peak client
+memory allocated while building and submitting the statement. Completions
+are limited to a single token so the measurement is dominated by prompt
+submission rather than generation.
+
+Usage (connection parameters are read from ``~/.snowflake/connections.toml``)::
+
+    python benchmarks/sql_binding_benchmark.py --runs 3
+"""
+import argparse
+import json
+import sys
+import tracemalloc
+from pathlib import Path
+
+from snowflake.snowpark import Session
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from cortex_utils.sql import complete_sql
+from map_reduce_benchmark import NVIDIA_10K_QUERY
+
+OPTIONS = {'temperature': 0.3, 'max_tokens': 1}
+
+QUESTION = "Summarize the key themes in these 10K filings"
+
+
+# The statement as the apps used to build it: the whole context inlined in the SQL text
+def inline_statement(model, filings):
+    all_values = ' '.join(filings)
+    question_context = f"{QUESTION}\n\n\n\n{all_values}".replace('"', '').replace("'", '')
+    sql = f"""
+    SELECT SNOWFLAKE.CORTEX.COMPLETE(
+        '{model}',
+        ARRAY_CONSTRUCT(
+            OBJECT_CONSTRUCT('role', 'user', 'content', '{question_context}')
+        ),
+        PARSE_JSON('{json.dumps(OPTIONS)}')
+    );
+    """
+    return sql, None
+
+
+# The statement with the question and every filing bound as separate parameters
+def bound_statement(model, filings):
+    parts = [QUESTION, "\n\n\n\n"]
+    for index, text in enumerate(filings):
+        if index:
+            parts.append(' ')
+        parts.append(text)
+    return complete_sql(model, [{'role': 'user', 'content': parts}], OPTIONS)
+
+
+def measure(session, build_statement, model, filings):
+    tracemalloc.start()
+    sql, params = build_statement(model, filings)
+    job = session.sql(sql, params=params).collect_nowait()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    job.result()
+
+    history = session.sql(
+        """
+        SELECT COMPILATION_TIME, EXECUTION_TIME
+        FROM TABLE(INFORMATION_SCHEMA.QUERY_HISTORY_BY_SESSION())
+        WHERE QUERY_ID = ?
+        """,
+        params=[job.query_id],
+    ).collect()
+    return len(sql), history[0]['COMPILATION_TIME'], history[0]['EXECUTION_TIME'], peak_memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default="jamba-1.5-large")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    session = Session.builder.getOrCreate()
+    filings = [row['VALUE'] for row in session.sql(NVIDIA_10K_QUERY).collect()]
+
+    print(f"{'variant':<10}{'run':>5}{'SQL bytes':>12}{'compile (ms)':>14}{'execute (ms)':>14}{'client peak (MB)':>18}")
+    for name, build_statement in (("inline", inline_statement), ("bound", bound_statement)):
+        for run in range(1, args.runs + 1):
+            sql_bytes, compile_ms, execute_ms, peak_memory = measure(session, build_statement, args.model, filings)
+            print(f"{name:<10}{run:>5}{sql_bytes:>12,}{compile_ms:>14,}{execute_ms:>14,}{peak_memory / 2**20:>18.1f}")
+
+
+if __name__ == "__main__":
+    main()
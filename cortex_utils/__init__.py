@@ -0,0 +1,12 @@
+"""Shared helpers for the Snowflake Cortex Streamlit samples.
+
+The Streamlit apps in this repository (``insurance_policy_compare.py``,
+``Snowflake_10K_Decoder`` and ``streamlit_cortex_contract_companion``) import
+these modules to avoid repeating the same plumbing in every sample. When
+deploying an app to Streamlit in Snowflake, upload the ``cortex_utils`` folder
+alongside the app file.
+
+Some notebooks use the modules that do not depend on Snowflake
+(``conversation``, ``extraction``, ``grounding``, ``pdf_ingestion``,
+``segments``) by adding the repository root to ``sys.path``.
+"""
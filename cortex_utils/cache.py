@@ -0,0 +1,201 @@
+"""Content-addressed response cache for SNOWFLAKE.CORTEX.COMPLETE calls.
+
+A cache key is derived from everything that influences the completion: the
+model, the sorted document names, a SHA-256 hash of each document's text, the
+question and the generation options. Because the document hashes are part of
+the key, editing a plan's DETAIL automatically produces a new key, so stale
+answers are never served. Entries can additionally expire after a TTL.
+
+Three interchangeable backends are provided:
+
+- ``MemoryBackend``: in-process LRU, shared across Streamlit reruns when held
+  in ``st.cache_resource``.
+- ``DiskBackend``: one JSON file per entry in a local directory.
+- ``SnowflakeTableBackend``: a result table in Snowflake, shared by every
+  user of the app.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def text_hash(text):
+    """Return the SHA-256 hex digest of ``text``.
+
+    Matches ``SHA2(text, 256)`` in Snowflake, so hashes can be computed
+    server-side without downloading the text.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def make_cache_key(model, document_hashes, question, options):
+    """Build a cache key for a completion request.
+
+    ``document_hashes`` maps each document name (e.g. a plan name) to the
+    hash of its text. Names are sorted so the order in which plans were
+    selected does not matter.
+    """
+    payload = {
+        "model": model,
+        "documents": sorted([name, digest] for name, digest in document_hashes.items()),
+        "question": question,
+        "options": options,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    """Thread-safe in-process LRU store."""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, value, created_at):
+        with self._lock:
+            self._entries[key] = (value, created_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskBackend:
+    """Store each entry as a JSON file named after its key."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return entry["value"], entry["created_at"]
+
+    def set(self, key, value, created_at):
+        # Write to a temporary file first so readers never see a partial entry
+        tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"value": value, "created_at": created_at}, f)
+        os.replace(tmp_path, self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                os.remove(os.path.join(self.directory, name))
+
+
+class SnowflakeTableBackend:
+    """Store entries in a Snowflake table so every app user shares them."""
+
+    def __init__(self, session, table="CORTEX_RESPONSE_CACHE"):
+        self.session = session
+        self.table = table
+        self.session.sql(f"""
+            CREATE TABLE IF NOT EXISTS {self.table} (
+                CACHE_KEY STRING PRIMARY KEY,
+                RESPONSE STRING,
+                CREATED_AT FLOAT
+            )
+        """).collect()
+
+    def get(self, key):
+        result = self.session.sql(
+            f"SELECT RESPONSE, CREATED_AT FROM {self.table} WHERE CACHE_KEY = ?",
+            params=[key],
+        ).collect()
+        if not result:
+            return None
+        return result[0]["RESPONSE"], result[0]["CREATED_AT"]
+
+    def set(self, key, value, created_at):
+        self.session.sql(
+            f"""
+            MERGE INTO {self.table} t
+            USING (SELECT ? AS CACHE_KEY, ? AS RESPONSE, ? AS CREATED_AT) s
+            ON t.CACHE_KEY = s.CACHE_KEY
+            WHEN MATCHED THEN UPDATE SET RESPONSE = s.RESPONSE, CREATED_AT = s.CREATED_AT
+            WHEN NOT MATCHED THEN INSERT (CACHE_KEY, RESPONSE, CREATED_AT)
+                VALUES (s.CACHE_KEY, s.RESPONSE, s.CREATED_AT)
+            """,
+            params=[key, value, created_at],
+        ).collect()
+
+    def delete(self, key):
+        self.session.sql(f"DELETE FROM {self.table} WHERE CACHE_KEY = ?", params=[key]).collect()
+
+    def clear(self):
+        self.session.sql(f"TRUNCATE TABLE {self.table}").collect()
+
+
+class ResponseCache:
+    """Cache of completion responses on top of a pluggable backend.
+
+    ``ttl`` is the maximum age of an entry in seconds; ``None`` keeps entries
+    until the backend evicts them.
+    """
+
+    def __init__(self, backend, ttl=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.backend.get(key)
+        if entry is not None:
+            value, created_at = entry
+            if self.ttl is None or time.time() - created_at <= self.ttl:
+                self.hits += 1
+                return value
+            self.backend.delete(key)
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self.backend.set(key, value, time.time())
+
+    def get_or_compute(self, key, compute):
+        """Return the cached value for ``key``, calling ``compute()`` on a miss.
+
+        Empty responses are not cached so a failed call is retried next time.
+        """
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            if value:
+                self.set(key, value)
+        return value
+
+    def clear(self):
+        self.backend.clear()
@@ -0,0 +1,166 @@
+"""Fit long documents into a model's context window before calling it.
+
+The Cortex models offered by the apps range from 4k to 256k tokens of context.
+Sending three 10-K filings to a 4k model fails (or is silently truncated) only
+after the whole prompt has been uploaded and billed. ``pack_documents`` trims
+the documents up front so the prompt always fits the selected model:
+
+- documents share the token budget fairly; small documents are kept whole and
+  their unused share goes to the larger ones;
+- a document that exceeds its share is split into passages, and the passages
+  most relevant to the question are kept in their original order.
+
+Token counts use a fast local approximation by default. ``cortex_token_counter``
+uses the model's own tokenizer through ``SNOWFLAKE.CORTEX.COUNT_TOKENS`` when an
+exact count is worth a round trip.
+"""
+import math
+import re
+from dataclasses import dataclass, field
+
+# Context window (in tokens) of the Cortex models offered in the apps
+MODEL_CONTEXT_WINDOWS = {
+    "jamba-instruct": 256000,
+    "jamba-1.5-mini": 256000,
+    "jamba-1.5-large": 256000,
+    "snowflake-arctic": 4096,
+    "mistral-large": 32000,
+    "reka-flash": 100000,
+    "mixtral-8x7b": 32000,
+    "llama2-70b-chat": 4096,
+    "llama3-8b": 8000,
+    "llama3-70b": 8000,
+    "llama3.1-8b": 128000,
+    "llama3.1-70b": 128000,
+    "llama3.1-405b": 128000,
+    "mistral-7b": 32000,
+    "gemma-7b": 8000,
+}
+
+# Window assumed for models missing from MODEL_CONTEXT_WINDOWS
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# Tokens kept free for the chat template and system prompt
+PROMPT_OVERHEAD_TOKENS = 100
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def estimate_tokens(text):
+    """Approximate the number of tokens in ``text`` without a tokenizer.
+
+    English text averages about four characters per token; dense numeric text
+    such as financial tables has more, shorter tokens, so the word count is
+    used as a floor.
+    """
+    return max(math.ceil(len(text) / 4), math.ceil(len(_WORD_RE.findall(text)) * 4 / 3))
+
+
+def cortex_token_counter(session, model):
+    """Return a token counter that uses ``model``'s tokenizer in Snowflake."""
+    def count_tokens(text):
+        result = session.sql(
+            "SELECT SNOWFLAKE.CORTEX.COUNT_TOKENS(?, ?) AS TOKENS", params=[model, text]
+        ).collect()
+        return result[0]["TOKENS"]
+    return count_tokens
+
+
+def context_window(model):
+    return MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+
+
+def prompt_budget(model, max_tokens, question="", count_tokens=estimate_tokens):
+    """Return the number of tokens left for documents in ``model``'s window.
+
+    ``max_tokens`` is reserved for the completion, and the question plus a
+    small template overhead are subtracted as well.
+    """
+    budget = context_window(model) - max_tokens - count_tokens(question) - PROMPT_OVERHEAD_TOKENS
+    return max(budget, 0)
+
+
+@dataclass
+class PackedContext:
+    documents: list
+    tokens: int
+    trimmed: list = field(default_factory=list)
+
+
+def split_passages(text, max_chars=2000):
+    """Split ``text`` into passages of at most ``max_chars`` along line breaks."""
+    passages = []
+    current = ""
+    for line in text.splitlines(keepends=True):
+        # Hard-split lines that are longer than a passage on their own
+        while len(line) > max_chars:
+            if current:
+                passages.append(current)
+                current = ""
+            passages.append(line[:max_chars])
+            line = line[max_chars:]
+        if len(current) + len(line) > max_chars:
+            passages.append(current)
+            current = ""
+        current += line
+    if current:
+        passages.append(current)
+    return passages
+
+
+def _question_terms(question):
+    return {word for word in _WORD_RE.findall(question.lower()) if len(word) > 3}
+
+
+def trim_to_budget(text, budget, question="", count_tokens=estimate_tokens):
+    """Keep the passages of ``text`` most relevant to ``question`` within ``budget`` tokens."""
+    passages = split_passages(text)
+    terms = _question_terms(question)
+
+    def score(item):
+        index, passage = item
+        words = _WORD_RE.findall(passage.lower())
+        hits = sum(1 for word in words if word in terms)
+        # Prefer earlier passages on ties: the start of a filing gives the overview
+        return (hits / (len(words) + 1), -index)
+
+    kept = []
+    used = 0
+    for index, passage in sorted(enumerate(passages), key=score, reverse=True):
+        tokens = count_tokens(passage)
+        if used + tokens <= budget:
+            kept.append(index)
+            used += tokens
+    return "".join(passages[index] for index in sorted(kept)), used
+
+
+def pack_documents(documents, budget, question="", count_tokens=estimate_tokens):
+    """Fit ``documents`` (a list of ``(name, text)``) into ``budget`` tokens.
+
+    Returns a ``PackedContext`` with the documents in their original order,
+    the total token count and the names of the documents that were trimmed.
+    """
+    token_counts = [count_tokens(text) for _, text in documents]
+    if sum(token_counts) <= budget:
+        return PackedContext(list(documents), sum(token_counts))
+
+    # Give each document an equal share, smallest first, so that the budget
+    # small documents do not need is redistributed to the larger ones
+    allocations = [0] * len(documents)
+    remaining = budget
+    order = sorted(range(len(documents)), key=lambda i: token_counts[i])
+    for position, i in enumerate(order):
+        share = remaining // (len(documents) - position)
+        allocations[i] = min(token_counts[i], share)
+        remaining -= allocations[i]
+
+    packed = []
+    trimmed = []
+    total = 0
+    for (name, text), tokens, allocation in zip(documents, token_counts, allocations):
+        if tokens > allocation:
+            text, tokens = trim_to_budget(text, allocation, question, count_tokens)
+            trimmed.append(name)
+        packed.append((name, text))
+        total += tokens
+    return PackedContext(packed, total, trimmed)
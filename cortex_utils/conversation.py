@@ -0,0 +1,320 @@
+"""Multi-turn conversations over a fixed set of documents.
+
+The apps used to send ``'{question} {documents}'``: the question came first,
+so every follow-up question changed the start of the prompt, and nothing the
+model had already processed could be reused. A ``Conversation`` lays the
+prompt out as a stable prefix instead:
+
+1. a system message holding the instructions and the documents, identical for
+   every turn;
+2. the earlier turns, which only ever grow at the end;
+3. the new question, last.
+
+Providers that cache prompt prefixes (the automatic prefix caching of the
+OpenAI and Anthropic models, or a KV cache in a self-hosted server) reprocess
+only the new tail on a follow-up question. The earlier turns are held in a
+``ChatSession`` (below) sized with ``history_budget``, so the oldest turns are
+dropped, or summarized, before the prompt outgrows the context window. The Jamba models in Cortex do not
+expose such a cache, so ``PrefixCache`` is a local stand-in. It tracks which
+message prefixes were already sent and reports how many prompt tokens a
+prefix cache would reuse and how many it would reprocess.
+
+Chat endpoints that are sent the whole history on every call, such as AI21's
+conversational RAG in ``conversational_rag``, grow slower and more expensive
+with every turn. A ``ConversationStore`` keeps one ``ChatSession`` per user
+instead of a global list. Once a session's history passes a token threshold,
+its oldest turns are folded into a running summary, or dropped, so the
+request size stays flat however long the chat runs.
+"""
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+
+from cortex_utils.context import estimate_tokens
+
+SUMMARY_PROMPT = """Below are the summary of a conversation so far and the turns that followed it.
+Write an updated summary of the whole conversation in at most {max_words} words. Keep the facts, figures, \
+names and dates that were asked about or given. Reply with the summary only.
+
+Summary so far:
+{summary}
+
+Next turns:
+{turns}"""
+
+# The summary is sent as an opening exchange, so user and assistant messages keep alternating
+SUMMARY_MESSAGE = "Summary of our conversation so far:\n{summary}"
+SUMMARY_ACKNOWLEDGEMENT = "Understood, I will take our earlier conversation into account."
+
+
+# Share of a conversation's prompt budget kept for the earlier turns and the new question
+HISTORY_SHARE = 0.25
+
+
+def history_budget(budget, share=HISTORY_SHARE):
+    """Return the tokens of ``budget`` kept for the turns of a conversation; the documents get the rest."""
+    return int(budget * share)
+
+
+def document_prefix(documents, instructions="", tag="document"):
+    """Return the system message content for ``documents`` (a list of ``(name, text)``).
+
+    The content depends only on the documents and the instructions, never on
+    the question, so it is byte-for-byte identical on every turn.
+    """
+    parts = [instructions] if instructions else []
+    for name, text in documents:
+        parts.append(f'<{tag} name="{name}">{text}</{tag}>')
+    return "\n\n".join(parts)
+
+
+@dataclass
+class Conversation:
+    """A document prefix and the turns asked about it, kept in ``st.session_state``.
+
+    ``turns`` holds every turn, for display. The turns sent to the model are
+    those ``history`` (a ``ChatSession``) still holds.
+    """
+
+    key: object
+    prefix: str
+    history: object
+    turns: list = field(default_factory=list)
+
+    def messages(self, question):
+        """Return the messages for ``question``: prefix, earlier turns, then the question."""
+        return [{"role": "system", "content": self.prefix}] + self.history.messages(question)
+
+    def add_turn(self, question, answer):
+        self.turns.append((question, answer))
+        self.history.add_turn(question, answer)
+
+
+def get_conversation(state, key, build_prefix, state_key="conversation", **session_options):
+    """Return the conversation about ``key`` stored in ``state``.
+
+    A new conversation is started, and ``build_prefix()`` called, only when
+    ``key`` (e.g. the selected plans) differs from the stored conversation's.
+    Its history is a ``ChatSession`` with the settings ``session_options``,
+    e.g. ``max_history_tokens``.
+    """
+    conversation = state.get(state_key)
+    if conversation is None or conversation.key != key:
+        conversation = Conversation(key, build_prefix(), ChatSession(**session_options))
+        state[state_key] = conversation
+    return conversation
+
+
+@dataclass
+class PrefixUsage:
+    reused_tokens: int
+    processed_tokens: int
+
+    @property
+    def prompt_tokens(self):
+        return self.reused_tokens + self.processed_tokens
+
+
+class PrefixCache:
+    """Local stand-in for a provider's prompt prefix cache.
+
+    A prompt is cached per message: the key of message ``i`` is a hash of
+    messages ``0..i``, so a prompt reuses the longest run of leading messages
+    that an earlier prompt also started with. The most recent ``maxsize``
+    prefixes are kept.
+    """
+
+    def __init__(self, maxsize=256, count_tokens=estimate_tokens):
+        self.maxsize = maxsize
+        self.count_tokens = count_tokens
+        self._prefixes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def process(self, messages):
+        """Record ``messages`` as sent and return the tokens reused and reprocessed."""
+        digest = hashlib.sha256()
+        reused = processed = 0
+        with self._lock:
+            for message in messages:
+                digest.update(f"{message['role']}\0{message['content']}\0".encode("utf-8"))
+                key = digest.hexdigest()
+                if key in self._prefixes:
+                    reused += self._prefixes[key]
+                else:
+                    # Once a message differs, every later key is new as well
+                    self._prefixes[key] = self.count_tokens(message["content"])
+                    processed += self._prefixes[key]
+                self._prefixes.move_to_end(key)
+                if len(self._prefixes) > self.maxsize:
+                    self._prefixes.popitem(last=False)
+        return PrefixUsage(reused, processed)
+
+
+def summary_prompt(summary, turns, max_words=150):
+    """Return the prompt that folds ``turns`` (a list of ``(question, answer)``) into ``summary``."""
+    text = "\n".join(f"User: {question}\nAssistant: {answer}" for question, answer in turns)
+    return SUMMARY_PROMPT.format(max_words=max_words, summary=summary or "(none)", turns=text)
+
+
+@dataclass
+class RequestSize:
+    turn: int
+    messages: int
+    tokens: int
+
+
+class ChatSession:
+    """The history of one chat: a running summary of its old turns and its recent turns.
+
+    Once the summary and the turns add up to more than ``max_history_tokens``,
+    the oldest turns are folded into the summary with
+    ``summarize(summary, turns)``, which returns the new summary (e.g. a model
+    call with ``summary_prompt``), until the recent turns fit in half the
+    threshold. The ``keep_turns`` most recent turns are always sent verbatim.
+    Without ``summarize``, or when it fails, the old turns are dropped. The
+    summary itself is trimmed to ``max_summary_tokens``.
+
+    ``messages`` and ``add_turn`` may be called from several threads. The
+    summary call runs outside the session's lock, so other threads keep
+    reading and extending the history meanwhile; the turns being summarized
+    stay in the history until the new summary replaces them.
+    """
+
+    def __init__(self, max_history_tokens=2000, keep_turns=2, summarize=None, max_summary_tokens=500,
+                 count_tokens=estimate_tokens, max_recorded_requests=1000):
+        self.max_history_tokens = max_history_tokens
+        self.keep_turns = keep_turns
+        self.summarize = summarize
+        self.max_summary_tokens = max_summary_tokens
+        self.count_tokens = count_tokens
+        self.summary = ""
+        self.summary_tokens = 0
+        self.turn_count = 0
+        self.summarized_turns = 0
+        self.evicted_turns = 0
+        self.requests = deque(maxlen=max_recorded_requests)
+        self._turns = deque()
+        self._turn_tokens = 0
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+
+    @property
+    def history_tokens(self):
+        return self.summary_tokens + self._turn_tokens
+
+    def history(self):
+        """Return the messages standing for the conversation so far."""
+        with self._lock:
+            return self._history()
+
+    def _history(self):
+        messages = []
+        if self.summary:
+            messages.append({"role": "user", "content": SUMMARY_MESSAGE.format(summary=self.summary)})
+            messages.append({"role": "assistant", "content": SUMMARY_ACKNOWLEDGEMENT})
+        for question, answer, _ in self._turns:
+            messages.append({"role": "user", "content": question})
+            messages.append({"role": "assistant", "content": answer})
+        return messages
+
+    def messages(self, question):
+        """Return the messages to send for ``question`` and record their size in ``requests``."""
+        with self._lock:
+            messages = self._history()
+            messages.append({"role": "user", "content": question})
+            tokens = self.history_tokens + self.count_tokens(question)
+            self.requests.append(RequestSize(self.turn_count + 1, len(messages), tokens))
+        return messages
+
+    def add_turn(self, question, answer):
+        """Add an answered question, then compact the history if it passed the threshold."""
+        with self._lock:
+            tokens = self.count_tokens(question) + self.count_tokens(answer)
+            self._turns.append((question, answer, tokens))
+            self._turn_tokens += tokens
+            self.turn_count += 1
+            if self.history_tokens <= self.max_history_tokens:
+                return
+        self._compact()
+
+    def _compact(self):
+        # One compaction at a time: a thread finding one in progress leaves it to finish, and
+        # the next add_turn compacts again if needed. Only compactions remove turns, so the
+        # oldest turns are still the ones selected here when the summary is installed.
+        if not self._compact_lock.acquire(blocking=False):
+            return
+        try:
+            with self._lock:
+                old_turns = []
+                remaining_tokens = self._turn_tokens
+                for question, answer, tokens in self._turns:
+                    if len(self._turns) - len(old_turns) <= self.keep_turns:
+                        break
+                    if remaining_tokens <= self.max_history_tokens // 2:
+                        break
+                    old_turns.append((question, answer))
+                    remaining_tokens -= tokens
+                previous_summary = self.summary
+            if not old_turns:
+                return
+
+            # The model call runs without the lock, so the session stays usable meanwhile
+            summary = None
+            if self.summarize is not None:
+                try:
+                    summary = self.summarize(previous_summary, old_turns)
+                except Exception:
+                    # The history must stay bounded even when the summary call fails
+                    summary = None
+
+            with self._lock:
+                for _ in old_turns:
+                    _, _, tokens = self._turns.popleft()
+                    self._turn_tokens -= tokens
+                if summary is None:
+                    self.evicted_turns += len(old_turns)
+                    return
+                self.summary, self.summary_tokens = summary.strip(), self.count_tokens(summary.strip())
+                while self.summary_tokens > self.max_summary_tokens:
+                    # Models overrun the requested length: keep the start of the summary
+                    self.summary = self.summary[:len(self.summary) * self.max_summary_tokens // self.summary_tokens]
+                    self.summary_tokens = self.count_tokens(self.summary)
+                self.summarized_turns += len(old_turns)
+        finally:
+            self._compact_lock.release()
+
+
+class ConversationStore:
+    """Chat sessions by id (e.g. one per user), safe to share between threads.
+
+    Sessions are created on first use with the ``ChatSession`` settings given
+    here. The ``max_sessions`` most recently used sessions are kept; older
+    ones are dropped.
+    """
+
+    def __init__(self, max_sessions=1000, **session_options):
+        self.max_sessions = max_sessions
+        self.session_options = session_options
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """Return the session ``session_id``, starting it if needed."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = ChatSession(**self.session_options)
+                if len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def reset(self, session_id):
+        """Forget the session ``session_id``."""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
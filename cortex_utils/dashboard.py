@@ -0,0 +1,41 @@
+"""Streamlit performance dashboard for the calls of a ``CallRecorder``."""
+from dataclasses import asdict
+
+import streamlit as st
+
+from cortex_utils.metrics import current_rss, peak_rss, prometheus_text
+
+
+def render_performance_dashboard(session, recorder, scheduler=None):
+    """Show p50/p95 latency and token usage per model, then the most recent calls.
+
+    The resident memory of the app process comes first: the highest value
+    sampled during this session's reruns, and the process peak. Memory is
+    per process, shared by every session of the app. With a
+    ``cortex_utils.scheduler.Scheduler``, its retry, failure and
+    deduplication counts are shown as well.
+    """
+    # Memory is sampled at the end of each rerun; the session keeps the highest sample
+    st.session_state["peak_rss"] = max(st.session_state.get("peak_rss", 0), current_rss())
+    col1, col2 = st.columns(2)
+    col1.metric("App process RSS (max seen by this session)", f"{st.session_state['peak_rss'] / 2**20:,.0f} MiB")
+    col2.metric("Peak RSS (app process)", f"{peak_rss() / 2**20:,.0f} MiB")
+
+    if scheduler is not None and scheduler.stats():
+        st.write("Scheduler:")
+        st.dataframe(scheduler.stats(), use_container_width=True)
+
+    recorder.fill_query_times(session)
+    calls = recorder.calls()
+    if not calls:
+        st.write("No model calls recorded yet.")
+        return
+
+    st.write("Per model:")
+    st.dataframe(recorder.summary(), use_container_width=True)
+
+    st.write("Most recent calls:")
+    st.dataframe([asdict(call) for call in reversed(calls[-20:])], use_container_width=True)
+
+    if st.toggle("Show Prometheus metrics"):
+        st.code(prometheus_text(recorder))
@@ -0,0 +1,75 @@
+"""Shared cache of Snowflake query results.
+
+Streamlit reruns an app script from the top on every widget change, so any
+query issued at module level is re-executed each time. ``QueryCache`` keeps the
+collected rows keyed by the session identity (account and role) and the query
+text. Held in ``st.cache_resource``, one instance is shared across reruns and
+across every user of the app that runs with the same role.
+
+Entries stay cached until they are explicitly invalidated, or, given
+``max_entries``, until they are the least recently used. The hit/miss counters
+show whether reruns still reach the warehouse. ``get_or_load`` caches any
+other value derived from the warehouse, such as a DataFrame built from a
+local copy of the rows, with the same counters.
+"""
+import threading
+
+
+def session_key(session):
+    """Return the part of the cache key that identifies who runs the query."""
+    return (session.get_current_account(), session.get_current_role())
+
+
+class QueryCache:
+    """Thread-safe cache of ``session.sql(query).collect()`` results."""
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self._results = {}
+        self._fetch_locks = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def fetch(self, session, query):
+        """Return the rows of ``query``, running it only on the first call."""
+        return self.get_or_load(session, query, lambda: session.sql(query).collect())
+
+    def get_or_load(self, session, query, load):
+        """Return the value cached for ``query`` (any hashable key), calling ``load()`` only on the first call."""
+        key = (session_key(session), query)
+        with self._lock:
+            if key in self._results:
+                self.hits += 1
+                self._results[key] = self._results.pop(key)
+                return self._results[key]
+            fetch_lock = self._fetch_locks.setdefault(key, threading.Lock())
+
+        # Only one caller loads a given key; concurrent callers wait for its result
+        with fetch_lock:
+            with self._lock:
+                if key in self._results:
+                    self.hits += 1
+                    return self._results[key]
+                self.misses += 1
+            value = load()
+            with self._lock:
+                self._results[key] = value
+                self._fetch_locks.pop(key, None)
+                # Drop the least recently used entries (dicts keep insertion order)
+                while self.max_entries is not None and len(self._results) > self.max_entries:
+                    del self._results[next(iter(self._results))]
+            return value
+
+    def invalidate(self, query=None):
+        """Drop the cached rows of ``query``, or of every query if it is ``None``."""
+        with self._lock:
+            if query is None:
+                self._results.clear()
+            else:
+                for key in [key for key in self._results if key[1] == query]:
+                    del self._results[key]
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._results)}
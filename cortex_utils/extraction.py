@@ -0,0 +1,252 @@
+"""Structured extraction of key figures from financial reports, validated and stored per filing.
+
+Users of the 10-K samples ask free-form questions, then re-ask for single
+figures ("what was the revenue in FY2022?"), each time re-sending the whole
+filing. ``extract`` instead pulls a fixed JSON schema out of a filing in one
+completion: revenue, margins, headcount and segments. The answer is parsed
+and validated against the schema, and the model is asked again with the
+validation errors when it does not conform. Valid results are saved in an
+``ExtractionStore`` keyed by filing and schema version, together with the
+hash of the filing text. Later questions and comparisons read the stored
+fields instantly. Changing the schema (and bumping its version) or the
+filing text triggers a new extraction.
+
+``complete`` is any callable taking a prompt and returning the answer text,
+as for ``cortex_utils.map_reduce``, so the engine works with Cortex and with
+the AI21 SDK.
+"""
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from cortex_utils.cache import text_hash
+from cortex_utils.context import trim_to_budget
+
+# Field types: "string", "integer", "number", "percent", or a list holding the
+# fields of each item of a list of objects
+FINANCIAL_SCHEMA = {
+    "name": "financial_highlights",
+    "version": 1,
+    "fields": {
+        "company_name": "string",
+        "fiscal_year": "integer",
+        "currency": "string",
+        "revenue": "number",
+        "gross_margin": "percent",
+        "operating_margin": "percent",
+        "net_margin": "percent",
+        "headcount": "integer",
+        "segments": [{"name": "string", "revenue": "number"}],
+    },
+    "instructions": (
+        "Report amounts in millions of the reporting currency, margins as percentages of revenue "
+        "(e.g. 56.9 for 56.9%) and headcount as the total number of employees at the end of the fiscal "
+        "year. List the reportable segments with their revenue. Use null for any figure the report "
+        "does not state; do not estimate."
+    ),
+}
+
+EXTRACTION_PROMPT = """{text}
+
+**********
+
+You're a stock analyst retrieving data from financial reports. Extract the figures below from the report above for its most recent fiscal year.
+{instructions}
+
+Answer with a single JSON object with exactly these keys and value types:
+{fields}"""
+
+RETRY_PROMPT = """
+
+Your previous answer was not valid:
+{errors}
+
+Answer again with the JSON object only."""
+
+_NUMBER_RE = re.compile(r"^\(?-?[$€£]?\s*-?[\d,]*\.?\d+\s*%?\)?$")
+
+
+def _describe(spec):
+    if isinstance(spec, list):
+        return "list of {" + ", ".join(f'"{name}": {_describe(item)}' for name, item in spec[0].items()) + "}"
+    return f"{'number (percentage)' if spec == 'percent' else spec} or null"
+
+
+def _number(value):
+    """Return ``value`` as a float, accepting strings such as "$26,974" or "(1,234)"."""
+    if isinstance(value, bool):
+        raise ValueError
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str) and _NUMBER_RE.match(value.strip()):
+        cleaned = re.sub(r"[$€£,%\s]", "", value.strip())
+        negative = cleaned.startswith("(") and cleaned.endswith(")")
+        number = float(cleaned.strip("()"))
+        return -number if negative else number
+    raise ValueError
+
+
+def _validate_value(value, spec, path, errors):
+    if value is None:
+        return None
+    if isinstance(spec, list):
+        if not isinstance(value, list):
+            errors.append(f"{path}: expected a list")
+            return None
+        items = []
+        for index, item in enumerate(value):
+            if not isinstance(item, dict):
+                errors.append(f"{path}[{index}]: expected an object")
+                continue
+            items.append({
+                name: _validate_value(item.get(name), item_spec, f"{path}[{index}].{name}", errors)
+                for name, item_spec in spec[0].items()
+            })
+        return items
+    if spec == "string":
+        if not isinstance(value, str):
+            errors.append(f"{path}: expected a string")
+            return None
+        return value
+    try:
+        number = _number(value)
+    except ValueError:
+        errors.append(f"{path}: expected {spec}, got {value!r}")
+        return None
+    if spec == "integer":
+        if number != int(number):
+            errors.append(f"{path}: expected integer, got {value!r}")
+            return None
+        return int(number)
+    if spec == "percent" and not -100 <= number <= 100:
+        errors.append(f"{path}: expected a percentage between -100 and 100, got {value!r}")
+        return None
+    return number
+
+
+def parse_json(answer):
+    """Return the JSON object in ``answer``, ignoring Markdown code fences and surrounding text."""
+    start, end = answer.find("{"), answer.rfind("}")
+    if start == -1 or end < start:
+        raise ValueError("no JSON object in the answer")
+    return json.loads(answer[start:end + 1])
+
+
+def validate_extraction(data, schema=FINANCIAL_SCHEMA):
+    """Validate ``data`` against ``schema``.
+
+    Returns ``(fields, errors)``: the fields normalized to their types (numbers
+    given as strings are converted, unknown keys are dropped) and a list of
+    error messages, empty when ``data`` conforms.
+    """
+    if not isinstance(data, dict):
+        return {}, ["expected a JSON object"]
+    errors = []
+    fields = {}
+    for name, spec in schema["fields"].items():
+        if name not in data:
+            errors.append(f"{name}: missing")
+            continue
+        fields[name] = _validate_value(data[name], spec, name, errors)
+    return fields, errors
+
+
+def extraction_prompt(text, schema=FINANCIAL_SCHEMA):
+    """Return the prompt extracting ``schema`` from a report's ``text``."""
+    return EXTRACTION_PROMPT.format(
+        text=text,
+        instructions=schema["instructions"],
+        fields="\n".join(f'"{name}": {_describe(spec)}' for name, spec in schema["fields"].items()),
+    )
+
+
+class ExtractionStore:
+    """Extracted fields on local disk, one JSON file per filing and schema version."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, filing_id, schema):
+        directory = os.path.join(self.root, f"{schema['name']}-v{schema['version']}")
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, re.sub(r"[^\w.-]", "_", str(filing_id)) + ".json")
+
+    def get(self, filing_id, digest, schema=FINANCIAL_SCHEMA):
+        """Return the stored record of a filing, or None if it is missing or the text has changed."""
+        try:
+            with open(self._path(filing_id, schema), encoding="utf-8") as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            return None
+        return record if record["text_hash"] == digest else None
+
+    def put(self, filing_id, digest, fields, schema=FINANCIAL_SCHEMA):
+        path = self._path(filing_id, schema)
+        record = {
+            "filing_id": filing_id,
+            "schema_version": schema["version"],
+            "text_hash": digest,
+            "extracted_at": time.time(),
+            "fields": fields,
+        }
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(record, f, indent=2)
+        os.replace(tmp_path, path)
+        return record
+
+
+@dataclass
+class Extraction:
+    filing_id: str
+    fields: dict
+    errors: list = field(default_factory=list)
+    cached: bool = False
+    attempts: int = 0
+
+
+def extract(filing_id, text, complete, store=None, schema=FINANCIAL_SCHEMA, max_attempts=3, max_text_tokens=None):
+    """Extract ``schema`` from the report ``text`` of ``filing_id``.
+
+    Returns the stored fields when ``store`` has them for this text and
+    schema version. Otherwise the model is called, and called again with the
+    validation errors, up to ``max_attempts`` times; a valid result is saved
+    in ``store``. ``max_text_tokens`` trims the report to the passages most
+    relevant to the schema's fields when it would not fit the model.
+    """
+    digest = text_hash(text)
+    if store is not None:
+        record = store.get(filing_id, digest, schema)
+        if record is not None:
+            return Extraction(filing_id, record["fields"], cached=True)
+
+    if max_text_tokens is not None:
+        text, _ = trim_to_budget(text, max_text_tokens, " ".join(schema["fields"]).replace("_", " "))
+    prompt = extraction_prompt(text, schema)
+    fields, errors = {}, []
+    for attempt in range(1, max_attempts + 1):
+        answer = complete(prompt if not errors else prompt + RETRY_PROMPT.format(errors="\n".join(errors)))
+        try:
+            fields, errors = validate_extraction(parse_json(answer or ""), schema)
+        except ValueError as e:
+            # json.JSONDecodeError is a ValueError
+            fields, errors = {}, [f"invalid JSON: {e}"]
+        if not errors:
+            if store is not None:
+                store.put(filing_id, digest, fields, schema)
+            return Extraction(filing_id, fields, attempts=attempt)
+    return Extraction(filing_id, fields, errors, attempts=max_attempts)
+
+
+def extract_all(filings, complete, store=None, schema=FINANCIAL_SCHEMA, max_workers=4, **kwargs):
+    """Extract ``schema`` from every ``(filing_id, text)`` of ``filings`` concurrently, in order."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(
+            lambda filing: extract(filing[0], filing[1], complete, store, schema, **kwargs),
+            filings,
+        ))
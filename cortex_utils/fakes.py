@@ -0,0 +1,255 @@
+"""Local stand-ins for Snowflake and Cortex, for exercising the apps' plumbing offline.
+
+``FakeCortexBackend`` implements the backend interface of
+``cortex_utils.scheduler``: it answers after a latency proportional to the
+prompt and completion sizes, can fail a given share of calls with the errors
+Cortex returns when it is throttled, and records how many calls ran at once
+per model.
+
+``FakeSession`` stands in for the Snowpark session returned by
+``get_active_session()``. It recognises the statements the apps run against
+``INSURANCE.PUBLIC.HMO2`` and the Cybersyn SEC tables, serves canned rows for
+them, and answers ``CORTEX.COMPLETE`` with a ``FakeCortexBackend``.
+"""
+import json
+import random
+import re
+import threading
+import time
+
+from cortex_utils.cache import text_hash
+from cortex_utils.context import estimate_tokens
+from cortex_utils.scheduler import message_tokens
+
+
+class FakeCortexError(Exception):
+    """Error raised by ``FakeCortexBackend`` for a simulated failed call."""
+
+
+class FakeCortexBackend:
+    """Simulate ``CORTEX.COMPLETE`` locally.
+
+    A call takes ``base_latency`` plus ``seconds_per_prompt_token`` per
+    prompt token and ``seconds_per_completion_token`` per generated token.
+    ``failure_rate`` of the calls raise a throttling error (``429 Too Many
+    Requests``) instead of answering.
+    """
+
+    def __init__(self, base_latency=0.05, seconds_per_prompt_token=1e-6, seconds_per_completion_token=1e-3,
+                 completion_tokens=50, failure_rate=0.0, seed=None, sleep=time.sleep):
+        self.base_latency = base_latency
+        self.seconds_per_prompt_token = seconds_per_prompt_token
+        self.seconds_per_completion_token = seconds_per_completion_token
+        self.completion_tokens = completion_tokens
+        self.failure_rate = failure_rate
+        self.sleep = sleep
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._running = {}
+        self.calls = 0
+        self.failures = 0
+        self.max_concurrency = {}
+
+    def _start(self, model):
+        with self._lock:
+            self.calls += 1
+            self._running[model] = self._running.get(model, 0) + 1
+            self.max_concurrency[model] = max(self.max_concurrency.get(model, 0), self._running[model])
+            failed = self._random.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+        return failed
+
+    def _finish(self, model):
+        with self._lock:
+            self._running[model] -= 1
+
+    def answer(self, model, messages):
+        """Return the fake answer text of a prompt."""
+        question = messages[-1]["content"]
+        question = question if isinstance(question, str) else "".join(question)
+        words = " ".join(question.split()[:10])
+        filler = " ".join(["lorem"] * self.completion_tokens)
+        return f"[{model}] Answer to: {words} {filler}"
+
+    def complete(self, model, messages, options):
+        failed = self._start(model)
+        try:
+            prompt_tokens = message_tokens(messages)
+            self.sleep(self.base_latency + prompt_tokens * self.seconds_per_prompt_token)
+            if failed:
+                raise FakeCortexError("Request failed for external function COMPLETE: 429 Too Many Requests")
+            text = self.answer(model, messages)
+            completion_tokens = estimate_tokens(text)
+            self.sleep(completion_tokens * self.seconds_per_completion_token)
+        finally:
+            self._finish(model)
+        return json.dumps({
+            "choices": [{"messages": text}],
+            "model": model,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+    def stream(self, model, messages, options):
+        failed = self._start(model)
+        try:
+            self.sleep(self.base_latency + message_tokens(messages) * self.seconds_per_prompt_token)
+            if failed:
+                raise FakeCortexError("Request failed for external function COMPLETE: 429 Too Many Requests")
+            for word in self.answer(model, messages).split(" "):
+                self.sleep(self.seconds_per_completion_token)
+                yield word + " "
+        finally:
+            self._finish(model)
+
+
+class FakeRow(dict):
+    """Row of a ``FakeSession`` result: columns are read by name or by position, like a Snowpark ``Row``."""
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list(self.values())[key]
+        return super().__getitem__(key)
+
+    def as_dict(self):
+        return dict(self)
+
+
+class FakeAsyncJob:
+    """Result of ``FakeDataFrame.collect_nowait``; the query has already run."""
+
+    def __init__(self, rows, query_id):
+        self._rows = rows
+        self.query_id = query_id
+
+    def is_done(self):
+        return True
+
+    def result(self):
+        return self._rows
+
+
+class FakeDataFrame:
+    def __init__(self, session, sql, params):
+        self._session = session
+        self._sql = sql
+        self._params = list(params or [])
+
+    def collect(self):
+        return self._session._execute(self._sql, self._params)
+
+    def collect_nowait(self):
+        rows = self.collect()
+        return FakeAsyncJob(rows, self._session.last_query_id)
+
+    def to_pandas(self):
+        import pandas as pd
+
+        return pd.DataFrame([dict(row) for row in self.collect()])
+
+
+_MODEL_RE = re.compile(r"COMPLETE\(\s*'([^']*)'")
+
+# The plans table, but not the comparison tables of insurance_batch_compare
+_PLANS_TABLE_RE = re.compile(r"INSURANCE\.PUBLIC\.HMO2\b")
+
+
+class FakeSession:
+    """Stand-in for the Snowpark session of the apps, serving canned rows.
+
+    ``plans`` maps HMO2 plan names to their details; ``filings`` is a list of
+    SEC filing rows with the columns of ``SEC_REPORT_TEXT_ATTRIBUTES`` and
+    ``SEC_REPORT_INDEX`` the apps read. ``CORTEX.COMPLETE`` statements are
+    answered by ``backend`` (a ``FakeCortexBackend``), so their latency grows
+    with the size of the prompt, including documents joined in SQL.
+    Statements the fake does not recognise return no rows. Every statement
+    is appended to ``queries``.
+    """
+
+    def __init__(self, plans=None, filings=None, backend=None):
+        self.plans = dict(plans or {})
+        self.filings = list(filings or [])
+        self.backend = backend or FakeCortexBackend(seed=0)
+        self.queries = []
+        self.last_query_id = None
+        self._lock = threading.Lock()
+
+    def sql(self, sql, params=None):
+        return FakeDataFrame(self, sql, params)
+
+    def get_current_account(self):
+        return '"FAKE_ACCOUNT"'
+
+    def get_current_role(self):
+        return '"FAKE_ROLE"'
+
+    def _execute(self, sql, params):
+        with self._lock:
+            self.queries.append((sql, params))
+            self.last_query_id = f"fake-{len(self.queries):08d}"
+        if "CORTEX.COMPLETE" in sql or "CORTEX.TRY_COMPLETE" in sql:
+            return self._complete(sql, params)
+        if "COUNT_TOKENS" in sql:
+            return [FakeRow(TOKENS=estimate_tokens(params[-1]))]
+        if _PLANS_TABLE_RE.search(sql):
+            return self._plans(sql, params)
+        if "SEC_REPORT_TEXT_ATTRIBUTES" in sql:
+            return self._filings(sql, params)
+        return []
+
+    def _documents(self, sql, params):
+        """Return the documents a statement reads from the canned tables."""
+        if "HMO2" in sql:
+            names = [param for param in params if param in self.plans] or list(self.plans)
+            return [self.plans[name] for name in names]
+        if "SEC_REPORT_TEXT_ATTRIBUTES" in sql:
+            return [row["VALUE"] for row in self._company_filings(sql, params)]
+        return []
+
+    def _complete(self, sql, params):
+        if sql.lstrip().upper().startswith("INSERT"):
+            return [FakeRow(number_of_rows_inserted=0)]
+        match = _MODEL_RE.search(sql)
+        content = "".join(str(param) for param in params if isinstance(param, str))
+        if "LISTAGG" in sql:
+            # The prompt is assembled in SQL from documents that never reach the client
+            content += " ".join(self._documents(sql, params))
+        response = self.backend.complete(match.group(1) if match else "fake", [{"role": "user", "content": content}], {})
+        return [FakeRow(RESPONSE=response)]
+
+    def _plans(self, sql, params):
+        names = [param for param in params if param in self.plans] or sorted(self.plans)
+        if "SHA2" in sql:
+            return [FakeRow(PLANNAME=name, DETAIL_HASH=text_hash(self.plans[name])) for name in names]
+        if "DETAIL" in sql.upper().split("FROM")[0]:
+            return [FakeRow(PLANNAME=name, DETAIL=self.plans[name]) for name in names]
+        return [FakeRow(PLANNAME=name) for name in names]
+
+    def _company_filings(self, sql, params):
+        """Return the filings of the companies a statement selects, as a bind parameter or a literal."""
+        return [
+            row for row in self.filings
+            if row["COMPANY_NAME"] in params or f"'{row['COMPANY_NAME']}'" in sql
+        ]
+
+    def _filings(self, sql, params):
+        if "TEXT_HASH" in sql:
+            # Fiscal years are the only integer parameters of the ingest query
+            fiscal_years = {param for param in params if isinstance(param, int)}
+            return [
+                FakeRow(SEC_DOCUMENT_ID=row["SEC_DOCUMENT_ID"], CIK=row["CIK"], COMPANY_NAME=row["COMPANY_NAME"],
+                        FISCAL_YEAR=row["FISCAL_YEAR"], FILED_DATE=row["FILED_DATE"],
+                        PERIOD_END_DATE=row["PERIOD_END_DATE"], TEXT_HASH=text_hash(row["VALUE"]))
+                for row in self.filings
+                if row["COMPANY_NAME"] in params and (not fiscal_years or row["FISCAL_YEAR"] in fiscal_years)
+            ]
+        if "SEC_DOCUMENT_ID IN" in sql:
+            return [
+                FakeRow(SEC_DOCUMENT_ID=row["SEC_DOCUMENT_ID"], VALUE=row["VALUE"])
+                for row in self.filings if row["SEC_DOCUMENT_ID"] in params
+            ]
+        return [FakeRow(row) for row in self._company_filings(sql, params)]
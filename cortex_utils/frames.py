@@ -0,0 +1,50 @@
+"""Columnar, memory-lean views of the SEC filing rows.
+
+The 10-K apps built their filing DataFrame from a list of per-row dicts on
+every click, then ran ``.astype(str)`` on the multi-megabyte ``VALUE`` column
+and joined it into one more string that was never used. ``filing_frame``
+builds the frame once, column by column. The ``VALUE`` column holds the
+strings of the fetched rows themselves, so the filing text exists only once
+in memory however many views use it. ``preview_frame`` replaces the text
+with its length and first characters for ``st.dataframe``, so the browser
+receives a few kilobytes instead of whole filings.
+"""
+import pandas as pd
+
+# Columns of the filing rows shown next to the text
+FILING_COLUMNS = ["SEC_DOCUMENT_ID", "VARIABLE_NAME", "COMPANY_NAME", "FILED_DATE", "FISCAL_YEAR"]
+
+# Characters of each filing shown in the preview column
+PREVIEW_CHARS = 300
+
+
+def filing_frame(rows):
+    """Return a DataFrame of the filing ``rows`` (Snowpark ``Row`` objects or dicts).
+
+    The ``VALUE`` column is an object column referencing the rows' strings:
+    no filing text is copied.
+    """
+    columns = {name: [row[name] for row in rows] for name in FILING_COLUMNS + ["VALUE"]}
+    return pd.DataFrame(columns, columns=FILING_COLUMNS + ["VALUE"])
+
+
+def preview_frame(frame, preview_chars=PREVIEW_CHARS):
+    """Return ``frame`` with the filing text replaced by its length and first characters."""
+    preview = frame[FILING_COLUMNS].copy()
+    preview["VALUE_CHARS"] = frame["VALUE"].str.len()
+    preview["VALUE_PREVIEW"] = frame["VALUE"].str.slice(0, preview_chars) + "..."
+    return preview
+
+
+def frame_documents(frame):
+    """Return ``(title, text)`` per filing of ``frame``, titled by fiscal year.
+
+    When ``frame`` holds the filings of several companies, the titles start
+    with the company name.
+    """
+    if frame["COMPANY_NAME"].nunique() > 1:
+        return [
+            (f"{company_name} FY{year}", text)
+            for company_name, year, text in zip(frame["COMPANY_NAME"], frame["FISCAL_YEAR"], frame["VALUE"])
+        ]
+    return [(f"FY{year}", text) for year, text in zip(frame["FISCAL_YEAR"], frame["VALUE"])]
@@ -0,0 +1,98 @@
+"""Word-overlap grounding metrics for generated or existing product descriptions.
+
+The grounded product description notebook scores how well a description is
+grounded in its attributes: the share of distinct attribute words that also
+appear in the description. Its ``get_words`` reloaded NLTK's English
+stopwords into a list on every call and tested membership in that list, and
+the scores were computed row by row with ``DataFrame.apply(axis=1)``.
+
+``WordOverlapScorer`` loads the stopwords once into a frozenset and keeps
+the tokenization settings bound, so scoring a pair is a few set operations.
+``match_rates`` scores whole columns at once into a NumPy array. Given
+``processes``, it splits the rows into chunks scored in a process pool. The
+scores are exactly those of the notebook's ``percentage_distinct_words``.
+"""
+import string
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+
+@lru_cache(maxsize=None)
+def english_stopwords():
+    """Return NLTK's English stopwords as a frozenset (run ``nltk.download('stopwords')`` first)."""
+    from nltk.corpus import stopwords
+
+    return frozenset(stopwords.words("english"))
+
+
+class WordOverlapScorer:
+    """Score the share of distinct words of one text that appear in another.
+
+    Words are the whitespace-separated tokens of the lowercased text with at
+    least ``min_chars_in_word`` characters that are not stopwords, stripped
+    of surrounding punctuation, as in the notebook's ``get_words``. With
+    ``numeric``, only numbers are compared.
+    """
+
+    def __init__(self, stopwords=None, min_chars_in_word=2, numeric=False):
+        self.stopwords = frozenset(stopwords) if stopwords is not None else english_stopwords()
+        self.min_chars_in_word = min_chars_in_word
+        self.numeric = numeric
+
+    def words(self, text):
+        """Return the set of distinct words of ``text``."""
+        stopwords, min_chars, punctuation = self.stopwords, self.min_chars_in_word, string.punctuation
+        words = {
+            word.strip(punctuation) for word in text.lower().split()
+            if len(word) >= min_chars and word not in stopwords
+        }
+        if self.numeric:
+            words = {word for word in words if word.isnumeric()}
+        return words
+
+    def score(self, text1, text2):
+        """Return the share (0 to 1) of the distinct words of ``text1`` that appear in ``text2``.
+
+        Returns 0 when ``text1`` has no words or is not a string (e.g. NaN).
+        """
+        if not isinstance(text1, str) or not isinstance(text2, str):
+            return 0.0
+        words1 = self.words(text1)
+        if not words1:
+            return 0.0
+        return len(words1 & self.words(text2)) / len(words1)
+
+    def score_many(self, texts1, texts2):
+        """Return the scores of the pairs of ``texts1`` and ``texts2`` as a float array."""
+        score = self.score
+        return np.fromiter((score(text1, text2) for text1, text2 in zip(texts1, texts2)), dtype=float)
+
+
+def _score_chunk(scorer, texts1, texts2):
+    return scorer.score_many(texts1, texts2)
+
+
+def match_rates(texts1, texts2, numeric=False, min_chars_in_word=2, stopwords=None, processes=None,
+                chunk_size=5000):
+    """Score every pair of ``texts1`` and ``texts2`` (e.g. two DataFrame columns).
+
+    Returns a float array with, for each row, the share of the distinct words
+    of ``texts1`` that appear in ``texts2``. With ``processes`` greater than 1,
+    chunks of ``chunk_size`` rows are scored in that many worker processes.
+    """
+    scorer = WordOverlapScorer(stopwords, min_chars_in_word, numeric)
+    texts1, texts2 = list(texts1), list(texts2)
+    if not processes or processes < 2 or len(texts1) <= chunk_size:
+        return scorer.score_many(texts1, texts2)
+
+    starts = range(0, len(texts1), chunk_size)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        chunks = executor.map(
+            _score_chunk,
+            [scorer] * len(starts),
+            [texts1[start:start + chunk_size] for start in starts],
+            [texts2[start:start + chunk_size] for start in starts],
+        )
+        return np.concatenate(list(chunks))
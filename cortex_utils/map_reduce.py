@@ -0,0 +1,152 @@
+"""Chunked map-reduce over long documents.
+
+An alternative to sending every filing in one giant ``CORTEX.COMPLETE`` call,
+for models whose context window cannot hold the documents:
+
+1. map: each document is split into section-aware chunks (10-K "Item"
+   headings first, then line breaks) and every chunk is asked for the
+   information relevant to the question, concurrently;
+2. reduce: the partial answers are combined in a tree, as many per call as fit
+   in the budget, until a single call writes the answer. That last call runs
+   even when the map step leaves a single partial answer, so the answer has
+   the same form whatever the length of the documents.
+
+``complete`` is any callable taking a prompt and returning the answer text, so
+the same engine works with SQL, streaming or AI21 SDK completions.
+"""
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from cortex_utils.context import estimate_tokens, split_passages
+
+# Matches the "Item 1.", "Item 1A.", "Item 7." headings of 10-K filings
+SECTION_HEADING_RE = re.compile(r"^\s*item\s+\d+[a-c]?\s*[.:]", re.IGNORECASE | re.MULTILINE)
+
+# Answer the map step gives for chunks without relevant information
+NO_INFORMATION = "NO RELEVANT INFORMATION"
+
+MAP_PROMPT = """You are reading one excerpt of the document "{name}".
+Extract every fact from the excerpt that helps answer the question below, including figures and dates.
+If the excerpt contains nothing relevant, answer exactly "{no_information}".
+
+Question: {question}
+
+Excerpt:
+{chunk}"""
+
+REDUCE_PROMPT = """Below are partial answers to the same question, each based on a different part of the documents.
+Combine them into a single, complete answer to the question. Keep figures and dates, and say which document they come from.
+
+Question: {question}
+
+Partial answers:
+{partials}"""
+
+
+@dataclass
+class MapReduceResult:
+    answer: str
+    calls: int
+    prompt_tokens: int
+    elapsed: float
+
+
+def split_sections(text, chunk_tokens, count_tokens=estimate_tokens):
+    """Split ``text`` into chunks of at most ``chunk_tokens``, along section headings where possible."""
+    starts = [match.start() for match in SECTION_HEADING_RE.finditer(text)]
+    bounds = [0] + [start for start in starts if start > 0] + [len(text)]
+    sections = [text[begin:end] for begin, end in zip(bounds, bounds[1:]) if text[begin:end].strip()]
+
+    chunks = []
+    for section in sections:
+        if count_tokens(section) <= chunk_tokens:
+            chunks.append(section)
+        else:
+            chunks.extend(_split_to_budget(section, chunk_tokens, count_tokens))
+
+    # Merge consecutive small sections so short items do not each cost a call
+    merged = []
+    for chunk in chunks:
+        if merged and count_tokens(merged[-1]) + count_tokens(chunk) <= chunk_tokens:
+            merged[-1] += chunk
+        else:
+            merged.append(chunk)
+    return merged
+
+
+def _split_to_budget(text, chunk_tokens, count_tokens):
+    """Split ``text`` along line breaks into passages of at most ``chunk_tokens`` as ``count_tokens`` counts them."""
+    passages = []
+    # Four characters per token on average, see estimate_tokens
+    for passage in split_passages(text, max_chars=chunk_tokens * 4):
+        if len(passage) <= 1 or count_tokens(passage) <= chunk_tokens:
+            passages.append(passage)
+            continue
+        # Dense text such as financial tables has more tokens: halve the passage, at a
+        # line break or space where possible, until each half fits
+        half = len(passage) // 2
+        middle = max(passage.rfind("\n", 0, half), passage.rfind(" ", 0, half)) + 1 or half
+        passages += _split_to_budget(passage[:middle], chunk_tokens, count_tokens)
+        passages += _split_to_budget(passage[middle:], chunk_tokens, count_tokens)
+    return passages
+
+
+def map_reduce(documents, question, complete, chunk_tokens, max_workers=8, count_tokens=estimate_tokens):
+    """Answer ``question`` over ``documents`` (a list of ``(name, text)``).
+
+    ``chunk_tokens`` bounds the size of every prompt, so it should be the
+    prompt budget of the model (see ``context.prompt_budget``).
+    """
+    started_at = time.perf_counter()
+    # Leave room in every prompt for the instructions around the chunk
+    template_tokens = count_tokens(MAP_PROMPT + REDUCE_PROMPT + question)
+    content_tokens = max(chunk_tokens - template_tokens, 1)
+
+    prompts = [
+        MAP_PROMPT.format(name=name, no_information=NO_INFORMATION, question=question, chunk=chunk)
+        for name, text in documents
+        for chunk in split_sections(text, content_tokens, count_tokens)
+    ]
+    calls = len(prompts)
+    prompt_tokens = sum(count_tokens(prompt) for prompt in prompts)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        partials = [
+            partial.strip() for partial in executor.map(complete, prompts)
+            if partial and NO_INFORMATION not in partial
+        ]
+
+        # Reduce in a tree: combine as many partial answers per call as fit, until one call
+        # combines them all. A single partial still goes through that final call.
+        while partials:
+            groups = _group_partials(partials, content_tokens, count_tokens)
+            if len(groups) == len(partials) > 1:
+                # Each partial fills a prompt on its own; combine pairs to make progress
+                groups = [partials[i:i + 2] for i in range(0, len(partials), 2)]
+            prompts = [
+                REDUCE_PROMPT.format(question=question, partials="\n\n---\n\n".join(group))
+                for group in groups
+            ]
+            calls += len(prompts)
+            prompt_tokens += sum(count_tokens(prompt) for prompt in prompts)
+            partials = [partial.strip() for partial in executor.map(complete, prompts) if partial]
+            if len(groups) == 1:
+                break
+
+    answer = partials[0] if partials else ""
+    return MapReduceResult(answer, calls, prompt_tokens, time.perf_counter() - started_at)
+
+
+def _group_partials(partials, budget, count_tokens):
+    groups = [[]]
+    used = 0
+    for partial in partials:
+        tokens = count_tokens(partial)
+        if groups[-1] and used + tokens > budget:
+            groups.append([])
+            used = 0
+        groups[-1].append(partial)
+        used += tokens
+    return groups
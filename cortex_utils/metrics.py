@@ -0,0 +1,236 @@
+"""Latency and token instrumentation for Cortex calls.
+
+Every completion the apps run is described by a ``CallRecord``: model, query ID,
+SQL compilation and execution time, end-to-end latency, time-to-first-token
+for streamed answers, prompt/completion/total tokens from the response
+``usage`` and whether the answer came from a cache. A ``CallRecorder`` keeps the
+recent records for the in-app dashboard and forwards each record to its sinks:
+
+- ``LoggingSink`` writes one JSON log line per call. In Streamlit in Snowflake,
+  log records are collected in the account's event table.
+- ``TableSink`` inserts the records into a Snowflake table.
+- ``prometheus_text`` renders the recorder in the Prometheus text exposition
+  format for scraping.
+"""
+import json
+import logging
+import math
+import mmap
+import sys
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass, field
+
+logger = logging.getLogger("cortex_utils.metrics")
+
+
+@dataclass
+class CallRecord:
+    model: str
+    latency: float
+    cache_status: str = "miss"
+    query_id: str = None
+    prompt_tokens: int = None
+    completion_tokens: int = None
+    total_tokens: int = None
+    time_to_first_token: float = None
+    compilation_ms: int = None
+    execution_ms: int = None
+    timestamp: float = field(default_factory=time.time)
+
+    @classmethod
+    def from_response(cls, model, response, latency, **kwargs):
+        """Build a record, reading token counts from a CORTEX.COMPLETE JSON response."""
+        usage = {}
+        if response:
+            try:
+                usage = json.loads(response).get("usage", {})
+            except (json.JSONDecodeError, AttributeError):
+                pass
+        return cls(
+            model=model,
+            latency=latency,
+            prompt_tokens=usage.get("prompt_tokens"),
+            completion_tokens=usage.get("completion_tokens"),
+            total_tokens=usage.get("total_tokens"),
+            **kwargs,
+        )
+
+
+class LoggingSink:
+    """Write each call as a structured (JSON) log line."""
+
+    def __init__(self, logger=logger):
+        self.logger = logger
+
+    def emit(self, call):
+        self.logger.info(json.dumps(asdict(call)))
+
+
+class TableSink:
+    """Insert each call into a Snowflake table."""
+
+    COLUMNS = [name for name in CallRecord.__dataclass_fields__]
+
+    def __init__(self, session, table="CORTEX_CALL_METRICS"):
+        self.session = session
+        self.table = table
+        self.session.sql(f"""
+            CREATE TABLE IF NOT EXISTS {self.table} (
+                MODEL STRING, LATENCY FLOAT, CACHE_STATUS STRING, QUERY_ID STRING,
+                PROMPT_TOKENS NUMBER, COMPLETION_TOKENS NUMBER, TOTAL_TOKENS NUMBER,
+                TIME_TO_FIRST_TOKEN FLOAT, COMPILATION_MS NUMBER, EXECUTION_MS NUMBER,
+                TIMESTAMP FLOAT
+            )
+        """).collect()
+
+    def emit(self, call):
+        self.session.sql(
+            f"INSERT INTO {self.table} ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' for _ in self.COLUMNS)})",
+            params=[getattr(call, name) for name in self.COLUMNS],
+        ).collect()
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of ``values`` (``fraction`` between 0 and 1)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+class CallRecorder:
+    """Keep the most recent calls and forward every call to the sinks."""
+
+    def __init__(self, sinks=(), maxlen=1000):
+        self.sinks = list(sinks)
+        self._calls = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def record(self, call):
+        with self._lock:
+            self._calls.append(call)
+        for sink in self.sinks:
+            try:
+                sink.emit(call)
+            except Exception:
+                # Instrumentation must never break the app
+                logger.exception("Failed to emit call metrics")
+
+    def calls(self):
+        with self._lock:
+            return list(self._calls)
+
+    def fill_query_times(self, session):
+        """Look up compilation and execution time of the recorded queries in one statement.
+
+        Uses the query history of ``session``, so only queries run by that
+        session are found.
+        """
+        pending = {call.query_id: call for call in self.calls() if call.query_id and call.compilation_ms is None}
+        if not pending:
+            return
+        rows = session.sql(
+            f"""
+            SELECT QUERY_ID, COMPILATION_TIME, EXECUTION_TIME
+            FROM TABLE(INFORMATION_SCHEMA.QUERY_HISTORY_BY_SESSION(RESULT_LIMIT => 10000))
+            WHERE QUERY_ID IN ({', '.join('?' for _ in pending)})
+            """,
+            params=list(pending),
+        ).collect()
+        for row in rows:
+            call = pending[row["QUERY_ID"]]
+            call.compilation_ms = row["COMPILATION_TIME"]
+            call.execution_ms = row["EXECUTION_TIME"]
+
+    def summary(self):
+        """Return one row per model with call counts, latency percentiles and tokens."""
+        by_model = {}
+        for call in self.calls():
+            by_model.setdefault(call.model, []).append(call)
+
+        rows = []
+        for model, calls in sorted(by_model.items()):
+            latencies = [call.latency for call in calls]
+            first_tokens = [call.time_to_first_token for call in calls if call.time_to_first_token is not None]
+            rows.append({
+                "model": model,
+                "calls": len(calls),
+                "cache hit rate": sum(call.cache_status != "miss" for call in calls) / len(calls),
+                "p50 latency (s)": percentile(latencies, 0.5),
+                "p95 latency (s)": percentile(latencies, 0.95),
+                "p50 time to first token (s)": percentile(first_tokens, 0.5),
+                "p95 time to first token (s)": percentile(first_tokens, 0.95),
+                "prompt tokens": sum(call.prompt_tokens or 0 for call in calls),
+                "completion tokens": sum(call.completion_tokens or 0 for call in calls),
+            })
+        return rows
+
+
+def current_rss():
+    """Return the resident set size of this process, in bytes (the peak where it cannot be read)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * mmap.PAGESIZE
+    except OSError:
+        return peak_rss()
+
+
+def peak_rss():
+    """Return the peak resident set size of this process, in bytes, or 0 where it cannot be read."""
+    try:
+        import resource
+    except ImportError:
+        # The resource module is Unix-only: on Windows, use psutil's peak working set if installed
+        try:
+            import psutil
+        except ImportError:
+            return 0
+        return getattr(psutil.Process().memory_info(), "peak_wset", 0)
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_instrumented(session, statement, model, recorder, cache_status="miss"):
+    """Run a ``(sql, params)`` completion statement and record its metrics.
+
+    Returns the first column of the first row (the JSON response), like the
+    apps' own ``run_query`` functions.
+    """
+    sql, params = statement
+    started_at = time.perf_counter()
+    job = session.sql(sql, params=params).collect_nowait()
+    rows = job.result()
+    latency = time.perf_counter() - started_at
+    response = rows[0][0] if rows else None
+    recorder.record(CallRecord.from_response(model, response, latency, cache_status=cache_status,
+                                             query_id=job.query_id))
+    return response
+
+
+def prometheus_text(recorder):
+    """Render the recorded calls in the Prometheus text exposition format."""
+    lines = [
+        "# TYPE cortex_calls_total counter",
+        "# TYPE cortex_call_latency_seconds summary",
+        "# TYPE cortex_tokens_total counter",
+    ]
+    counts = {}
+    for call in recorder.calls():
+        key = (call.model, call.cache_status)
+        counts[key] = counts.get(key, 0) + 1
+    for (model, cache_status), count in sorted(counts.items()):
+        lines.append(f'cortex_calls_total{{model="{model}",cache_status="{cache_status}"}} {count}')
+    for row in recorder.summary():
+        model = row["model"]
+        latencies = [call.latency for call in recorder.calls() if call.model == model]
+        lines.append(f'cortex_call_latency_seconds_count{{model="{model}"}} {len(latencies)}')
+        lines.append(f'cortex_call_latency_seconds_sum{{model="{model}"}} {sum(latencies)}')
+        lines.append(f'cortex_call_latency_seconds{{model="{model}",quantile="0.5"}} {row["p50 latency (s)"]}')
+        lines.append(f'cortex_call_latency_seconds{{model="{model}",quantile="0.95"}} {row["p95 latency (s)"]}')
+        lines.append(f'cortex_tokens_total{{model="{model}",kind="prompt"}} {row["prompt tokens"]}')
+        lines.append(f'cortex_tokens_total{{model="{model}",kind="completion"}} {row["completion tokens"]}')
+    return "\n".join(lines) + "\n"
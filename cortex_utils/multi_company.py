@@ -0,0 +1,73 @@
+"""Parallel analysis of the 10-K filings of several companies.
+
+Asking one question about several companies used to mean running the app
+once per company, or sending every filing in a single prompt that no
+context window can hold. ``analyze_companies`` instead answers the question
+for each company on its own: the company's filings are fetched and the
+model queried concurrently for all companies, at most ``max_workers`` at a
+time. A synthesis call then compares the per-company answers. Wall-clock time
+is that of the slowest company plus one call, instead of growing with the
+number of companies.
+
+``analyze`` and ``complete`` are callables, so the same engine works with
+any of the apps' processing modes (single prompt, server-side prompt,
+map-reduce).
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+SYNTHESIS_PROMPT = """Below are answers to the same question, each based on the 10-K filings of a different company.
+Compare the companies and combine the answers into a single answer to the question. Keep figures and fiscal years, and say which company they come from.
+
+Question: {question}
+
+{analyses}"""
+
+
+@dataclass
+class CompanyAnalysis:
+    company_name: str
+    answer: str
+    elapsed: float
+    error: str = None
+
+
+@dataclass
+class MultiCompanyResult:
+    analyses: list
+    answer: str
+    elapsed: float
+
+
+def _timed(analyze, company_name):
+    started_at = time.perf_counter()
+    try:
+        answer = analyze(company_name)
+    except Exception as e:
+        # One failing company does not stop the others
+        return CompanyAnalysis(company_name, "", time.perf_counter() - started_at, str(e))
+    return CompanyAnalysis(company_name, answer or "", time.perf_counter() - started_at)
+
+
+def analyze_companies(company_names, question, analyze, complete, max_workers=8):
+    """Answer ``question`` for each of ``company_names`` concurrently, then combine the answers.
+
+    ``analyze(company_name)`` fetches one company's filings and returns the
+    answer text for that company; ``complete(prompt)`` returns the answer text
+    of the synthesis prompt. With a single company its answer is returned as
+    is, without a synthesis call.
+    """
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        analyses = list(executor.map(lambda company_name: _timed(analyze, company_name), company_names))
+
+    answered = [analysis for analysis in analyses if analysis.answer]
+    if len(answered) > 1:
+        answer = complete(SYNTHESIS_PROMPT.format(
+            question=question,
+            analyses="\n\n---\n\n".join(f"{analysis.company_name}:\n{analysis.answer.strip()}" for analysis in answered),
+        ))
+    else:
+        answer = answered[0].answer if answered else ""
+    return MultiCompanyResult(analyses, answer or "", time.perf_counter() - started_at)
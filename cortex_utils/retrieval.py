@@ -0,0 +1,291 @@
+"""Passage retrieval over long documents.
+
+Instead of sending whole filings to the model, a question can be answered from
+the top-k passages most similar to it. Documents are chunked once
+(section-aware, like the map-reduce engine), embedded and stored in a persisted
+index. Adding a document whose text has not changed is a no-op, so new filings
+are indexed incrementally.
+
+Two indexes are provided:
+
+- ``RetrievalIndex`` keeps the embeddings in a NumPy ``.npy`` matrix that is
+  memory-mapped for search, with the chunk texts in a JSON-lines file. It
+  embeds with a local CPU sentence-transformers model when one is installed,
+  and falls back to ``HashingEmbedder``, a dependency-free TF vector.
+- ``SnowflakeVectorIndex`` stores the chunks with ``VECTOR`` columns filled by
+  ``SNOWFLAKE.CORTEX.EMBED_TEXT_768`` and searches with
+  ``VECTOR_COSINE_SIMILARITY``, so nothing is embedded on the client.
+
+Both return the top-k chunks by score, or, with ``in_document_order``,
+grouped by document and in their order within it, so a prompt can present
+each document's passages together under its title.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+from cortex_utils.map_reduce import split_sections
+
+logger = logging.getLogger("cortex_utils.retrieval")
+
+# Chunk size (in tokens) of the indexed passages
+CHUNK_TOKENS = 800
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class HashingEmbedder:
+    """Embed text as an L2-normalised, log-scaled term-frequency vector.
+
+    Terms are hashed into ``dimensions`` buckets, so no vocabulary has to be
+    fitted and documents can be added one at a time.
+    """
+
+    name = "hashing-tf"
+
+    def __init__(self, dimensions=4096):
+        self.dimensions = dimensions
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in _TOKEN_RE.findall(text.lower()):
+                vectors[row, zlib.crc32(token.encode("utf-8")) % self.dimensions] += 1.0
+        np.log1p(vectors, out=vectors)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+class SentenceTransformerEmbedder:
+    """Embed text with a local sentence-transformers model on the CPU."""
+
+    def __init__(self, model_name="sentence-transformers/all-MiniLM-L6-v2"):
+        from sentence_transformers import SentenceTransformer
+
+        self.name = model_name
+        self._model = SentenceTransformer(model_name, device="cpu")
+
+    def embed(self, texts):
+        return self._model.encode(texts, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+
+def default_embedder():
+    """Return a local embedding model if sentence-transformers is installed, else ``HashingEmbedder``.
+
+    Also falls back when the model cannot be loaded, e.g. when it cannot be
+    downloaded behind a firewall.
+    """
+    try:
+        return SentenceTransformerEmbedder()
+    except (ImportError, OSError) as error:
+        logger.warning("Using HashingEmbedder, the sentence-transformers model is unavailable: %s", error)
+        return HashingEmbedder()
+
+
+class RetrievalIndex:
+    """Chunk embeddings persisted in ``directory`` and memory-mapped for search."""
+
+    def __init__(self, directory, embedder=None, chunk_tokens=CHUNK_TOKENS):
+        self.directory = directory
+        self.embedder = embedder or default_embedder()
+        self.chunk_tokens = chunk_tokens
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        self._manifest = self._load_json("manifest.json", {"embedder": self.embedder.name, "documents": {}})
+        if self._manifest["embedder"] != self.embedder.name:
+            # Vectors of another model cannot be compared with ours: start over
+            self._manifest = {"embedder": self.embedder.name, "documents": {}}
+            self._write_chunks([], None)
+        self._chunks = self._load_chunks()
+        self._embeddings = self._load_embeddings()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load_json(self, name, default):
+        try:
+            with open(self._path(name), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return default
+
+    def _load_chunks(self):
+        try:
+            with open(self._path("chunks.jsonl"), encoding="utf-8") as f:
+                return [json.loads(line) for line in f]
+        except FileNotFoundError:
+            return []
+
+    def _load_embeddings(self):
+        try:
+            return np.load(self._path("embeddings.npy"), mmap_mode="r")
+        except FileNotFoundError:
+            return None
+
+    def _write_chunks(self, chunks, embeddings):
+        with open(self._path("chunks.jsonl.tmp"), "w", encoding="utf-8") as f:
+            for chunk in chunks:
+                f.write(json.dumps(chunk) + "\n")
+        os.replace(self._path("chunks.jsonl.tmp"), self._path("chunks.jsonl"))
+        if embeddings is None:
+            if os.path.exists(self._path("embeddings.npy")):
+                os.remove(self._path("embeddings.npy"))
+        else:
+            np.save(self._path("embeddings.tmp.npy"), embeddings)
+            os.replace(self._path("embeddings.tmp.npy"), self._path("embeddings.npy"))
+        with open(self._path("manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(self._manifest, f)
+
+    def add_documents(self, documents):
+        """Index ``documents`` (a list of ``(doc_id, title, text)``).
+
+        Documents whose text is unchanged since they were indexed are skipped;
+        changed documents replace their previous chunks. Returns the number of
+        documents (re)indexed.
+        """
+        with self._lock:
+            changed = [
+                (doc_id, title, text) for doc_id, title, text in documents
+                if self._manifest["documents"].get(doc_id) != content_hash(text)
+            ]
+            if not changed:
+                return 0
+
+            changed_ids = {doc_id for doc_id, _, _ in changed}
+            keep = [i for i, chunk in enumerate(self._chunks) if chunk["doc_id"] not in changed_ids]
+            chunks = [self._chunks[i] for i in keep]
+            new_chunks = [
+                {"doc_id": doc_id, "title": title, "text": chunk}
+                for doc_id, title, text in changed
+                for chunk in split_sections(text, self.chunk_tokens)
+            ]
+            new_embeddings = self.embedder.embed([chunk["text"] for chunk in new_chunks])
+            if self._embeddings is not None and keep:
+                embeddings = np.concatenate([np.asarray(self._embeddings[keep]), new_embeddings])
+            else:
+                embeddings = new_embeddings
+
+            for doc_id, _, text in changed:
+                self._manifest["documents"][doc_id] = content_hash(text)
+            self._write_chunks(chunks + new_chunks, embeddings)
+            self._chunks = chunks + new_chunks
+            self._embeddings = self._load_embeddings()
+            return len(changed)
+
+    def search(self, question, k=8, doc_ids=None, in_document_order=False):
+        """Return the ``k`` chunks most similar to ``question`` as ``(title, text, score)``.
+
+        ``doc_ids`` restricts the search to some documents. The chunks are
+        ordered by score, or with ``in_document_order`` by title, document and
+        position in the document.
+        """
+        with self._lock:
+            if self._embeddings is None or not self._chunks:
+                return []
+            scores = np.asarray(self._embeddings @ self.embedder.embed([question])[0])
+            if doc_ids is not None:
+                allowed = np.array([chunk["doc_id"] in doc_ids for chunk in self._chunks])
+                scores = np.where(allowed, scores, -np.inf)
+            k = min(k, len(self._chunks))
+            top = np.argpartition(-scores, k - 1)[:k]
+            if in_document_order:
+                # Chunks are stored in document order, so their index is their position
+                top = sorted(top, key=lambda i: (self._chunks[i]["title"], self._chunks[i]["doc_id"], i))
+            else:
+                top = top[np.argsort(-scores[top])]
+            return [
+                (self._chunks[i]["title"], self._chunks[i]["text"], float(scores[i]))
+                for i in top if np.isfinite(scores[i])
+            ]
+
+
+class SnowflakeVectorIndex:
+    """Chunk embeddings stored in a Snowflake table with a ``VECTOR`` column."""
+
+    def __init__(self, session, table="DOCUMENT_CHUNKS", embedding_model="snowflake-arctic-embed-m",
+                 chunk_tokens=CHUNK_TOKENS):
+        self.session = session
+        self.table = table
+        self.embedding_model = embedding_model
+        self.chunk_tokens = chunk_tokens
+        self.session.sql(f"""
+            CREATE TABLE IF NOT EXISTS {self.table} (
+                DOC_ID STRING,
+                DOC_HASH STRING,
+                TITLE STRING,
+                CHUNK_INDEX NUMBER,
+                TEXT STRING,
+                EMBEDDING VECTOR(FLOAT, 768)
+            )
+        """).collect()
+
+    def add_documents(self, documents):
+        """Index ``documents`` (a list of ``(doc_id, title, text)``), skipping unchanged ones."""
+        indexed = {
+            row["DOC_ID"]: row["DOC_HASH"]
+            for row in self.session.sql(f"SELECT DISTINCT DOC_ID, DOC_HASH FROM {self.table}").collect()
+        }
+        changed = 0
+        for doc_id, title, text in documents:
+            doc_hash = content_hash(text)
+            if indexed.get(doc_id) == doc_hash:
+                continue
+            chunks = split_sections(text, self.chunk_tokens)
+            self.session.sql(f"DELETE FROM {self.table} WHERE DOC_ID = ?", params=[doc_id]).collect()
+            # The chunks are embedded by Snowflake in a single set-based statement
+            self.session.sql(
+                f"""
+                INSERT INTO {self.table}
+                SELECT ?, ?, ?, f.index, f.value::STRING,
+                       SNOWFLAKE.CORTEX.EMBED_TEXT_768('{self.embedding_model}', f.value::STRING)
+                FROM TABLE(FLATTEN(INPUT => PARSE_JSON(?))) f
+                """,
+                params=[doc_id, doc_hash, title, json.dumps(chunks)],
+            ).collect()
+            changed += 1
+        return changed
+
+    def search(self, question, k=8, doc_ids=None, in_document_order=False):
+        """Return the ``k`` chunks most similar to ``question`` as ``(title, text, score)``.
+
+        ``doc_ids`` restricts the search to some documents. The chunks are
+        ordered by score, or with ``in_document_order`` by title, document and
+        position in the document.
+        """
+        order = "TITLE, DOC_ID, CHUNK_INDEX" if in_document_order else "SCORE DESC"
+        params = [question]
+        where = ""
+        if doc_ids is not None:
+            doc_ids = list(doc_ids)
+            if not doc_ids:
+                return []
+            where = f"WHERE DOC_ID IN ({', '.join('?' for _ in doc_ids)})"
+            params += doc_ids
+        rows = self.session.sql(
+            f"""
+            SELECT TITLE, TEXT, SCORE FROM (
+                SELECT DOC_ID, CHUNK_INDEX, TITLE, TEXT,
+                       VECTOR_COSINE_SIMILARITY(
+                           EMBEDDING, SNOWFLAKE.CORTEX.EMBED_TEXT_768('{self.embedding_model}', ?)
+                       ) AS SCORE
+                FROM {self.table}
+                {where}
+                ORDER BY SCORE DESC
+                LIMIT {int(k)}
+            )
+            ORDER BY {order}
+            """,
+            params=params,
+        ).collect()
+        return [(row["TITLE"], row["TEXT"], row["SCORE"]) for row in rows]
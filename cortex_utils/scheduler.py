@@ -0,0 +1,327 @@
+"""Shared scheduler for Cortex and AI21 calls.
+
+Every completion used to be a synchronous ``session.sql(...).collect()``, so
+a throttled or briefly unavailable service surfaced as "No response", and
+concurrent callers (map-reduce, model comparisons, several users) could
+overrun a model's limits. The ``Scheduler`` runs calls on a thread pool and
+adds, per model:
+
+- a concurrency cap (a semaphore per model);
+- token-bucket rate limiting on prompt tokens per minute;
+- retries of transient errors with jittered exponential backoff;
+- deduplication: an identical prompt already in flight through a backend
+  with the same identity (for Cortex, the account and role) shares its
+  result instead of being sent again.
+
+The calls themselves go through a backend object with ``complete(model,
+messages, options)`` and ``stream(model, messages, options)`` methods.
+``CortexBackend`` calls Snowflake, ``AI21Backend`` the AI21 SDK, and
+``cortex_utils.fakes.FakeCortexBackend`` simulates Cortex locally, so the
+scheduler can be exercised without an account.
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cortex_utils.context import estimate_tokens
+from cortex_utils.data_cache import session_key
+from cortex_utils.metrics import run_instrumented
+from cortex_utils.sql import complete_sql, run_complete
+from cortex_utils.streaming import stream_ai21_chat, stream_complete
+
+# Error messages of throttled requests and transient service or network failures
+TRANSIENT_ERROR_RE = re.compile(
+    r"\b429\b|\b50[234]\b|too many requests|rate limit|throttl|temporarily unavailable|"
+    r"service unavailable|timed? ?out|connection (reset|aborted|refused)|try again",
+    re.IGNORECASE,
+)
+
+
+def is_transient(error):
+    """Return whether ``error`` is worth retrying."""
+    return isinstance(error, (ConnectionError, TimeoutError)) or bool(TRANSIENT_ERROR_RE.search(str(error)))
+
+
+def message_tokens(messages, count_tokens=estimate_tokens):
+    """Estimate the prompt tokens of ``messages`` (content may be a list of parts)."""
+    total = 0
+    for message in messages:
+        content = message["content"]
+        parts = [content] if isinstance(content, str) else content
+        total += sum(count_tokens(part) for part in parts)
+    return total
+
+
+def request_key(model, messages, options):
+    """Return a key identifying a completion request, used to deduplicate it."""
+    payload = json.dumps([model, messages, options], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RetryPolicy:
+    """Jittered exponential backoff ("full jitter") for transient errors."""
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=30.0, retryable=is_transient):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retryable = retryable
+
+    def delay(self, attempt):
+        """Return the delay before retry number ``attempt`` (starting at 0)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+def retry_call(fn, policy=None, sleep=time.sleep):
+    """Call ``fn()``, retrying transient errors according to ``policy``."""
+    policy = policy or RetryPolicy()
+    for attempt in range(policy.max_attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == policy.max_attempts - 1 or not policy.retryable(e):
+                raise
+            sleep(policy.delay(attempt))
+
+
+class TokenBucket:
+    """Allow up to ``tokens_per_minute`` tokens per minute, with bursts of one minute's worth."""
+
+    def __init__(self, tokens_per_minute, clock=time.monotonic, sleep=time.sleep):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self.clock = clock
+        self.sleep = sleep
+        self._level = tokens_per_minute
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens):
+        """Block until ``tokens`` are available and take them. Returns the time waited."""
+        # A request larger than the bucket would never fit: let it through on a full bucket
+        tokens = min(tokens, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._level = min(self.capacity, self._level + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._level >= tokens:
+                    self._level -= tokens
+                    return waited
+                wait = (tokens - self._level) / self.rate
+            self.sleep(wait)
+            waited += wait
+
+
+class CortexBackend:
+    """Run completions in Snowflake with ``CORTEX.COMPLETE``.
+
+    With a ``recorder`` (``cortex_utils.metrics.CallRecorder``) every call is
+    instrumented.
+    """
+
+    def __init__(self, session, recorder=None):
+        self.session = session
+        self.recorder = recorder
+        self._identity = None
+
+    @property
+    def identity(self):
+        """The account and role the calls run as; backends with the same identity share in-flight calls."""
+        if self._identity is None:
+            self._identity = ("cortex",) + tuple(session_key(self.session))
+        return self._identity
+
+    def complete(self, model, messages, options):
+        if self.recorder is None:
+            return run_complete(self.session, model, messages, options)
+        return run_instrumented(self.session, complete_sql(model, messages, options), model, self.recorder)
+
+    def stream(self, model, messages, options):
+        # The streaming (REST) endpoint takes plain strings and has no bind parameters,
+        # so a prompt given as parts is joined here, once, when the request is sent
+        messages = [
+            dict(message, content=message["content"] if isinstance(message["content"], str)
+                 else "".join(message["content"]))
+            for message in messages
+        ]
+        return stream_complete(self.session, model, messages, options)
+
+
+class AI21Backend:
+    """Run completions with the AI21 SDK; responses are returned in the ``CORTEX.COMPLETE`` JSON shape."""
+
+    def __init__(self, client):
+        self.client = client
+        # The client itself, not its id(), so the key cannot match a later client at the same address
+        self.identity = ("ai21", client)
+
+    def _messages(self, messages):
+        from ai21.models.chat import ChatMessage
+
+        return [
+            ChatMessage(role=message["role"], content=message["content"] if isinstance(message["content"], str)
+                        else "".join(message["content"]))
+            for message in messages
+        ]
+
+    def complete(self, model, messages, options):
+        response = self.client.chat.completions.create(model=model, messages=self._messages(messages), **options)
+        return json.dumps({
+            "choices": [{"messages": response.choices[0].message.content}],
+            "model": model,
+            "usage": {
+                "prompt_tokens": response.usage.prompt_tokens,
+                "completion_tokens": response.usage.completion_tokens,
+                "total_tokens": response.usage.total_tokens,
+            },
+        })
+
+    def stream(self, model, messages, options):
+        return stream_ai21_chat(self.client, model, self._messages(messages), **options)
+
+
+class Scheduler:
+    """Run model calls with per-model concurrency caps, rate limits, retries and deduplication.
+
+    ``concurrency`` and ``tokens_per_minute`` map model names to limits;
+    models missing from them get ``default_concurrency`` and
+    ``default_tokens_per_minute`` (``None`` means no rate limit).
+    """
+
+    def __init__(self, max_workers=16, concurrency=None, default_concurrency=4,
+                 tokens_per_minute=None, default_tokens_per_minute=None, retry=None,
+                 count_tokens=estimate_tokens, clock=time.monotonic, sleep=time.sleep):
+        self.concurrency = dict(concurrency or {})
+        self.default_concurrency = default_concurrency
+        self.tokens_per_minute = dict(tokens_per_minute or {})
+        self.default_tokens_per_minute = default_tokens_per_minute
+        self.retry = retry or RetryPolicy()
+        self.count_tokens = count_tokens
+        self.clock = clock
+        self.sleep = sleep
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cortex-scheduler")
+        self._semaphores = {}
+        self._buckets = {}
+        self._in_flight = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _limits(self, model):
+        with self._lock:
+            if model not in self._semaphores:
+                self._semaphores[model] = threading.BoundedSemaphore(
+                    self.concurrency.get(model, self.default_concurrency))
+                tokens_per_minute = self.tokens_per_minute.get(model, self.default_tokens_per_minute)
+                self._buckets[model] = (
+                    TokenBucket(tokens_per_minute, self.clock, self.sleep) if tokens_per_minute else None
+                )
+                self._stats[model] = {"calls": 0, "retries": 0, "failures": 0, "deduplicated": 0,
+                                      "rate limit wait (s)": 0.0}
+            return self._semaphores[model], self._buckets[model]
+
+    def _count(self, model, name, amount=1):
+        with self._lock:
+            self._stats[model][name] += amount
+
+    def _run(self, model, fn, tokens):
+        semaphore, bucket = self._limits(model)
+        for attempt in range(self.retry.max_attempts):
+            if bucket is not None:
+                self._count(model, "rate limit wait (s)", bucket.acquire(tokens))
+            with semaphore:
+                self._count(model, "calls")
+                try:
+                    return fn()
+                except Exception as e:
+                    if attempt == self.retry.max_attempts - 1 or not self.retry.retryable(e):
+                        self._count(model, "failures")
+                        raise
+            # Back off outside the semaphore so other calls can use the slot
+            self._count(model, "retries")
+            self.sleep(self.retry.delay(attempt))
+
+    def submit(self, model, fn, tokens=0, key=None):
+        """Schedule ``fn()``, a call to ``model`` of about ``tokens`` prompt tokens.
+
+        Returns a ``Future``. If ``key`` is given and a call with the same key
+        is still in flight, its future is returned instead of calling ``fn``
+        again.
+        """
+        self._limits(model)
+        with self._lock:
+            if key is not None and key in self._in_flight:
+                self._stats[model]["deduplicated"] += 1
+                return self._in_flight[key]
+            future = self._executor.submit(self._run, model, fn, tokens)
+            if key is not None:
+                self._in_flight[key] = future
+        if key is not None:
+            future.add_done_callback(lambda _: self._forget(key, future))
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def run(self, model, fn, tokens=0):
+        """Run ``fn()`` within ``model``'s limits and return its result."""
+        return self.submit(model, fn, tokens).result()
+
+    def submit_complete(self, backend, model, messages, options):
+        """Schedule ``backend.complete(model, messages, options)`` and return a ``Future``.
+
+        An identical request already in flight through a backend with the same
+        ``identity`` is not sent again: its future is returned.
+        """
+        return self.submit(
+            model,
+            lambda: backend.complete(model, messages, options),
+            tokens=message_tokens(messages, self.count_tokens),
+            # Backends without an identity are only deduplicated with themselves
+            key=(getattr(backend, "identity", backend), request_key(model, messages, options)),
+        )
+
+    def complete(self, backend, model, messages, options):
+        """Run ``backend.complete(model, messages, options)`` and return its response."""
+        return self.submit_complete(backend, model, messages, options).result()
+
+    def stream(self, backend, model, messages, options):
+        """Yield the chunks of ``backend.stream(model, messages, options)`` within the model's limits.
+
+        The concurrency slot is held until the stream ends. Transient errors
+        are retried only before the first chunk, so no text is repeated.
+        """
+        semaphore, bucket = self._limits(model)
+        tokens = message_tokens(messages, self.count_tokens)
+        for attempt in range(self.retry.max_attempts):
+            if bucket is not None:
+                self._count(model, "rate limit wait (s)", bucket.acquire(tokens))
+            started = False
+            with semaphore:
+                self._count(model, "calls")
+                try:
+                    for chunk in backend.stream(model, messages, options):
+                        started = True
+                        yield chunk
+                    return
+                except Exception as e:
+                    if started or attempt == self.retry.max_attempts - 1 or not self.retry.retryable(e):
+                        self._count(model, "failures")
+                        raise
+            self._count(model, "retries")
+            self.sleep(self.retry.delay(attempt))
+
+    def stats(self):
+        """Return one row per model with its call, retry, failure and deduplication counts."""
+        with self._lock:
+            return [dict(model=model, **stats) for model, stats in sorted(self._stats.items())]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
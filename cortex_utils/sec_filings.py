@@ -0,0 +1,285 @@
+"""Incremental ingestion of SEC 10-K filings into a local chunked store.
+
+The apps used to re-read the full filing text from
+``SEC_FILINGS.CYBERSYN.SEC_REPORT_TEXT_ATTRIBUTES`` on every run. ``ingest``
+instead watches ``SEC_REPORT_INDEX`` for 10-K rows of the requested fiscal
+years filed since the FILED_DATE watermark of each company and fiscal year.
+It first compares their text hashes (computed in Snowflake) with the store,
+then downloads only the new or changed filings. A fiscal year without a
+filing gets an empty watermark, so it is not looked up again on every run.
+Each filing is saved with derived artifacts: its 10-K Item sections and
+per-section token counts. At question time the apps read filings from the
+store instead of doing bulk reads from the warehouse.
+
+Store layout::
+
+    <root>/state.json                       FILED_DATE watermark per company and fiscal year
+    <root>/<CIK>/<SEC_DOCUMENT_ID>/text.txt filing text
+    <root>/<CIK>/<SEC_DOCUMENT_ID>/meta.json company, dates, hash, sections
+
+Run it for a list of companies, e.g. from a scheduled job::
+
+    python -m cortex_utils.sec_filings --store ./sec_store "NVIDIA CORP" "APPLE INC" --fiscal-years 2022 2023
+"""
+import argparse
+import json
+import os
+import threading
+
+from cortex_utils.context import estimate_tokens
+from cortex_utils.map_reduce import SECTION_HEADING_RE
+
+FILINGS_SQL = """
+SELECT A.SEC_DOCUMENT_ID, B.CIK, B.COMPANY_NAME, B.FISCAL_YEAR, B.FILED_DATE, A.PERIOD_END_DATE,
+       SHA2(A.VALUE, 256) AS TEXT_HASH
+FROM "SEC_FILINGS"."CYBERSYN".SEC_REPORT_TEXT_ATTRIBUTES A
+JOIN "SEC_FILINGS"."CYBERSYN".SEC_REPORT_INDEX B
+  ON A.ADSH = B.ADSH
+WHERE B.FORM_TYPE = '10-K'
+  AND A.VARIABLE_NAME = '10-K Filing Text'
+  AND ({company_filter})
+"""
+
+TEXT_SQL = """
+SELECT SEC_DOCUMENT_ID, VALUE
+FROM "SEC_FILINGS"."CYBERSYN".SEC_REPORT_TEXT_ATTRIBUTES
+WHERE VARIABLE_NAME = '10-K Filing Text'
+  AND SEC_DOCUMENT_ID IN ({placeholders})
+"""
+
+
+def split_filing_sections(text):
+    """Return the Item sections of a filing as ``{title, start, end, tokens}`` dicts."""
+    starts = [match.start() for match in SECTION_HEADING_RE.finditer(text)]
+    bounds = [0] + [start for start in starts if start > 0] + [len(text)]
+    sections = []
+    for begin, end in zip(bounds, bounds[1:]):
+        body = text[begin:end]
+        if not body.strip():
+            continue
+        title = body.strip().splitlines()[0][:120] if begin in starts else "Preamble"
+        sections.append({"title": title, "start": begin, "end": end, "tokens": estimate_tokens(body)})
+    return sections
+
+
+def _write_atomic(path, content):
+    """Write ``content`` to a temporary file next to ``path``, then replace ``path`` with it."""
+    # One temporary file per writer, as two sessions may store the same filing
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+class FilingStore:
+    """Filings and their derived artifacts on local disk."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _state_path(self):
+        return os.path.join(self.root, "state.json")
+
+    def _filing_dir(self, cik, sec_document_id):
+        return os.path.join(self.root, str(cik), str(sec_document_id))
+
+    def watermarks(self):
+        """Return ``{company_name: {fiscal_year: filed_date}}``; the date is ``""`` for a year without filings.
+
+        Fiscal years are strings, as in the JSON state file.
+        """
+        try:
+            with open(self._state_path(), encoding="utf-8") as f:
+                watermarks = json.load(f)
+        except FileNotFoundError:
+            return {}
+        # Stores written before per-year watermarks hold one date per company: their
+        # companies are rechecked by hash, without downloading unchanged text
+        return {company_name: marks for company_name, marks in watermarks.items() if isinstance(marks, dict)}
+
+    def missing_years(self, company_name, fiscal_years):
+        """Return the fiscal years of ``fiscal_years`` that were never checked for ``company_name``."""
+        marks = self.watermarks().get(company_name, {})
+        return [fiscal_year for fiscal_year in fiscal_years if str(fiscal_year) not in marks]
+
+    def set_watermarks(self, watermarks):
+        tmp_path = f"{self._state_path()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(watermarks, f, indent=2)
+        os.replace(tmp_path, self._state_path())
+
+    def advance_watermarks(self, filed_dates):
+        """Raise each watermark of ``filed_dates`` (``{company_name: {fiscal_year: filed_date}}``), if later.
+
+        A company or fiscal year seen for the first time is recorded even with
+        an empty date. Safe to call from concurrent ingests of different
+        companies.
+        """
+        with self._lock:
+            watermarks = self.watermarks()
+            for company_name, dates in filed_dates.items():
+                marks = watermarks.setdefault(company_name, {})
+                for fiscal_year, filed_date in dates.items():
+                    marks[str(fiscal_year)] = max(filed_date, marks.get(str(fiscal_year), ""))
+            self.set_watermarks(watermarks)
+
+    def text_hash(self, cik, sec_document_id):
+        meta = self.load_meta(cik, sec_document_id)
+        return meta["text_hash"] if meta else None
+
+    def load_meta(self, cik, sec_document_id):
+        try:
+            with open(os.path.join(self._filing_dir(cik, sec_document_id), "meta.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def load_text(self, cik, sec_document_id):
+        with open(os.path.join(self._filing_dir(cik, sec_document_id), "text.txt"), encoding="utf-8") as f:
+            return f.read()
+
+    def save(self, meta, text):
+        """Store a filing; readers see either the previous or the new text and metadata, never a partial file."""
+        directory = self._filing_dir(meta["cik"], meta["sec_document_id"])
+        os.makedirs(directory, exist_ok=True)
+        _write_atomic(os.path.join(directory, "text.txt"), text)
+        meta = dict(meta, tokens=estimate_tokens(text), sections=split_filing_sections(text))
+        # meta.json is written last: a filing without it is treated as missing
+        _write_atomic(os.path.join(directory, "meta.json"), json.dumps(meta, indent=2))
+
+    def filings(self, company_names=None, fiscal_years=None):
+        """Return the metadata of the stored filings, by company then most recent first."""
+        found = []
+        for cik in os.listdir(self.root):
+            cik_dir = os.path.join(self.root, cik)
+            if not os.path.isdir(cik_dir):
+                continue
+            for sec_document_id in os.listdir(cik_dir):
+                meta = self.load_meta(cik, sec_document_id)
+                if meta is None:
+                    continue
+                if company_names is not None and meta["company_name"] not in company_names:
+                    continue
+                if fiscal_years is not None and meta["fiscal_year"] not in fiscal_years:
+                    continue
+                found.append(meta)
+        found.sort(key=lambda meta: (meta["filed_date"], meta["period_end_date"]), reverse=True)
+        return sorted(found, key=lambda meta: meta["company_name"])
+
+    def rows(self, company_names=None, fiscal_years=None):
+        """Return the stored filings shaped like rows of the apps' ``sec_query``."""
+        return [
+            {
+                "SEC_DOCUMENT_ID": meta["sec_document_id"],
+                "VARIABLE_NAME": "10-K Filing Text",
+                "CIK": meta["cik"],
+                "COMPANY_NAME": meta["company_name"],
+                "FILED_DATE": meta["filed_date"],
+                "PERIOD_END_DATE": meta["period_end_date"],
+                "FISCAL_YEAR": meta["fiscal_year"],
+                "VALUE": self.load_text(meta["cik"], meta["sec_document_id"]),
+            }
+            for meta in self.filings(company_names, fiscal_years)
+        ]
+
+
+def ingest(session, store, company_names, fiscal_years=None, full_refresh=False):
+    """Bring ``store`` up to date with the 10-K filings of ``company_names`` for ``fiscal_years``.
+
+    ``fiscal_years=None`` means every fiscal year. Only filings filed on or
+    after the watermark of their company and fiscal year are considered,
+    unless ``full_refresh`` is set, in which case every filing's hash is
+    rechecked (still without downloading unchanged text). Returns the
+    metadata of the filings that were added or updated.
+    """
+    watermarks = {} if full_refresh else store.watermarks()
+    filters = []
+    params = []
+    for company_name in company_names:
+        marks = watermarks.get(company_name, {})
+        if fiscal_years is None:
+            filed_dates = [filed_date for filed_date in marks.values() if filed_date]
+            if filed_dates:
+                filters.append("(B.COMPANY_NAME = ? AND B.FILED_DATE >= ?)")
+                params += [company_name, max(filed_dates)]
+            else:
+                filters.append("B.COMPANY_NAME = ?")
+                params.append(company_name)
+            continue
+        unseen = []
+        for fiscal_year in fiscal_years:
+            if marks.get(str(fiscal_year)):
+                filters.append("(B.COMPANY_NAME = ? AND B.FISCAL_YEAR = ? AND B.FILED_DATE >= ?)")
+                params += [company_name, fiscal_year, marks[str(fiscal_year)]]
+            else:
+                unseen.append(fiscal_year)
+        if unseen:
+            filters.append(f"(B.COMPANY_NAME = ? AND B.FISCAL_YEAR IN ({', '.join('?' for _ in unseen)}))")
+            params += [company_name] + list(unseen)
+    if not filters:
+        return []
+
+    candidates = session.sql(FILINGS_SQL.format(company_filter=" OR ".join(filters)), params=params).collect()
+    changed = [
+        row for row in candidates
+        if store.text_hash(row["CIK"], row["SEC_DOCUMENT_ID"]) != row["TEXT_HASH"]
+    ]
+
+    updated = []
+    if changed:
+        texts = session.sql(
+            TEXT_SQL.format(placeholders=", ".join("?" for _ in changed)),
+            params=[row["SEC_DOCUMENT_ID"] for row in changed],
+        ).collect()
+        text_by_id = {row["SEC_DOCUMENT_ID"]: row["VALUE"] for row in texts}
+        for row in changed:
+            if row["SEC_DOCUMENT_ID"] not in text_by_id:
+                continue
+            meta = {
+                "sec_document_id": row["SEC_DOCUMENT_ID"],
+                "cik": row["CIK"],
+                "company_name": row["COMPANY_NAME"],
+                "fiscal_year": row["FISCAL_YEAR"],
+                "filed_date": row["FILED_DATE"].isoformat(),
+                "period_end_date": row["PERIOD_END_DATE"].isoformat(),
+                "text_hash": row["TEXT_HASH"],
+            }
+            store.save(meta, text_by_id[row["SEC_DOCUMENT_ID"]])
+            updated.append(meta)
+
+    # Advance the watermark of each company and fiscal year to its most recent filing. Companies
+    # and requested years without filings get an empty one, so they are not queried on every run.
+    filed_dates = {
+        company_name: {str(fiscal_year): "" for fiscal_year in fiscal_years or ()}
+        for company_name in company_names
+    }
+    for row in candidates:
+        marks = filed_dates.setdefault(row["COMPANY_NAME"], {})
+        fiscal_year = str(row["FISCAL_YEAR"])
+        marks[fiscal_year] = max(row["FILED_DATE"].isoformat(), marks.get(fiscal_year, ""))
+    store.advance_watermarks(filed_dates)
+    return updated
+
+
+def main():
+    from snowflake.snowpark import Session
+
+    parser = argparse.ArgumentParser(description="Ingest new SEC 10-K filings into a local store.")
+    parser.add_argument("companies", nargs="+", help="Company names as in SEC_REPORT_INDEX, e.g. 'NVIDIA CORP'.")
+    parser.add_argument("--store", default="sec_store", help="Directory of the local filing store.")
+    parser.add_argument("--fiscal-years", type=int, nargs="+", help="Fiscal years to ingest (default: all).")
+    parser.add_argument("--full-refresh", action="store_true",
+                        help="Recheck the hash of every filing, not only those filed since the watermark.")
+    args = parser.parse_args()
+
+    session = Session.builder.getOrCreate()
+    updated = ingest(session, FilingStore(args.store), args.companies, args.fiscal_years, args.full_refresh)
+    for meta in updated:
+        print(f"{meta['company_name']} FY{meta['fiscal_year']} ({meta['filed_date']}): {meta['sec_document_id']}")
+    print(f"{len(updated)} filings added or updated")
+
+
+if __name__ == "__main__":
+    main()
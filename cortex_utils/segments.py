@@ -0,0 +1,90 @@
+"""Merge summarize-by-segment output down to a chosen number of segments.
+
+``get_user_defined_segments`` in
+``summarize_text_custom_segments/Summarize_Provided_Link.ipynb`` repeatedly
+finds the shortest segment with ``idxmin`` and merges it into its shorter
+neighbour, rebuilding the DataFrame after every merge. That is O(n²), with
+pandas overhead on every step. ``merge_segment_ranges`` makes the same
+merges with a heap of segment lengths and a doubly linked list of
+neighbours, in O(n log n):
+
+- the shortest segment is merged into its shorter neighbour: into the right
+  one if it is the first segment, into the left one if it is the last, and
+  into the left one when both neighbours have the same length;
+- among segments of equal length the first one is merged first, as with
+  ``idxmin``;
+- merged texts are joined with a single space, and a merged segment's length
+  is the length of the joined text.
+
+A merged segment always covers consecutive input segments, so the result is
+a list of ranges, and each text is joined once at the end instead of being
+copied on every merge. ``merge_shortest_segments`` applies the ranges to a
+DataFrame and returns the same rows as the notebook's function.
+"""
+import heapq
+
+import numpy as np
+
+
+def merge_segment_ranges(lengths, desired_segments):
+    """Return the ``(start, end)`` ranges of input segments that make up each merged segment.
+
+    ``lengths`` are the text lengths of the segments in order. Segments are
+    merged until at most ``desired_segments`` remain; ``end`` is exclusive.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64).copy()
+    count = len(lengths)
+    if count <= desired_segments:
+        return [(index, index + 1) for index in range(count)]
+    if desired_segments < 1:
+        return []
+
+    previous = np.arange(-1, count - 1)
+    following = np.arange(1, count + 1)
+    following[-1] = -1
+    ends = np.arange(1, count + 1)
+    alive = np.ones(count, dtype=bool)
+    # Segments keep their input order, so the segment id breaks ties like idxmin does
+    heap = list(zip(lengths.tolist(), range(count)))
+    heapq.heapify(heap)
+
+    remaining = count
+    while remaining > desired_segments:
+        length, shortest = heapq.heappop(heap)
+        if not alive[shortest] or length != lengths[shortest]:
+            # Stale entry: the segment was merged away or has grown since
+            continue
+        left, right = previous[shortest], following[shortest]
+        if left == -1 or (right != -1 and lengths[right] < lengths[left]):
+            # Merge the right neighbour into the shortest segment
+            survivor, merged = shortest, right
+        else:
+            # Merge the shortest segment into its left neighbour
+            survivor, merged = left, shortest
+
+        lengths[survivor] += 1 + lengths[merged]
+        ends[survivor] = ends[merged]
+        alive[merged] = False
+        following[survivor] = following[merged]
+        if following[merged] != -1:
+            previous[following[merged]] = survivor
+        heapq.heappush(heap, (int(lengths[survivor]), int(survivor)))
+        remaining -= 1
+
+    starts = np.flatnonzero(alive)
+    return list(zip(starts.tolist(), ends[starts].tolist()))
+
+
+def merge_shortest_segments(df, desired_segments, text_column="SegmentText", join_columns=("Summary", "SegmentText")):
+    """Return ``df`` with its shortest segments merged until ``desired_segments`` rows remain.
+
+    Lengths are taken from ``text_column``; the values of ``join_columns``
+    are joined with a space, and other columns keep the value of the first
+    merged row. ``df`` itself is not modified.
+    """
+    ranges = merge_segment_ranges(df[text_column].str.len().to_numpy(), desired_segments)
+    merged = df.iloc[[start for start, _ in ranges]].reset_index(drop=True)
+    for column in join_columns:
+        values = df[column].tolist()
+        merged[column] = [" ".join(values[start:end]) for start, end in ranges]
+    return merged
@@ -0,0 +1,91 @@
+"""Submit Cortex prompts through bind parameters.
+
+Inlining a prompt into the SQL text (``f"... '{escape_quotes(prompt)}' ..."``)
+makes every statement a unique multi-megabyte SQL text. Snowflake has to parse
+and compile that text, and can never reuse the plan. On the client, every
+``replace`` makes another full copy of the document. With bind parameters the
+SQL text stays a few hundred bytes and is identical for every question, and
+the prompt travels as a value.
+
+A message's content may be a list of parts (question, then one part per
+document). The parts are bound separately and concatenated by Snowflake, so
+Python never builds the concatenated context.
+"""
+import json
+
+
+def _escape_literal(value):
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+
+def _content_sql(content):
+    if isinstance(content, str):
+        return "?", [content]
+    return f"ARRAY_TO_STRING(ARRAY_CONSTRUCT({', '.join('?' for _ in content)}), '')", list(content)
+
+
+def complete_sql(model, messages, options):
+    """Return ``(sql, params)`` calling ``SNOWFLAKE.CORTEX.COMPLETE``.
+
+    ``messages`` is a list of ``{'role': ..., 'content': ...}`` dicts, where
+    ``content`` is a string or a list of strings to concatenate in SQL.
+    """
+    message_sql = []
+    params = []
+    for message in messages:
+        content_sql, content_params = _content_sql(message["content"])
+        message_sql.append(f"OBJECT_CONSTRUCT('role', ?, 'content', {content_sql})")
+        params += [message["role"]] + content_params
+    # The model and options are small and fixed for an app, so they stay literals:
+    # the SQL text is still identical for every question asked of the same model
+    sql = f"""
+    SELECT SNOWFLAKE.CORTEX.COMPLETE(
+        '{_escape_literal(model)}',
+        ARRAY_CONSTRUCT({', '.join(message_sql)}),
+        PARSE_JSON('{_escape_literal(json.dumps(options))}')
+    ) AS RESPONSE
+    """
+    return sql, params
+
+
+def run_complete(session, model, messages, options):
+    """Run ``CORTEX.COMPLETE`` with bound prompts and return the JSON response string."""
+    sql, params = complete_sql(model, messages, options)
+    result = session.sql(sql, params=params).collect()
+    return result[0]["RESPONSE"] if result else None
+
+
+def complete_over_documents_sql(model, question, documents_sql, document_expr, order_by, options,
+                                documents_params=(), system_prompt=None, separator=" "):
+    """Return ``(sql, params)`` answering ``question`` over documents that stay in Snowflake.
+
+    The prompt is assembled inside the statement: ``documents_sql`` selects
+    the documents, ``LISTAGG`` joins ``document_expr`` over them in
+    ``order_by`` order, and the result is appended to the question and fed
+    straight into ``CORTEX.COMPLETE``. Only the answer is sent back to the
+    client, instead of downloading the documents and uploading them again
+    inside the prompt.
+    """
+    messages_sql = []
+    params = []
+    if system_prompt is not None:
+        messages_sql.append("OBJECT_CONSTRUCT('role', 'system', 'content', ?)")
+        params.append(system_prompt)
+    messages_sql.append("OBJECT_CONSTRUCT('role', 'user', 'content', CONCAT(?, context.text))")
+    params.append(question)
+    sql = f"""
+    WITH documents AS (
+        SELECT * FROM ({documents_sql})
+    ),
+    context AS (
+        SELECT LISTAGG({document_expr}, '{_escape_literal(separator)}') WITHIN GROUP (ORDER BY {order_by}) AS text
+        FROM documents
+    )
+    SELECT SNOWFLAKE.CORTEX.COMPLETE(
+        '{_escape_literal(model)}',
+        ARRAY_CONSTRUCT({', '.join(messages_sql)}),
+        PARSE_JSON('{_escape_literal(json.dumps(options))}')
+    ) AS RESPONSE
+    FROM context
+    """
+    return sql, list(documents_params) + params
@@ -0,0 +1,88 @@
+"""Streaming completions for the Streamlit apps.
+
+``SNOWFLAKE.CORTEX.COMPLETE`` called through ``session.sql(...).collect()``
+only returns once the whole completion has been generated. The generators in
+this module yield text chunks as soon as the model produces them, so an app can
+render the answer with ``st.write_stream`` while it is still being written.
+
+``TimedStream`` wraps any of these generators and records time-to-first-token
+and total generation time.
+"""
+import json
+import time
+
+from cortex_utils.context import estimate_tokens
+
+
+def stream_complete(session, model, messages, options=None):
+    """Yield text chunks from the Cortex streaming (REST) endpoint.
+
+    ``messages`` is a list of ``{'role': ..., 'content': ...}`` dicts and
+    ``options`` holds generation options such as ``temperature`` and
+    ``max_tokens``. Requires the ``snowflake-ml-python`` package, which is
+    available in Streamlit in Snowflake.
+    """
+    from snowflake.cortex import complete
+
+    yield from complete(model, messages, options=options, session=session, stream=True)
+
+
+def stream_ai21_chat(client, model, messages, **kwargs):
+    """Yield text chunks from an AI21 SDK chat completion stream.
+
+    ``client`` is an ``ai21.AI21Client``; ``messages`` are
+    ``ai21.models.chat.ChatMessage`` objects. Extra keyword arguments
+    (``temperature``, ``max_tokens``...) are passed to the SDK unchanged.
+    """
+    response = client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs)
+    for chunk in response:
+        content = chunk.choices[0].delta.content
+        if content:
+            yield content
+
+
+class TimedStream:
+    """Iterate over a text stream while timing it and collecting the text."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._parts = []
+        self.started_at = None
+        self.time_to_first_token = None
+        self.elapsed = None
+
+    def __iter__(self):
+        self.started_at = time.perf_counter()
+        for chunk in self._chunks:
+            if self.time_to_first_token is None:
+                self.time_to_first_token = time.perf_counter() - self.started_at
+            self._parts.append(chunk)
+            yield chunk
+        self.elapsed = time.perf_counter() - self.started_at
+
+    @property
+    def text(self):
+        return "".join(self._parts)
+
+    def response_json(self, model, prompt_tokens=None):
+        """Return the streamed answer in the JSON shape returned by CORTEX.COMPLETE.
+
+        The streaming endpoint reports no token counts. Given the estimated
+        ``prompt_tokens``, the response has a ``usage`` block with the
+        completion estimated from the text, marked ``"estimated": true``.
+        """
+        response = {
+            "choices": [{"messages": self.text}],
+            "model": model,
+            "time_to_first_token": self.time_to_first_token,
+            "elapsed": self.elapsed,
+        }
+        if prompt_tokens is not None:
+            completion_tokens = estimate_tokens(self.text)
+            response["usage"] = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "estimated": True,
+            }
+        return json.dumps(response)
@@ -0,0 +1,276 @@
+"""Precompute plan comparisons for every pair of HMO2 plans.
+
+The Insurance Plan Comparison app compares two plans for one question per
+click. This batch job answers every pair of plans in ``INSURANCE.PUBLIC.HMO2``
+for each pre-canned question ahead of time, for example from a nightly task,
+and stores the answers in ``INSURANCE.PUBLIC.HMO2_COMPARISONS``. The app reads
+that table before calling the model.
+
+Everything runs server-side. The comparison matrix is a table of prompts,
+and each batch is a single ``INSERT ... SELECT`` that calls
+``CORTEX.TRY_COMPLETE`` over that table rather than issuing one round trip per
+comparison. Every batch commits on its own, so an interrupted or partially
+failed run resumes where it stopped when it is started again. Failed
+comparisons return NULL: their attempts are counted in
+``INSURANCE.PUBLIC.HMO2_COMPARISON_FAILURES``, pending prompts are answered
+fewest attempts first, and prompts that failed ``--max-attempts`` times are
+skipped and reported instead of being re-sent by every batch. Answers are keyed on the
+hash of both plans' details, so a comparison is recomputed when a plan
+changes. Batches run through a ``cortex_utils.scheduler.Scheduler``, with an
+estimate of their prompt tokens, so the model's concurrency cap and
+tokens-per-minute limit apply to them, and batches that fail with a transient
+error (throttling, warehouse unavailable) are retried with jittered
+exponential backoff.
+
+Usage (connection parameters are read from ``~/.snowflake/connections.toml``)::
+
+    python insurance_batch_compare.py --batch-size 50 --tokens-per-minute 2000000 --max-attempts 3
+"""
+import argparse
+import json
+import math
+
+from snowflake.snowpark import Session
+from snowflake.snowpark.exceptions import SnowparkSQLException
+
+from cortex_utils.scheduler import Scheduler
+
+PLANS_TABLE = "INSURANCE.PUBLIC.HMO2"
+PROMPTS_TABLE = "INSURANCE.PUBLIC.HMO2_COMPARISON_PROMPTS"
+RESULTS_TABLE = "INSURANCE.PUBLIC.HMO2_COMPARISONS"
+FAILURES_TABLE = "INSURANCE.PUBLIC.HMO2_COMPARISON_FAILURES"
+BATCH_TABLE = "INSURANCE.PUBLIC.HMO2_COMPARISON_BATCH"
+
+MODEL = 'jamba-1.5-large'
+OPTIONS = {'temperature': 0.3, 'max_tokens': 5000}
+
+# Pre-canned questions offered by the app, answered for every pair of plans
+PRE_CANNED_QUESTIONS = [
+    "I need an in-patient procedure, help me choose which plan is best for me?",
+    "Which healthcare plan should I choose between these 2?",
+    "How much would I pay out of pocket to see my PCP every year?",
+    "I have a large family with 4 dependents. Which plan is right for me?",
+    "How much prescription coverage is paid for by each of these plans?",
+    "I am over 18 years old and the only person who would be covered by my insurance. Is vision covered by these insurance plans?",
+]
+
+
+def escape_quotes(s):
+    return s.replace("'", "''")
+
+
+# Function to create the results and failures tables on first use
+def create_results_table(session):
+    session.sql(f"""
+    CREATE TABLE IF NOT EXISTS {RESULTS_TABLE} (
+        PLAN_A STRING,
+        PLAN_B STRING,
+        QUESTION STRING,
+        MODEL STRING,
+        PLAN_A_HASH STRING,
+        PLAN_B_HASH STRING,
+        RESPONSE STRING,
+        CREATED_AT TIMESTAMP_LTZ DEFAULT CURRENT_TIMESTAMP()
+    )
+    """).collect()
+    session.sql(f"""
+    CREATE TABLE IF NOT EXISTS {FAILURES_TABLE} (
+        PLAN_A STRING,
+        PLAN_B STRING,
+        QUESTION STRING,
+        MODEL STRING,
+        PLAN_A_HASH STRING,
+        PLAN_B_HASH STRING,
+        ATTEMPTS NUMBER,
+        LAST_ATTEMPT_AT TIMESTAMP_LTZ
+    )
+    """).collect()
+
+
+# Function to build the comparison matrix: every pair of plans x every question,
+# with the current hash of each plan's details
+def build_prompts_table(session, questions=PRE_CANNED_QUESTIONS):
+    questions_values = ", ".join(f"('{escape_quotes(question)}')" for question in questions)
+    session.sql(f"""
+    CREATE OR REPLACE TABLE {PROMPTS_TABLE} AS
+    WITH plans AS (
+        SELECT planname, SHA2(detail, 256) AS detail_hash
+        FROM {PLANS_TABLE}
+        WHERE planname <> 'filename'
+    ),
+    questions AS (
+        SELECT column1 AS question FROM VALUES {questions_values}
+    )
+    SELECT a.planname AS plan_a, b.planname AS plan_b, q.question,
+           a.detail_hash AS plan_a_hash, b.detail_hash AS plan_b_hash
+    FROM plans a
+    JOIN plans b ON a.planname < b.planname
+    CROSS JOIN questions q
+    """).collect()
+
+
+# Condition matching a row (aliased ``alias``) with the same prompt as ``p``
+def same_prompt(alias):
+    return f"""
+        {alias}.plan_a = p.plan_a AND {alias}.plan_b = p.plan_b AND {alias}.question = p.question
+        AND {alias}.model = '{MODEL}'
+        AND {alias}.plan_a_hash = p.plan_a_hash AND {alias}.plan_b_hash = p.plan_b_hash
+    """
+
+
+# Condition selecting the prompts that have no up-to-date answer yet
+UNANSWERED_CONDITION = f"NOT EXISTS (SELECT 1 FROM {RESULTS_TABLE} r WHERE {same_prompt('r')})"
+
+
+# Condition selecting the unanswered prompts that have failed fewer than max_attempts times
+def pending_condition(max_attempts):
+    return f"""
+        {UNANSWERED_CONDITION}
+        AND NOT EXISTS (
+            SELECT 1 FROM {FAILURES_TABLE} e WHERE {same_prompt('e')} AND e.attempts >= {int(max_attempts)}
+        )
+    """
+
+
+def count_pending(session, max_attempts):
+    result = session.sql(f"SELECT COUNT(*) FROM {PROMPTS_TABLE} p WHERE {pending_condition(max_attempts)}").collect()
+    return result[0][0]
+
+
+# Function to list the unanswered prompts skipped after failing max_attempts times
+def list_given_up(session, max_attempts):
+    return session.sql(f"""
+    SELECT p.plan_a, p.plan_b, p.question, f.attempts, f.last_attempt_at
+    FROM {PROMPTS_TABLE} p
+    JOIN {FAILURES_TABLE} f ON {same_prompt('f')}
+    WHERE {UNANSWERED_CONDITION} AND f.attempts >= {int(max_attempts)}
+    ORDER BY p.plan_a, p.plan_b, p.question
+    """).collect()
+
+
+# Pending prompts of the next batch, fewest failed attempts first, joined with the details of both plans
+def next_batch_sql(batch_size, max_attempts):
+    return f"""
+        SELECT p.plan_a, p.plan_b, p.question, p.plan_a_hash, p.plan_b_hash,
+               a.planname AS plan_a_name, a.detail AS plan_a_detail,
+               b.planname AS plan_b_name, b.detail AS plan_b_detail
+        FROM (
+            SELECT p.* FROM {PROMPTS_TABLE} p
+            LEFT JOIN {FAILURES_TABLE} f ON {same_prompt('f')}
+            WHERE {pending_condition(max_attempts)}
+            ORDER BY COALESCE(f.attempts, 0), p.plan_a, p.plan_b, p.question
+            LIMIT {int(batch_size)}
+        ) p
+        JOIN {PLANS_TABLE} a ON a.planname = p.plan_a
+        JOIN {PLANS_TABLE} b ON b.planname = p.plan_b
+    """
+
+
+# Function to estimate the prompt tokens of the next batch (about four characters per token),
+# computed in Snowflake so the plan details are not downloaded
+def estimate_batch_tokens(session, batch_size, max_attempts):
+    result = session.sql(f"""
+    SELECT COALESCE(SUM(LENGTH(question) + LENGTH(plan_a_detail) + LENGTH(plan_b_detail)), 0)
+    FROM ({next_batch_sql(batch_size, max_attempts)})
+    """).collect()
+    return math.ceil(result[0][0] / 4)
+
+
+# Function to answer up to batch_size pending prompts with one set-based TRY_COMPLETE statement.
+# The responses are kept in a temporary table, so the answers are written and the
+# failures (NULL responses) counted from the same batch.
+# Returns the number of answers written and of prompts that failed.
+def run_batch(session, batch_size, max_attempts):
+    session.sql(f"""
+    CREATE OR REPLACE TEMPORARY TABLE {BATCH_TABLE} AS
+        SELECT p.plan_a, p.plan_b, p.question, p.plan_a_hash, p.plan_b_hash,
+               SNOWFLAKE.CORTEX.TRY_COMPLETE(
+                   '{MODEL}',
+                   ARRAY_CONSTRUCT(OBJECT_CONSTRUCT('role', 'user', 'content',
+                       p.question || ' '
+                       || '<plan name="' || p.plan_a_name || '">' || p.plan_a_detail || '</plan> '
+                       || '<plan name="' || p.plan_b_name || '">' || p.plan_b_detail || '</plan>'
+                   )),
+                   PARSE_JSON('{json.dumps(OPTIONS)}')
+               )::STRING AS response
+        FROM ({next_batch_sql(batch_size, max_attempts)}) p
+    """).collect()
+    result = session.sql(f"""
+    INSERT INTO {RESULTS_TABLE} (PLAN_A, PLAN_B, QUESTION, MODEL, PLAN_A_HASH, PLAN_B_HASH, RESPONSE)
+    SELECT plan_a, plan_b, question, '{MODEL}', plan_a_hash, plan_b_hash, response
+    FROM {BATCH_TABLE}
+    WHERE response IS NOT NULL
+    """).collect()
+    written = result[0][0] if result else 0
+    result = session.sql(f"""
+    MERGE INTO {FAILURES_TABLE} f
+    USING (SELECT * FROM {BATCH_TABLE} WHERE response IS NULL) p
+    ON {same_prompt('f')}
+    WHEN MATCHED THEN UPDATE SET attempts = f.attempts + 1, last_attempt_at = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN INSERT (PLAN_A, PLAN_B, QUESTION, MODEL, PLAN_A_HASH, PLAN_B_HASH, ATTEMPTS, LAST_ATTEMPT_AT)
+        VALUES (p.plan_a, p.plan_b, p.question, '{MODEL}', p.plan_a_hash, p.plan_b_hash, 1, CURRENT_TIMESTAMP())
+    """).collect()
+    failed = (result[0][0] + result[0][1]) if result else 0
+    return written, failed
+
+
+# Function to look up a precomputed answer for the current details of the given plans
+def lookup_comparison(session, question, plan_names, plan_hashes):
+    if len(plan_names) != 2:
+        return None
+    plan_a, plan_b = sorted(plan_names)
+    try:
+        result = session.sql(
+            f"""
+            SELECT RESPONSE FROM {RESULTS_TABLE}
+            WHERE PLAN_A = ? AND PLAN_B = ? AND QUESTION = ? AND MODEL = ?
+              AND PLAN_A_HASH = ? AND PLAN_B_HASH = ?
+            ORDER BY CREATED_AT DESC
+            LIMIT 1
+            """,
+            params=[plan_a, plan_b, question, MODEL, plan_hashes.get(plan_a), plan_hashes.get(plan_b)],
+        ).collect()
+    except SnowparkSQLException:
+        # The results table does not exist until the batch job has run once
+        return None
+    return result[0]['RESPONSE'] if result else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute HMO2 plan comparisons.")
+    parser.add_argument("--batch-size", type=int, default=50,
+                        help="Number of comparisons answered per statement (one checkpoint per batch).")
+    parser.add_argument("--tokens-per-minute", type=int, default=None,
+                        help="Prompt tokens per minute allowed for the model (no limit by default).")
+    parser.add_argument("--max-attempts", type=int, default=3,
+                        help="Failed attempts after which a comparison is skipped (counted across runs).")
+    args = parser.parse_args()
+
+    # The same limits, retries and backoff as the app's model calls
+    scheduler = Scheduler(tokens_per_minute={MODEL: args.tokens_per_minute} if args.tokens_per_minute else None)
+
+    session = Session.builder.getOrCreate()
+    create_results_table(session)
+    build_prompts_table(session)
+
+    pending = count_pending(session, args.max_attempts)
+    print(f"{pending} comparisons to compute")
+    while pending:
+        # Every prompt of a batch is either answered or has its attempts counted, so the loop
+        # ends once the remaining prompts have failed max_attempts times
+        tokens = estimate_batch_tokens(session, args.batch_size, args.max_attempts)
+        written, failed = scheduler.run(MODEL, lambda: run_batch(session, args.batch_size, args.max_attempts),
+                                        tokens=tokens)
+        pending = count_pending(session, args.max_attempts)
+        print(f"wrote {written} comparisons, {failed} failed, {pending} remaining")
+    scheduler.shutdown()
+
+    given_up = list_given_up(session, args.max_attempts)
+    if given_up:
+        print(f"{len(given_up)} comparisons skipped after {args.max_attempts} failed attempts:")
+        for row in given_up:
+            print(f"  {row['PLAN_A']} / {row['PLAN_B']}: {row['QUESTION']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,17 @@ import streamlit as st
 import pandas as pd
 from snowflake.snowpark.context import get_active_session
 import json
+import time
+from cortex_utils.cache import ResponseCache, MemoryBackend, make_cache_key
+from cortex_utils.context import pack_documents, prompt_budget
+from cortex_utils.conversation import PrefixCache, document_prefix, get_conversation, history_budget
+from cortex_utils.data_cache import QueryCache, session_key
+from cortex_utils.dashboard import render_performance_dashboard
+from cortex_utils.metrics import CallRecord, CallRecorder, LoggingSink, run_instrumented
+from cortex_utils.scheduler import CortexBackend, Scheduler, message_tokens
+from cortex_utils.sql import complete_over_documents_sql
+from cortex_utils.streaming import TimedStream
+from insurance_batch_compare import PRE_CANNED_QUESTIONS, lookup_comparison
 
 # Set up the main title of the Streamlit app
 st.title("Insurance Plan Comparison with Jamba-1.5-Large and Snowflake Cortex:health_worker::snowflake:")
@@ -19,44 +30,130 @@ st.write("""
 
 
 
-# Function to fetch insurance plans from Snowflake
+# Query listing the available insurance plans
+PLANS_QUERY = "SELECT DISTINCT planname FROM INSURANCE.PUBLIC.HMO2 WHERE planname <> 'filename' ORDER BY planname"
+
+# Shared cache of query results, kept across reruns and users of the app
+@st.cache_resource
+def get_data_cache():
+    return QueryCache()
+
+# Function to fetch insurance plans from Snowflake. The query only runs on the first
+# call; later reruns read the cached rows until the cache is invalidated.
 def get_insurance_plans():
-    query = "SELECT DISTINCT planname FROM INSURANCE.PUBLIC.HMO2 WHERE planname <> 'filename' ORDER BY planname"
-    result = session.sql(query).collect()
+    result = get_data_cache().fetch(session, PLANS_QUERY)
     return [row['PLANNAME'] for row in result]
 
-# Function to run a query using Jamba-1.5-Large
-def run_jamba_query(question, plan_names):
-    # Fetch details for all selected plans
+# Model and generation options used for every comparison
+JAMBA_MODEL = 'jamba-1.5-large'
+JAMBA_OPTIONS = {'temperature': 0.3, 'max_tokens': 5000}
+
+# Cached responses expire after a day even if the plan details are unchanged
+RESPONSE_CACHE_TTL = 24 * 60 * 60
+
+# Shared response cache, kept across reruns and users of the app.
+# Swap MemoryBackend for DiskBackend or SnowflakeTableBackend to persist it.
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache(MemoryBackend(maxsize=256), ttl=RESPONSE_CACHE_TTL)
+
+# Shared recorder of the latency and token usage of every model call
+@st.cache_resource
+def get_call_recorder():
+    return CallRecorder([LoggingSink()])
+
+# Shared scheduler of the model calls: per-model concurrency caps, retries of
+# throttled calls and deduplication of identical prompts, across reruns and users
+@st.cache_resource
+def get_scheduler():
+    return Scheduler()
+
+# Backend of the model calls, one per Snowflake account and role, shared across reruns
+# and users so that the scheduler recognises identical prompts already in flight
+@st.cache_resource
+def get_backend(identity):
+    return CortexBackend(session, get_call_recorder())
+
+# Shared stand-in for a provider-side prompt prefix cache, used to report how much
+# of each conversation prompt would be reprocessed
+@st.cache_resource
+def get_prefix_cache():
+    return PrefixCache()
+
+# Function to fetch a hash of each selected plan's details.
+# The hash is computed in Snowflake so the details are only downloaded on a cache miss.
+def get_plan_hashes(plan_names):
+    plan_hashes_query = f"""
+    SELECT planname, SHA2(detail, 256) AS detail_hash
+    FROM INSURANCE.PUBLIC.HMO2
+    WHERE planname IN ({', '.join('?' for _ in plan_names)})
+    """
+    result = session.sql(plan_hashes_query, params=list(plan_names)).collect()
+    return {row['PLANNAME']: row['DETAIL_HASH'] for row in result}
+
+# Function to build the cache key of a question about the selected plans
+def get_cache_key(question, plan_hashes):
+    return make_cache_key(JAMBA_MODEL, plan_hashes, question, JAMBA_OPTIONS)
+
+# Function to fetch the details of the selected plans, trimmed to what fits in the
+# model's context window (keeping the passages most relevant to the question), less
+# reserved_tokens kept for other parts of the prompt
+def get_plan_documents(plan_names, question="", reserved_tokens=0):
     plan_details_query = f"""
     SELECT planname, detail
     FROM INSURANCE.PUBLIC.HMO2 
-    WHERE planname IN ({', '.join([f"'{name}'" for name in plan_names])})
+    WHERE planname IN ({', '.join('?' for _ in plan_names)})
     """
-    plan_details = session.sql(plan_details_query).collect()
+    plan_details = session.sql(plan_details_query, params=list(plan_names)).collect()
     
-    # Concatenate plan details with delimiters
-    def escape_quotes(s):
-        return s.replace("'", "''").replace('"', '""')
-    
-    concatenated_details = " ".join([
-        f'<plan name="{escape_quotes(row["PLANNAME"])}">{escape_quotes(row["DETAIL"])}</plan>'
-        for row in plan_details
-    ])
-    
-    # Construct the query for Jamba
-    jamba_query = f"""
-    SELECT SNOWFLAKE.CORTEX.COMPLETE(
-        'jamba-1.5-large',
-        ARRAY_CONSTRUCT(
-            OBJECT_CONSTRUCT('role', 'user', 'content', '{escape_quotes(question)} {escape_quotes(concatenated_details)}')
-        ),
-        OBJECT_CONSTRUCT('temperature', 0.3, 'max_tokens', 5000)
-    ) AS response;
-    """
-    
-    result = session.sql(jamba_query).collect()
-    return result[0]['RESPONSE'] if result else None
+    packed = pack_documents(
+        [(row["PLANNAME"], row["DETAIL"]) for row in plan_details],
+        prompt_budget(JAMBA_MODEL, JAMBA_OPTIONS['max_tokens'], question) - reserved_tokens,
+        question,
+    )
+    return packed.documents
+
+# Function to build the prompt from the question and the full details of the selected plans.
+# The prompt is returned as a list of parts; the streaming endpoint takes one string, which
+# the backend joins when it sends the request.
+def build_plan_prompt(question, plan_names):
+    # Delimit each plan's details with a <plan> tag
+    parts = [question]
+    for name, detail in get_plan_documents(plan_names, question):
+        parts += [f' <plan name="{name}">', detail, '</plan>']
+    return parts
+
+# Function to call Jamba-1.5-Large with a prompt assembled inside Snowflake.
+# The plan details never leave Snowflake: only the answer is returned to the app.
+def run_jamba_server_side(question, plan_names):
+    sql, params = complete_over_documents_sql(
+        JAMBA_MODEL,
+        f"{question} ",
+        f"SELECT planname, detail FROM INSURANCE.PUBLIC.HMO2 WHERE planname IN ({', '.join('?' for _ in plan_names)})",
+        """'<plan name="' || planname || '">' || detail || '</plan>'""",
+        "planname",
+        JAMBA_OPTIONS,
+        documents_params=plan_names,
+    )
+    return get_scheduler().run(JAMBA_MODEL, lambda: run_instrumented(session, (sql, params), JAMBA_MODEL, get_call_recorder()))
+
+# Function to stream the Jamba-1.5-Large answer chunk by chunk as it is generated.
+# The prompt stays a list of parts; the backend joins them for the streaming endpoint.
+def stream_jamba_query(messages):
+    return get_scheduler().stream(get_backend(session_key(session)), JAMBA_MODEL, messages, JAMBA_OPTIONS)
+
+# Instructions sent ahead of the plan details in conversation mode
+PLAN_INSTRUCTIONS = "You help users compare the healthcare plans below. Answer their questions using the plan details."
+
+# Tokens of the context window kept for the earlier turns of a conversation and the new question
+def conversation_history_tokens():
+    return history_budget(prompt_budget(JAMBA_MODEL, JAMBA_OPTIONS['max_tokens']))
+
+# Function to build the stable prompt prefix of a conversation about the selected plans.
+# It does not depend on the question, so every turn starts with the same text.
+def build_plan_prefix(plan_names):
+    documents = get_plan_documents(plan_names, reserved_tokens=conversation_history_tokens())
+    return document_prefix(documents, PLAN_INSTRUCTIONS, tag="plan")
 
 # Get all available plans
 all_plans = get_insurance_plans()
@@ -64,22 +161,21 @@ all_plans = get_insurance_plans()
 # Allow user to select up to 2 plans
 selected_plans = st.multiselect("Select up to 2 plans to compare:", all_plans, max_selections=2)
 
+# Display the data cache counters and allow reloading the plan list
+with st.expander("Data Cache"):
+    st.write(get_data_cache().stats())
+    if st.button('Reload Plans'):
+        get_data_cache().invalidate(PLANS_QUERY)
+        st.rerun()
+
 st.write("""
     Below, you can select one of the pre-canned questions or enter your own custom question. 
     The app uses this question to analyze the selected plans and provide a tailored response.
 """)
 
 
-# Pre-canned questions
-pre_canned_questions = [
-    "I need an in-patient procedure, help me choose which plan is best for me?",
-    "Which healthcare plan should I choose between these 2?",
-    "How much would I pay out of pocket to see my PCP every year?",
-    "I have a large family with 4 dependents. Which plan is right for me?",
-    "How much prescription coverage is paid for by each of these plans?",
-    "I am over 18 years old and the only person who would be covered by my insurance. Is vision covered by these insurance plans?",
-    "Custom question"
-]
+# Pre-canned questions, precomputed for every pair of plans by insurance_batch_compare.py
+pre_canned_questions = PRE_CANNED_QUESTIONS + ["Custom question"]
 
 
 
@@ -105,64 +201,175 @@ def escape_markdown(text):
     return ''.join(f"\\{char}" if char in markdown_special_chars else char for char in text)
 
 
+# Optionally build the prompt inside Snowflake instead of in the app
+server_side = st.toggle(
+    "Build the prompt inside Snowflake",
+    help="The plan details are never downloaded to the app, but the answer is shown once complete instead of streamed.",
+)
+
 st.write("""
     The model response will appear below, offering detailed comparisons based on your selected question and plans. 
     You can expand the 'View Full Response' section to see the complete model output in JSON format.
 """)
 
 
+# Function to escape the Markdown characters of a model response.
+# Characters are escaped one by one, so this is also safe on streamed chunks.
+def escape_response_markdown(message):
+    return (
+        message.replace("$", "\\$")
+               .replace("*", "\\*")
+               .replace("_", "\\_")
+               .replace("[", "\\[")
+               .replace("]", "\\]")
+               .replace("(", "\\(")
+               .replace(")", "\\)")
+               .replace("#", "\\#")
+               .replace("+", "\\+")
+               .replace("-", "\\-")
+               .replace(".", "\\.")
+               .replace("!", "\\!")
+    )
+
+# Function to display a complete (e.g. cached) response
+def display_response(jamba_response):
+    try:
+        # Parse the JSON response
+        parsed_response = json.loads(jamba_response)
+        
+        # Extract the message content from the nested structure
+        if 'choices' in parsed_response and len(parsed_response['choices']) > 0:
+            choice = parsed_response['choices'][0]
+            if 'messages' in choice:
+                message = choice['messages']
+            elif 'mesages' in choice:  # Handle potential typo in key name
+                message = choice['mesages']
+            else:
+                message = str(choice)  # Fallback: convert the entire choice to string
+        else:
+            message = str(parsed_response)  # Fallback: convert the entire response to string
+        
+        st.subheader("Model Response:")
+        # Escape common Markdown characters and display with st.write
+        st.write(escape_response_markdown(message))
+        
+        # Add button to view full response JSON
+        with st.expander('View Full Response'):
+            st.json(parsed_response)
+        
+    except json.JSONDecodeError:
+        st.error("Failed to parse JSON response. Raw response:")
+        st.write(f"<pre>{jamba_response}</pre>")
+
+
+# Optionally ask several questions about the same plans
+conversation_mode = st.toggle(
+    "Conversation mode",
+    help="Ask follow-up questions about the selected plans. The plan details come first and are identical "
+         "on every turn, so a prompt prefix cache only has to process the new question.",
+)
+
+if conversation_mode:
+    if not selected_plans:
+        st.info("Select the plans to ask about.")
+    else:
+        # The conversation is kept in session state and restarts when the plan selection changes.
+        # Past half the tokens kept for the history (the rest is for the new question), the
+        # oldest turns are dropped, so the prompt stays within the context window.
+        conversation = get_conversation(
+            st.session_state, tuple(sorted(selected_plans)), lambda: build_plan_prefix(selected_plans),
+            max_history_tokens=conversation_history_tokens() // 2, keep_turns=0,
+        )
+        for asked, answer in conversation.turns:
+            with st.chat_message("user"):
+                st.write(asked)
+            with st.chat_message("assistant"):
+                st.write(escape_response_markdown(answer))
+        
+        follow_up = st.chat_input("Ask a question about the selected plans")
+        if follow_up:
+            with st.chat_message("user"):
+                st.write(follow_up)
+            messages = conversation.messages(follow_up)
+            prefix_usage = get_prefix_cache().process(messages)
+            
+            with st.chat_message("assistant"):
+                stream = TimedStream(get_scheduler().stream(get_backend(session_key(session)), JAMBA_MODEL, messages, JAMBA_OPTIONS))
+                st.write_stream(escape_response_markdown(chunk) for chunk in stream)
+            get_call_recorder().record(CallRecord(JAMBA_MODEL, stream.elapsed,
+                                                  time_to_first_token=stream.time_to_first_token))
+            
+            if stream.text:
+                conversation.add_turn(follow_up, stream.text)
+                
+                # Report how much of the prompt a prefix cache would have to reprocess
+                col1, col2, col3 = st.columns(3)
+                col1.metric("Time to first token", f"{stream.time_to_first_token:.2f}s")
+                col2.metric("Prompt tokens reprocessed", f"{prefix_usage.processed_tokens:,}")
+                col3.metric("Prompt tokens reused", f"{prefix_usage.reused_tokens:,}")
+            else:
+                st.error("No response from Jamba-1.5-Large.")
+
 # Button to run the comparison
-if st.button('Compare Plans') and len(selected_plans) > 0:
-    with st.spinner("Analyzing plans..."):
-        # Run Jamba query for selected plans
-        jamba_response = run_jamba_query(question, selected_plans)
+elif st.button('Compare Plans') and len(selected_plans) > 0:
+    started_at = time.perf_counter()
+    response_cache = get_response_cache()
+    plan_hashes = get_plan_hashes(selected_plans)
+    cache_key = get_cache_key(question, plan_hashes)
+    jamba_response = response_cache.get(cache_key)
+    
+    # Fall back to the comparisons precomputed by the batch job
+    precomputed_response = None
+    if not jamba_response:
+        precomputed_response = lookup_comparison(session, question, selected_plans, plan_hashes)
+    
+    if jamba_response:
+        st.caption("Served from the response cache.")
+        get_call_recorder().record(CallRecord(JAMBA_MODEL, time.perf_counter() - started_at, cache_status="hit"))
+        display_response(jamba_response)
+    elif precomputed_response:
+        st.caption("Served from the precomputed plan comparisons.")
+        get_call_recorder().record(CallRecord(JAMBA_MODEL, time.perf_counter() - started_at, cache_status="precomputed"))
+        response_cache.set(cache_key, precomputed_response)
+        display_response(precomputed_response)
+    elif server_side:
+        with st.spinner("Analyzing plans in Snowflake..."):
+            jamba_response = run_jamba_server_side(question, selected_plans)
         
         if jamba_response:
-            try:
-                # Parse the JSON response
-                parsed_response = json.loads(jamba_response)
-                
-                # Extract the message content from the nested structure
-                if 'choices' in parsed_response and len(parsed_response['choices']) > 0:
-                    choice = parsed_response['choices'][0]
-                    if 'messages' in choice:
-                        message = choice['messages']
-                    elif 'mesages' in choice:  # Handle potential typo in key name
-                        message = choice['mesages']
-                    else:
-                        message = str(choice)  # Fallback: convert the entire choice to string
-                else:
-                    message = str(parsed_response)  # Fallback: convert the entire response to string
-                
-                st.subheader("Model Response:")
-                # Escape common Markdown characters and display with st.write
-                escaped_message = (
-                    message.replace("$", "\\$")
-                           .replace("*", "\\*")
-                           .replace("_", "\\_")
-                           .replace("[", "\\[")
-                           .replace("]", "\\]")
-                           .replace("(", "\\(")
-                           .replace(")", "\\)")
-                           .replace("#", "\\#")
-                           .replace("+", "\\+")
-                           .replace("-", "\\-")
-                           .replace(".", "\\.")
-                           .replace("!", "\\!")
-                )
-                
-                st.write(escaped_message)
-                
-                # Add button to view full response JSON
-                with st.expander('View Full Response'):
-                    st.json(parsed_response)
-                
-            except json.JSONDecodeError:
-                st.error("Failed to parse JSON response. Raw response:")
-                st.write(f"<pre>{jamba_response}</pre>")
+            response_cache.set(cache_key, jamba_response)
+            display_response(jamba_response)
+        else:
+            st.error("No response from Jamba-1.5-Large.")
+    else:
+        # Stream the answer as it is generated instead of waiting for the full completion
+        st.subheader("Model Response:")
+        messages = [{'role': 'user', 'content': build_plan_prompt(question, selected_plans)}]
+        stream = TimedStream(stream_jamba_query(messages))
+        st.write_stream(escape_response_markdown(chunk) for chunk in stream)
+        
+        get_call_recorder().record(CallRecord(JAMBA_MODEL, time.perf_counter() - started_at,
+                                              time_to_first_token=stream.time_to_first_token))
+        
+        if stream.text:
+            # The streaming endpoint reports no usage, so the cached response holds an estimate
+            jamba_response = stream.response_json(JAMBA_MODEL, message_tokens(messages))
+            response_cache.set(cache_key, jamba_response)
+            
+            # Report how long users waited for the first and last token
+            col1, col2 = st.columns(2)
+            col1.metric("Time to first token", f"{stream.time_to_first_token:.2f}s")
+            col2.metric("Total generation time", f"{stream.elapsed:.2f}s")
+            
+            with st.expander('View Full Response'):
+                st.json(json.loads(jamba_response))
         else:
             st.error("No response from Jamba-1.5-Large.")
     st.success('Comparison complete!')
     
+# Latency and token usage of the model calls made by the app
+with st.expander("Performance"):
+    render_performance_dashboard(session, get_call_recorder(), get_scheduler())
+
 st.markdown("---")
-st.write("Note: This app uses the Jamba-1.5-Large model to analyze insurance plans. The app  makes a single call to Jamba with concatenated plan details for efficient comparison.")
\ No newline at end of file
+st.write("Note: This app uses the Jamba-1.5-Large model to analyze insurance plans. The app  makes a single call to Jamba with concatenated plan details for efficient comparison, streams the answer as it is generated and caches it for repeated questions.")
\ No newline at end of file
@@ -2,8 +2,24 @@
 import streamlit as st
 import pandas as pd
 import json
+import sys
+import time
+from pathlib import Path
 from snowflake.snowpark.context import get_active_session
 
+# Make the shared cortex_utils package (in the repository root) importable
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from cortex_utils.context import context_window, pack_documents, prompt_budget
+from cortex_utils.conversation import PrefixCache, document_prefix, get_conversation, history_budget
+from cortex_utils.dashboard import render_performance_dashboard
+from cortex_utils.data_cache import QueryCache, session_key
+from cortex_utils.frames import filing_frame, frame_documents, preview_frame
+from cortex_utils.map_reduce import map_reduce
+from cortex_utils.metrics import CallRecord, CallRecorder, LoggingSink, run_instrumented
+from cortex_utils.scheduler import CortexBackend, Scheduler
+from cortex_utils.sql import complete_over_documents_sql
+from cortex_utils.streaming import TimedStream
+
 
 # Set up the main title of the Streamlit app
 st.title("AI21's Jamba-Instruct in Snowflake Cortex :snake::snowflake:")
@@ -59,56 +75,142 @@ order by FILED_DATE desc, PERIOD_END_DATE desc)
     """
 
 
-# Function to fetch sec data from Snowflake
+# Shared cache of query results, kept across reruns and users of the app
+@st.cache_resource
+def get_data_cache():
+    return QueryCache()
+
+# Shared recorder of the latency and token usage of every model call
+@st.cache_resource
+def get_call_recorder():
+    return CallRecorder([LoggingSink()])
+
+# Shared scheduler of the model calls: per-model concurrency caps, retries of
+# throttled calls and deduplication of identical prompts, across reruns and users
+@st.cache_resource
+def get_scheduler():
+    return Scheduler()
+
+# Backend of the model calls, one per Snowflake account and role, shared across reruns
+# and users so that the scheduler recognises identical prompts already in flight
+@st.cache_resource
+def get_backend(identity):
+    return CortexBackend(session, get_call_recorder())
+
+# Shared stand-in for a provider-side prompt prefix cache, used to report how much
+# of each conversation prompt would be reprocessed
+@st.cache_resource
+def get_prefix_cache():
+    return PrefixCache()
+
+# Columnar view of the filings, built once per Snowflake account and role from the cached
+# rows, like the query cache itself
+@st.cache_resource
+def load_filing_frame(identity):
+    return filing_frame(get_data_cache().fetch(session, sec_query))
+
+# Function to fetch sec data from Snowflake as a DataFrame. The join only runs on the
+# first call; later reruns reuse the cached DataFrame until the cache is invalidated.
 def run_data_query():
-    query = sec_query
-    result = session.sql(query).collect()
-    return result
+    return load_filing_frame(session_key(session))
 
-# Function to run a specific query using the selected language model
-def run_query(question):
-    params = f"""
-    SELECT SNOWFLAKE.CORTEX.COMPLETE(
-        '{option}',
-        ARRAY_CONSTRUCT(
-            OBJECT_CONSTRUCT('role', 'system', 'content', 'You are a helpful AI SEC filing assistant. Answer the question in a helpful and concise way, if you don''t know the answer respond with "I don''t know"'),
-            OBJECT_CONSTRUCT('role', 'user', 'content', '{question}')
-        ),
-        OBJECT_CONSTRUCT('temperature', 0.7, 'max_tokens', 3000)
-    );
-    """
-    result = session.sql(params).collect()
-    return result[0][0] if result else None
+# Function to drop the cached filing rows together with the DataFrames built from them
+def invalidate_filings():
+    get_data_cache().invalidate(sec_query)
+    load_filing_frame.clear()
+
+# System prompt of the SEC filing assistant
+SYSTEM_PROMPT = 'You are a helpful AI SEC filing assistant. Answer the question in a helpful and concise way, if you don\'t know the answer respond with "I don\'t know"'
 
-# Fetch the data
-filing_data = run_data_query()
+# Generation options of every question
+QUERY_OPTIONS = {'temperature': 0.7, 'max_tokens': 3000}
+
+# Function to run a specific query using the selected language model through the scheduler.
+# The question is passed as a bind parameter, so the SQL text is the same for every question.
+def run_query(question):
+    messages = [
+        {'role': 'system', 'content': SYSTEM_PROMPT},
+        {'role': 'user', 'content': question},
+    ]
+    return get_scheduler().complete(get_backend(session_key(session)), option, messages, QUERY_OPTIONS)
+
+# Function to return only the answer text of the selected language model
+def run_query_text(prompt):
+    result = run_query(prompt)
+    return json.loads(result)['choices'][0]['messages'] if result else ''
+
+# Function to return a callable answering prompts with the selected language model, for
+# map-reduce, which calls it from worker threads. The scheduler and backend are looked up here,
+# on the script thread: worker threads have no Streamlit script context, so they must not call
+# st.cache_resource functions.
+def query_text_runner():
+    scheduler, backend = get_scheduler(), get_backend(session_key(session))
+    
+    def run(prompt):
+        messages = [
+            {'role': 'system', 'content': SYSTEM_PROMPT},
+            {'role': 'user', 'content': prompt},
+        ]
+        result = scheduler.complete(backend, option, messages, QUERY_OPTIONS)
+        return json.loads(result)['choices'][0]['messages'] if result else ''
+    return run
+
+# Function to answer the question with a prompt assembled inside Snowflake.
+# The filings never leave Snowflake: only the answer is returned to the app.
+def run_server_side_query(question):
+    # Cut each filing in SQL if the model's context window cannot hold all of them
+    # (about four characters per token)
+    budget_chars = prompt_budget(option, 3000, question) * 4
+    sql, params = complete_over_documents_sql(
+        option,
+        f"{question}\n\n\n\n",
+        f"SELECT VALUE, FILED_DATE, PERIOD_END_DATE, COUNT(*) OVER () AS FILING_COUNT FROM {sec_query}",
+        f"LEFT(VALUE, FLOOR({budget_chars} / FILING_COUNT))",
+        "FILED_DATE DESC, PERIOD_END_DATE DESC",
+        QUERY_OPTIONS,
+        system_prompt=SYSTEM_PROMPT,
+    )
+    return get_scheduler().run(option, lambda: run_instrumented(session, (sql, params), option, get_call_recorder()))
+
+# Function to stream the answer of the selected language model chunk by chunk
+def stream_query(question):
+    messages = [
+        {'role': 'system', 'content': SYSTEM_PROMPT},
+        {'role': 'user', 'content': question},
+    ]
+    return get_scheduler().stream(get_backend(session_key(session)), option, messages, QUERY_OPTIONS)
+
+# Tokens of the model's context window kept for the earlier turns of a conversation and the new question
+def conversation_history_tokens(model):
+    return history_budget(prompt_budget(model, 3000))
+
+# Function to build the stable prompt prefix of a conversation about the filings:
+# the system prompt and the filings packed into the model's context window, without the question
+def build_filing_prefix(model):
+    packed = pack_documents(
+        frame_documents(run_data_query()),
+        prompt_budget(model, 3000) - conversation_history_tokens(model),
+    )
+    return document_prefix(packed.documents, SYSTEM_PROMPT, tag="filing")
 
 # Display the SQL query used to fetch the data
 with st.expander("View SQL Query:"):
     st.code(sec_query)
 
+# Display the data cache counters and allow reloading the filings
+with st.expander("Data Cache:"):
+    st.write(get_data_cache().stats())
+    if st.button('Reload 10K Data'):
+        invalidate_filings()
+        st.rerun()
+
 # Button to display the filing details
 if st.button('View 10K Detail'):
-    if filing_data:
-        # Create a DataFrame for the main details
-        df_main = pd.DataFrame([{
-            'SEC_DOCUMENT_ID': row['SEC_DOCUMENT_ID'],
-            'VARIABLE_NAME': row['VARIABLE_NAME'],
-            'COMPANY_NAME': row['COMPANY_NAME'],
-            'FILED_DATE': row['FILED_DATE'],
-            'FISCAL_YEAR': row['FISCAL_YEAR'],
-            'VALUE': row['VALUE']
-        } for row in filing_data])
-        
-        # Display the main details as a DataFrame
-        st.dataframe(df_main)
-
-        # Create a string variable with all VALUE data concatenated
-        all_values = ' '.join(df_main['VALUE'].astype(str))
-        
-        # Display the concatenated string
-        # st.write("All VALUES concatenated:")
-        # st.text(all_values)
+    # Fetch the data
+    filing_data = run_data_query()
+    if not filing_data.empty:
+        # Display the main details, with a preview of each filing instead of its full text
+        st.dataframe(preview_frame(filing_data))
     else:
         st.error("No filing data available.")
 
@@ -151,50 +253,146 @@ question = st.text_input("Enter your question:", "Summarize the key themes in th
 
 
 
+# Select how the filings are sent to the model
+mode = st.radio(
+    "Processing mode:",
+    ("Single prompt", "Server-side prompt", "Map-reduce", "Conversation"),
+    horizontal=True,
+    help="Server-side prompt builds the prompt inside Snowflake, so the filings are never downloaded "
+         "(the answer is not streamed). Map-reduce splits the filings into sections, queries the sections "
+         "concurrently and combines the partial answers. Use it with models whose context window cannot "
+         "hold the filings. Conversation keeps the filings first and identical on every turn, so follow-up "
+         "questions only add the new question to the prompt.",
+)
+
+if mode == "Conversation":
+    # The conversation is kept in session state and restarts when the model changes.
+    # Past half the tokens kept for the history (the rest is for the new question), the
+    # oldest turns are dropped, so the prompt stays within the model's context window.
+    conversation = get_conversation(
+        st.session_state, option, lambda: build_filing_prefix(option),
+        max_history_tokens=conversation_history_tokens(option) // 2, keep_turns=0,
+    )
+    for asked, answer in conversation.turns:
+        with st.chat_message("user"):
+            st.write(asked)
+        with st.chat_message("assistant"):
+            st.write(answer)
+    
+    follow_up = st.chat_input("Ask a question about the filings")
+    if follow_up:
+        with st.chat_message("user"):
+            st.write(follow_up)
+        messages = conversation.messages(follow_up)
+        prefix_usage = get_prefix_cache().process(messages)
+        
+        with st.chat_message("assistant"):
+            stream = TimedStream(get_scheduler().stream(get_backend(session_key(session)), option, messages, QUERY_OPTIONS))
+            st.write_stream(stream)
+        get_call_recorder().record(CallRecord(option, stream.elapsed, time_to_first_token=stream.time_to_first_token))
+        
+        if stream.text:
+            conversation.add_turn(follow_up, stream.text)
+            
+            # Report how much of the prompt a prefix cache would have to reprocess
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Time to first token", f"{stream.time_to_first_token:.2f}s")
+            col2.metric("Prompt tokens reprocessed", f"{prefix_usage.processed_tokens:,}")
+            col3.metric("Prompt tokens reused", f"{prefix_usage.reused_tokens:,}")
+        else:
+            st.error("No result returned from the query.")
+
 # Button to run the sec filing query
-if st.button('Run Filing Query'):
-    with st.spinner("Fetching filing data and running query..."):
-        if filing_data:
-            df_main = pd.DataFrame([{
-                'SEC_DOCUMENT_ID': row['SEC_DOCUMENT_ID'],
-                'VARIABLE_NAME': row['VARIABLE_NAME'],
-                'COMPANY_NAME': row['COMPANY_NAME'],
-                'FILED_DATE': row['FILED_DATE'],
-                'FISCAL_YEAR': row['FISCAL_YEAR'],
-                'VALUE': row['VALUE']
-            } for row in filing_data])
+elif st.button('Run Filing Query'):
+    # Only download the filings when the prompt is built in the app
+    filing_documents = frame_documents(run_data_query()) if mode != "Server-side prompt" else []
+    
+    if mode == "Server-side prompt":
+        with st.spinner("Running the query inside Snowflake..."):
+            started_at = time.perf_counter()
+            query_result = run_server_side_query(question)
+            elapsed = time.perf_counter() - started_at
+        
+        if query_result:
+            result_json = json.loads(query_result)
+            st.write("Jamba-Instruct Response:")
+            st.write(result_json['choices'][0]['messages'])
             
-            # Create a string variable with all VALUE data concatenated
-            all_values = ' '.join(df_main['VALUE'].astype(str))
+            # Report the cost of the query; only the answer was transferred
+            usage = result_json.get('usage', {})
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Total time", f"{elapsed:.2f}s")
+            col2.metric("Prompt tokens", f"{usage.get('prompt_tokens', 0):,}")
+            col3.metric("Bytes downloaded", f"{len(query_result):,}")
             
-            # Prepare the question with context
-            question_context = f"{question}\n\n\n\n{all_values}".replace('"', '').replace("'", '')
-            with st.expander("View Query and Context"):
-                st.write(question_context)
+            with st.expander("View Full Response"):
+                st.json(result_json)
+        else:
+            st.error("No result returned from the query.")
+    elif filing_documents and mode == "Map-reduce":
+        with st.spinner("Querying the filing sections concurrently..."):
+            result = map_reduce(
+                filing_documents,
+                question,
+                query_text_runner(),
+                prompt_budget(option, 3000),
+            )
+        
+        if result.answer:
+            st.write("Jamba-Instruct Response:")
+            st.write(result.answer)
             
-            # Run the query
-            query_result = run_query(question_context)
+            # Report the cost of the map-reduce run
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Model calls", result.calls)
+            col2.metric("Prompt tokens (est.)", f"{result.prompt_tokens:,}")
+            col3.metric("Total time", f"{result.elapsed:.2f}s")
+        else:
+            st.error("No result returned from the query.")
+    elif filing_documents:
+        # Trim the filings to what fits in the selected model's context window
+        packed = pack_documents(
+            filing_documents,
+            prompt_budget(option, 3000, question),
+            question,
+        )
+        if packed.trimmed:
+            st.info(f"{option} has a {context_window(option):,}-token context window, so the filings for "
+                    f"{', '.join(packed.trimmed)} were trimmed to the passages most relevant to the question "
+                    f"(~{packed.tokens:,} tokens of context).")
+        
+        # Prepare the question with context, copying the filings into the prompt only once
+        question_context = ' '.join([f"{question}\n\n\n\n"] + [text for _, text in packed.documents])
+        with st.expander("View Query and Context"):
+            st.write(question_context)
+        
+        # Stream the answer as it is generated instead of waiting for the full completion
+        st.write("Jamba-Instruct Response:")
+        stream = TimedStream(stream_query(question_context))
+        st.write_stream(stream)
+        get_call_recorder().record(CallRecord(option, stream.elapsed, time_to_first_token=stream.time_to_first_token))
+        
+        if stream.text:
+            # Report how long users waited for the first and last token
+            col1, col2 = st.columns(2)
+            col1.metric("Time to first token", f"{stream.time_to_first_token:.2f}s")
+            col2.metric("Total generation time", f"{stream.elapsed:.2f}s")
             
-            if query_result:
-                # Parse the JSON string
-                result_json = json.loads(query_result)
-                
-                # Display the message in a text area
-                message = result_json['choices'][0]['messages']
-                st.write("Jamba-Instruct Response:")
-                st.write(message)
-                
-                # Display the full response in an expandable section
-                with st.expander("View Full Response"):
-                    st.json(result_json)
-            else:
-                st.error("No result returned from the query.")
+            # Display the full response in an expandable section
+            with st.expander("View Full Response"):
+                st.json(json.loads(stream.response_json(option)))
         else:
-            st.error("No result returned from the data query.")
-    
+            st.error("No result returned from the query.")
+    else:
+        st.error("No result returned from the data query.")
+
     st.success('Done!')
     st.write("""
-    The 'View Full Response' expander shows the json response returned from Snowflake Cortex. You can see details such as number of tokens submitted and returned.
+    The 'View Full Response' expander shows the streamed response together with the time to first token and the total generation time.
     """)
 
+# Latency and token usage of the model calls made by the app
+with st.expander("Performance"):
+    render_performance_dashboard(session, get_call_recorder(), get_scheduler())
+
 st.markdown("---")